@@ -34,6 +34,7 @@ from . import (
     preprocessing,
     schedules,
     table,
+    tfimage,
     threading,
     typing,
     utils,
@@ -2,15 +2,18 @@
 
 <https://github.com/tensorflow/models/tree/master/research/autoaugment>
 
+元実装はPILだが、ここではnumpy/OpenCVで(PILとほぼ同じ結果になるように)実装している。
+サブポリシー内で連続する幾何変換は行列を合成して1回のcv2.warpAffineで適用する。
+
 """
 # pylint: disable=arguments-differ,abstract-method,unused-argument
 import random
+import typing
 
 import albumentations as A
+import cv2
 import numpy as np
 import PIL.Image
-import PIL.ImageEnhance
-import PIL.ImageOps
 
 
 class CIFAR10Policy(A.OneOf):
@@ -132,10 +135,99 @@ class ImageNetPolicy(A.OneOf):
 
 def subpolicy(a1, p1, mag1, a2, p2, mag2):
     """サブポリシー。"""
-    return A.Compose([a1(mag=mag1, p=p1), a2(mag=mag2, p=p2)], p=1)
+    return SubPolicy([a1(mag=mag1, p=p1), a2(mag=mag2, p=p2)], p=1)
+
+
+class SubPolicy(A.Compose):
+    """サブポリシー。
+
+    A.Composeと同じ順番で乱数を使いつつ、連続する幾何変換(GeometricTransform)は
+    変換行列を合成して1回の補間で適用する。
+
+    """
+
+    def __call__(self, force_apply=False, **data):
+        """変換の適用。"""
+        need_to_run = force_apply or random.random() < self.p
+        transforms = [
+            t for t in self.transforms.transforms if need_to_run or t.always_apply
+        ]
+        matrices: typing.List[np.ndarray] = []
+        interpolations: typing.List[int] = []
+        for t in transforms:
+            if not isinstance(t, GeometricTransform) or "image" not in data:
+                if len(matrices) > 0:
+                    data["image"] = warp_affine(data["image"], matrices, interpolations)
+                    matrices, interpolations = [], []
+                data = t(force_apply=force_apply, **data)
+            elif random.random() < t.p or t.always_apply or force_apply:
+                matrices.append(t.get_matrix(data["image"].shape))
+                interpolations.append(t.interpolation)
+        if len(matrices) > 0:
+            data["image"] = warp_affine(data["image"], matrices, interpolations)
+        return data
+
+
+def warp_affine(
+    image: np.ndarray,
+    matrices: typing.Sequence[np.ndarray],
+    interpolations: typing.Sequence[int],
+) -> np.ndarray:
+    """幾何変換をまとめて適用する。
+
+    Args:
+        image: 画像
+        matrices: 適用順の変換行列(出力座標から入力座標への3x3行列。PILの座標系)のリスト
+        interpolations: 各変換の補間方法(cv2.INTER_*)。最も高品質なものを使う。
+
+    Returns:
+        変換後の画像。(範囲外は128で埋める)
+
+    """
+    # 出力→入力の行列なので、後の変換ほど右から掛ける
+    m = np.eye(3)
+    for matrix in matrices:
+        m = m @ matrix
+    # PILはピクセルの左上、OpenCVはピクセルの中心が整数座標なので補正する
+    m = _translation(-0.5, -0.5) @ m @ _translation(0.5, 0.5)
+    interpolation = (
+        cv2.INTER_CUBIC if cv2.INTER_CUBIC in interpolations else max(interpolations)
+    )
+    num_channels = image.shape[2] if image.ndim == 3 else None
+    output = cv2.warpAffine(
+        image,
+        m[:2],
+        (image.shape[1], image.shape[0]),
+        flags=interpolation | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=(128, 128, 128, 128),
+    )
+    if num_channels == 1 and output.ndim == 2:
+        output = np.expand_dims(output, axis=-1)
+    return output
+
+
+def _translation(x: float, y: float) -> np.ndarray:
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+
+
+class GeometricTransform(A.ImageOnlyTransform):
+    """幾何変換の基底クラス。(SubPolicyで合成できるもの)"""
+
+    #: 補間方法
+    interpolation: int = cv2.INTER_CUBIC
+
+    def apply(self, image, **params):
+        return warp_affine(
+            image, [self.get_matrix(image.shape)], [self.interpolation]
+        )
 
+    def get_matrix(self, image_shape: typing.Tuple[int, ...]) -> np.ndarray:
+        """変換行列(出力座標から入力座標への3x3行列。PILの座標系)を返す。(乱数を使う)"""
+        raise NotImplementedError()
 
-class Affine(A.ImageOnlyTransform):
+
+class Affine(GeometricTransform):
     """Affine変換。
 
     TODO: 物体検出とかへの対応。
@@ -157,26 +249,19 @@ class Affine(A.ImageOnlyTransform):
         self.translate_x_mag = translate_x_mag
         self.translate_y_mag = translate_y_mag
 
-    def apply(self, image, **params):
+    def get_matrix(self, image_shape: typing.Tuple[int, ...]) -> np.ndarray:
         shear_x = float_parameter(self.shear_x_mag, 0.3, flip_sign=True)
         shear_y = float_parameter(self.shear_y_mag, 0.3, flip_sign=True)
         translate_x = float_parameter(
-            self.translate_x_mag, image.shape[1] * 150 / 331, flip_sign=True
+            self.translate_x_mag, image_shape[1] * 150 / 331, flip_sign=True
         )
         translate_y = float_parameter(
-            self.translate_y_mag, image.shape[0] * 150 / 331, flip_sign=True
+            self.translate_y_mag, image_shape[0] * 150 / 331, flip_sign=True
         )
-        image = to_pillow(image)
-        data = (1, shear_x, translate_x, shear_y, 1, translate_y)
-        return np.asarray(
-            image.transform(
-                image.size,
-                PIL.Image.AFFINE,
-                data,
-                PIL.Image.BICUBIC,
-                fillcolor=(128,) if image.mode == "L" else (128, 128, 128),
-            ),
-            dtype=np.uint8,
+        # PIL.Image.AFFINEのdata = (1, shear_x, translate_x, shear_y, 1, translate_y)
+        return np.array(
+            [[1, shear_x, translate_x], [shear_y, 1, translate_y], [0, 0, 1]],
+            dtype=np.float64,
         )
 
     def get_transform_init_args_names(self):
@@ -228,25 +313,30 @@ class TranslateY(Affine):
         return ("mag",)
 
 
-class Rotate(A.ImageOnlyTransform):
-    """回転。
+class Rotate(GeometricTransform):
+    """回転。(PIL.Image.rotateと同じく中心で反時計回り、最近傍補間)
 
     TODO: maskとかへの対応。
 
     """
 
+    interpolation = cv2.INTER_NEAREST
+
     def __init__(self, mag, always_apply=False, p=0.5):
         super().__init__(always_apply, p)
         self.mag = mag
 
-    def apply(self, image, **params):
+    def get_matrix(self, image_shape: typing.Tuple[int, ...]) -> np.ndarray:
         degrees = int_parameter(self.mag, 30, flip_sign=True)
-        image = to_pillow(image)
-        in_mode = image.mode
-        image = image.convert("RGBA").rotate(degrees)
-        bg = PIL.Image.new("RGBA", image.size, (128, 128, 128, 255))
-        image = PIL.Image.composite(image, bg, image).convert(in_mode)
-        return np.asarray(image, dtype=np.uint8)
+        angle = -np.radians(degrees)
+        cos, sin = np.cos(angle), np.sin(angle)
+        center_x, center_y = image_shape[1] / 2, image_shape[0] / 2
+        rotation = np.array([[cos, sin, 0], [-sin, cos, 0], [0, 0, 1]], dtype=np.float64)
+        return (
+            _translation(center_x, center_y)
+            @ rotation
+            @ _translation(-center_x, -center_y)
+        )
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -260,8 +350,17 @@ class AutoContrast(A.ImageOnlyTransform):
         del mag
 
     def apply(self, image, **params):
-        image = to_pillow(image)
-        return np.asarray(PIL.ImageOps.autocontrast(image), dtype=np.uint8)
+        luts = []
+        for c in range(_channels(image)):
+            hist = np.bincount(_channel(image, c).ravel(), minlength=256)
+            (nonzero,) = np.nonzero(hist)
+            lo, hi = nonzero[0], nonzero[-1]
+            if hi <= lo:
+                luts.append(np.arange(256))
+            else:
+                scale = 255.0 / (hi - lo)
+                luts.append(np.trunc(np.arange(256) * scale - lo * scale))
+        return _apply_luts(image, luts)
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -275,8 +374,7 @@ class Invert(A.ImageOnlyTransform):
         del mag
 
     def apply(self, image, **params):
-        image = to_pillow(image)
-        return np.asarray(PIL.ImageOps.invert(image), dtype=np.uint8)
+        return 255 - image
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -290,8 +388,17 @@ class Equalize(A.ImageOnlyTransform):
         del mag
 
     def apply(self, image, **params):
-        image = to_pillow(image)
-        return np.asarray(PIL.ImageOps.equalize(image), dtype=np.uint8)
+        luts = []
+        for c in range(_channels(image)):
+            hist = np.bincount(_channel(image, c).ravel(), minlength=256)
+            nonzero = hist[hist > 0]
+            step = (nonzero.sum() - nonzero[-1]) // 255 if len(nonzero) > 1 else 0
+            if step <= 0:
+                luts.append(np.arange(256))
+            else:
+                cumsum = np.concatenate([[0], np.cumsum(hist)[:-1]])
+                luts.append((step // 2 + cumsum) // step)
+        return _apply_luts(image, luts)
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -306,8 +413,7 @@ class Solarize(A.ImageOnlyTransform):
 
     def apply(self, image, **params):
         threshold = 256 - int_parameter(self.mag, 256)
-        image = to_pillow(image)
-        return np.asarray(PIL.ImageOps.solarize(image, threshold), dtype=np.uint8)
+        return np.where(image < threshold, image, 255 - image).astype(np.uint8)
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -323,8 +429,7 @@ class Posterize(A.ImageOnlyTransform):
     def apply(self, image, **params):
         # https://github.com/tensorflow/models/blob/master/research/autoaugment/augmentation_transforms.py#L267 🤔
         bit = 8 - int_parameter(self.mag, 4)
-        image = to_pillow(image)
-        return np.asarray(PIL.ImageOps.posterize(image, bit), dtype=np.uint8)
+        return image & np.uint8(~(2 ** (8 - bit) - 1) & 0xFF)
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -339,10 +444,8 @@ class Contrast(A.ImageOnlyTransform):
 
     def apply(self, image, **params):
         factor = 1 + float_parameter(self.mag, 0.9, flip_sign=True)
-        image = to_pillow(image)
-        return np.asarray(
-            PIL.ImageEnhance.Contrast(image).enhance(factor), dtype=np.uint8
-        )
+        mean = int(np.mean(_to_gray(image)) + 0.5)
+        return _blend(np.float32(mean), image, factor)
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -357,8 +460,9 @@ class Color(A.ImageOnlyTransform):
 
     def apply(self, image, **params):
         factor = 1 + float_parameter(self.mag, 0.9, flip_sign=True)
-        image = to_pillow(image)
-        return np.asarray(PIL.ImageEnhance.Color(image).enhance(factor), dtype=np.uint8)
+        if _channels(image) != 3:
+            return image  # グレースケールなら変化なし
+        return _blend(_to_gray(image), image, factor)
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -373,10 +477,7 @@ class Brightness(A.ImageOnlyTransform):
 
     def apply(self, image, **params):
         factor = 1 + float_parameter(self.mag, 0.9, flip_sign=True)
-        image = to_pillow(image)
-        return np.asarray(
-            PIL.ImageEnhance.Brightness(image).enhance(factor), dtype=np.uint8
-        )
+        return _blend(np.float32(0), image, factor)
 
     def get_transform_init_args_names(self):
         return ("mag",)
@@ -391,15 +492,52 @@ class Sharpness(A.ImageOnlyTransform):
 
     def apply(self, image, **params):
         factor = 1 + float_parameter(self.mag, 0.9, flip_sign=True)
-        image = to_pillow(image)
-        return np.asarray(
-            PIL.ImageEnhance.Sharpness(image).enhance(factor), dtype=np.uint8
-        )
+        # PIL.ImageFilter.SMOOTH相当 (端の1ピクセルは元のまま)
+        kernel = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+        smooth = cv2.filter2D(image.astype(np.float32), -1, kernel)
+        smooth = np.floor(smooth + 0.5).reshape(image.shape)
+        degenerate = image.astype(np.float32)
+        degenerate[1:-1, 1:-1] = smooth[1:-1, 1:-1]
+        return _blend(degenerate, image, factor)
 
     def get_transform_init_args_names(self):
         return ("mag",)
 
 
+def _channels(image: np.ndarray) -> int:
+    return image.shape[2] if image.ndim == 3 else 1
+
+
+def _channel(image: np.ndarray, c: int) -> np.ndarray:
+    return image[..., c] if image.ndim == 3 else image
+
+
+def _apply_luts(image: np.ndarray, luts: typing.Sequence[np.ndarray]) -> np.ndarray:
+    """チャンネルごとのLUTを適用する。"""
+    luts = [np.clip(lut, 0, 255).astype(np.uint8) for lut in luts]
+    if image.ndim == 2:
+        return luts[0][image]
+    return np.stack([lut[image[..., c]] for c, lut in enumerate(luts)], axis=-1)
+
+
+def _to_gray(image: np.ndarray) -> np.ndarray:
+    """PILの"L"への変換相当。(RGBならshapeはそのままで各チャンネルに同じ値)"""
+    if _channels(image) != 3:
+        return image
+    rgb = image.astype(np.int32)
+    gray = (
+        rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000
+    ) >> 16
+    return np.repeat(gray[..., np.newaxis], 3, axis=-1)
+
+
+def _blend(degenerate, image: np.ndarray, factor: float) -> np.ndarray:
+    """PIL.Image.blend(degenerate, image, factor)相当。"""
+    degenerate = np.asarray(degenerate, dtype=np.float32)
+    result = degenerate + np.float32(factor) * (image.astype(np.float32) - degenerate)
+    return np.clip(result, 0, 255).astype(np.uint8)
+
+
 def to_pillow(image: np.ndarray) -> PIL.Image:
     """ndarrayからPIL.Imageへの変換。"""
     image = np.squeeze(image)
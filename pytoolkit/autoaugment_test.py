@@ -68,3 +68,61 @@ def test_transforms(data_dir, save_dir, klass, grayscale, mag):
         save_dir / f"transform.{klass.__name__}.{grayscale=}.{mag=}.png",
         img,
     )
+
+
+def test_pil_compatibility(data_dir):
+    """PIL版と(ほぼ)同じ結果になることの確認"""
+    import random
+
+    import numpy as np
+    import PIL.Image
+    import PIL.ImageEnhance
+    import PIL.ImageOps
+
+    img = tk.ndimage.load(data_dir / "Lenna.png")
+    pil_img = PIL.Image.fromarray(img)
+
+    def check(transform, expected, atol):
+        random.seed(1)
+        actual = transform.apply(img)
+        diff = np.abs(actual.astype(np.int32) - np.asarray(expected, dtype=np.int32))
+        assert diff.mean() <= atol, f"{type(transform).__name__}: {diff.mean()}"
+
+    aa = tk.autoaugment
+    check(aa.Invert(mag=0), PIL.ImageOps.invert(pil_img), 0)
+    check(aa.Equalize(mag=0), PIL.ImageOps.equalize(pil_img), 0)
+    check(aa.AutoContrast(mag=0), PIL.ImageOps.autocontrast(pil_img), 0)
+    check(aa.Solarize(mag=5), PIL.ImageOps.solarize(pil_img, 256 - 142), 0)
+    check(aa.Posterize(mag=5), PIL.ImageOps.posterize(pil_img, 8 - 2), 0)
+    random.seed(1)
+    factor = 1 + aa.float_parameter(7, 0.9, flip_sign=True)
+    for cls, enhance in [
+        (aa.Contrast, PIL.ImageEnhance.Contrast),
+        (aa.Color, PIL.ImageEnhance.Color),
+        (aa.Brightness, PIL.ImageEnhance.Brightness),
+        (aa.Sharpness, PIL.ImageEnhance.Sharpness),
+    ]:
+        check(cls(mag=7), enhance(pil_img).enhance(factor), 1)
+
+
+def test_subpolicy_fused(data_dir):
+    """連続する幾何変換を1回で適用した場合と、1つずつ適用した場合がほぼ同じになることの確認"""
+    import random
+
+    import numpy as np
+
+    img = tk.ndimage.load(data_dir / "Lenna.png")
+    aa = tk.autoaugment
+    policy = aa.subpolicy(aa.ShearY, 1.0, 8, aa.TranslateY, 1.0, 3)
+    random.seed(1)
+    fused = policy(image=img)["image"]
+    random.seed(1)
+    random.random()  # SubPolicy(A.Compose)のp
+    sequential = img
+    for t in policy.transforms.transforms:
+        random.random()  # 各変換のp
+        sequential = t.apply(sequential)
+    assert fused.shape == img.shape
+    # 補間が1回で済む分だけ差がある程度
+    diff = np.abs(fused.astype(np.int32) - sequential.astype(np.int32))
+    assert diff.mean() < 8
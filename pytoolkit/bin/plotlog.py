@@ -3,6 +3,7 @@
 import argparse
 import base64
 import io
+import json
 import pathlib
 import re
 import sys
@@ -29,7 +30,9 @@ def main():
     parser = argparse.ArgumentParser(
         description="tk.callbacks.EpochLogger()で出力したログからグラフを描画するスクリプト。"
     )
-    parser.add_argument("logfile", type=pathlib.Path, help="対象のログファイルのパス")
+    parser.add_argument(
+        "logfile", type=pathlib.Path, help="対象のログファイルのパス。(拡張子が.jsonlならEpochLoggerのjsonl_pathの出力)"
+    )
     parser.add_argument("item", default=None, nargs="?", help="項目名。省略時は指定可能な項目名が表示される。")
     g = parser.add_mutually_exclusive_group(required=False)
     g.add_argument(
@@ -38,9 +41,11 @@ def main():
     g.add_argument("--save", action="store_true", help="結果をカレントディレクトリに画像ファイルとして出力する。")
     args = parser.parse_args()
 
-    df_list = _parse_log(
-        args.logfile.read_text(encoding="utf-8", errors="surrogateescape")
-    )
+    log_text = args.logfile.read_text(encoding="utf-8", errors="surrogateescape")
+    if args.logfile.suffix == ".jsonl":
+        df_list = _parse_jsonl(log_text)
+    else:
+        df_list = _parse_log(log_text)
     if args.item is None:
         logger.info(f"{args.logfile} items:")
         for col, _ in df_list:
@@ -123,6 +128,33 @@ def _parse_log(log_text: str):
         if len(data_row) > 0:
             data_rows.append(data_row)
 
+    return _to_df_list(keys, data_rows)
+
+
+def _parse_jsonl(log_text: str):
+    """tk.callbacks.EpochLoggerのjsonl_pathの出力から数値の項目をDataFrameに入れて返す。結果は(列名, DataFrame)の配列。"""
+    keys: typing.List[str] = []
+    data_rows = []
+    for line in log_text.split("\n"):
+        if line.strip() == "":
+            continue
+        record = json.loads(line)
+        data_row = {
+            key: float(value)
+            for key, value in record.items()
+            if key != "epoch"
+            and isinstance(value, (int, float))
+            and not isinstance(value, bool)
+        }
+        for key in data_row:
+            if key not in keys:
+                keys.append(key)
+        data_rows.append(data_row)
+    return _to_df_list(keys, data_rows)
+
+
+def _to_df_list(keys: typing.List[str], data_rows: typing.List[typing.Dict[str, float]]):
+    """epochごとの値のリストを(列名, DataFrame)の配列にする。"""
     if len(data_rows) == 0:
         return []
 
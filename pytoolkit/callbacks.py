@@ -1,5 +1,7 @@
 """DeepLearning(主にKeras)関連。"""
+import json
 import pathlib
+import sys
 import time
 import typing
 
@@ -98,13 +100,44 @@ class CosineAnnealing(tf.keras.callbacks.Callback):
 
 
 class EpochLogger(tf.keras.callbacks.Callback):
-    """DEBUGログを色々出力するcallback。Horovod使用時はrank() == 0のみ有効。"""
+    """DEBUGログを色々出力するcallback。Horovod使用時はrank() == 0のみ有効。
 
-    def __init__(self, enabled=None):
+    lrやメトリクスに加え、スループット(steps/sec, samples/sec)、
+    train stepの処理時間とstep間のオーバーヘッド(他のcallbackなどの時間)、プロセスのピークRSSを出力する。
+    (バッチごとには時刻を記録するだけで、ログ出力はepochごと)
+    data_loadersを指定した場合はそのPipelineStatsも出力する。
+    (先頭(訓練データ)のstarvationを入力待ちの指標としてinput_starvationとして出力する)
+
+    step_timeはtrain_functionの呼び出し時間で、TF 2.xではデータの取り出し(入力待ち)も
+    train_functionの中で行われるため、入力待ちの時間を含む。
+    (callbackからは入力待ちと計算時間を区別できない)
+    入力待ちを切り分けるにはDataLoader(collect_stats=True)とし、data_loadersを指定して
+    input_starvationやPipelineStatsを見る必要がある。
+    (tk.models.fitではdata_loadersは自動設定されるので、collect_stats=Trueだけでよい)
+
+    Args:
+        enabled: 有効にするか否か。Noneならtk.hvd.is_master()。
+        jsonl_path: 指定した場合、epochごとの値をJSON Lines形式で追記する。(plotlog.pyで描画可能)
+        batch_size: samples/secの計算に使うバッチサイズ。(tk.models.fitでは自動設定)
+        data_loaders: 統計を出力するDataLoaderのリスト。先頭は訓練データのもの。(tk.models.fitでは自動設定)
+                      (統計はDataLoader(collect_stats=True)の場合のみ記録される)
+
+    """
+
+    def __init__(
+        self, enabled=None, jsonl_path=None, batch_size=None, data_loaders=None
+    ):
         super().__init__()
         self.enabled = enabled if enabled is not None else tk.hvd.is_master()
+        self.jsonl_path = pathlib.Path(jsonl_path) if jsonl_path is not None else None
+        self.batch_size = batch_size
+        self.data_loaders = data_loaders
         self.train_start_time = None
         self.epoch_start_time = None
+        self.batch_begin_times: typing.List[float] = []
+        self.batch_end_times: typing.List[float] = []
+        # バッチごとのlogsをNumPyに変換させない
+        self._supports_tf_logs = True
 
     def on_train_begin(self, logs=None):
         del logs
@@ -113,10 +146,28 @@ class EpochLogger(tf.keras.callbacks.Callback):
     def on_epoch_begin(self, epoch, logs=None):
         del epoch, logs
         self.epoch_start_time = time.time()
+        self.batch_begin_times = []
+        self.batch_end_times = []
+        if self.data_loaders:
+            tk.data.collect_stats(reset=True, data_loaders=self.data_loaders)
+
+    def on_train_batch_begin(self, batch, logs=None):
+        del batch, logs
+        self.batch_begin_times.append(time.perf_counter())
+
+    def on_train_batch_end(self, batch, logs=None):
+        del batch, logs
+        self.batch_end_times.append(time.perf_counter())
 
     def on_epoch_end(self, epoch, logs=None):
         assert self.train_start_time is not None
         assert self.epoch_start_time is not None
+        # スカラーでない値や数値でない値は無視する
+        logs = {
+            k: v
+            for k, v in ((k, _to_float(v)) for k, v in (logs or {}).items())
+            if v is not None
+        }
         if isinstance(
             self.model.optimizer.learning_rate,
             tf.keras.optimizers.schedules.LearningRateSchedule,
@@ -137,10 +188,104 @@ class EpochLogger(tf.keras.callbacks.Callback):
         metrics = " ".join(
             [f"{k}={logs.get(k):.4f}" for k in metrics_names if k in logs]
         )
+        throughput = self._get_throughput()
+        # DataLoaderの処理段階ごとの統計 (starvationが高いならデータの読み込みがボトルネック)
+        # (他のfitなどで使用中のDataLoaderの統計は消さないよう、このfitの分だけを対象にする)
+        pipeline_stats: typing.List[tk.data.PipelineStats] = []
+        if self.data_loaders:
+            train_stats = self.data_loaders[0].stats.snapshot()
+            if train_stats["steps"] > 0:
+                throughput["input_starvation"] = train_stats["starvation"]
+            pipeline_stats = tk.data.collect_stats(
+                reset=True, data_loaders=self.data_loaders
+            )
         if self.enabled:
-            tk.log.get(__name__).debug(
+            logger = tk.log.get(__name__)
+            logger.debug(
                 f"Epoch {epoch + 1:3d}: lr={lr:.1e} {metrics} time={int(np.ceil(elapsed_time))} ETA={int(np.ceil(eta))}"
             )
+            logger.debug(
+                f"Epoch {epoch + 1:3d}: steps/sec={throughput['steps_per_sec']:.2f}"
+                + (
+                    f" samples/sec={throughput['samples_per_sec']:.1f}"
+                    if throughput["samples_per_sec"] is not None
+                    else ""
+                )
+                + f" step_time={throughput['step_time']:.1f}s overhead_time={throughput['overhead_time']:.1f}s"
+                + (
+                    f" input_starvation={throughput['input_starvation']:.1%}"
+                    if "input_starvation" in throughput
+                    else ""
+                )
+                + (
+                    f" peak_rss={throughput['peak_rss_mb']:.0f}MB"
+                    if throughput["peak_rss_mb"] is not None
+                    else ""
+                )
+            )
+            for stats in pipeline_stats:
+                logger.debug(f"Epoch {epoch + 1:3d}: {stats.format()}")
+            if self.jsonl_path is not None:
+                record = {
+                    "epoch": epoch + 1,
+                    "lr": float(lr),
+                    **{
+                        k: float(v)
+                        for k, v in logs.items()
+                        if isinstance(v, (int, float, np.number))
+                    },
+                    "time": elapsed_time,
+                    "eta": eta,
+                    **throughput,
+                    "pipeline": {
+                        stats.name: stats.snapshot() for stats in pipeline_stats
+                    },
+                }
+                self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+                with self.jsonl_path.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+
+    def _get_throughput(self) -> typing.Dict[str, typing.Any]:
+        """バッチごとの時刻からスループットなどを算出する。"""
+        begin = np.array(self.batch_begin_times)
+        end = np.array(self.batch_end_times[: len(begin)])
+        begin = begin[: len(end)]
+        steps = len(end)
+        # 最初のstepの開始から最後のstepの終了まで (validationなどは含まない)
+        train_time = float(end[-1] - begin[0]) if steps > 0 else 0.0
+        # train stepの中の時間 (TF 2.3ではデータの取り出しもtrain_functionの中)
+        step_time = float(np.sum(end - begin))
+        samples = steps * self.batch_size if self.batch_size else None
+        return {
+            "steps": steps,
+            "steps_per_sec": steps / train_time if train_time > 0 else 0.0,
+            "samples_per_sec": samples / train_time
+            if samples is not None and train_time > 0
+            else None,
+            "step_time": step_time,
+            # step間の時間 (他のcallbackやPythonの処理など。入力待ちはstep_timeの側に含まれる)
+            "overhead_time": max(train_time - step_time, 0.0),
+            "peak_rss_mb": _get_peak_rss_mb(),
+        }
+
+
+def _to_float(value) -> typing.Optional[float]:
+    """logsの値をfloatにする。(変換できなければNone)"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_peak_rss_mb() -> typing.Optional[float]:
+    """プロセスのピークRSS(MB)を返す。取得できない環境ではNone。"""
+    try:
+        import resource
+    except ImportError:  # Windowsなど
+        return None
+    # Linuxではキロバイト単位 (macOSではバイト単位)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
 
 
 class Checkpoint(tf.keras.callbacks.Callback):
@@ -151,13 +296,16 @@ class Checkpoint(tf.keras.callbacks.Callback):
     Args:
         checkpoint_path: 保存先パス
         checkpoints: 保存する回数。epochs % (checkpoints + 1) == 0だとキリのいい感じになる。
+        async_write: 書き込みをバックグラウンドで行うならTrue。(HDF5形式のみ。tk.models.save参照)
+                     学習の停止時間は重みのコピーの分だけになる。
 
     """
 
-    def __init__(self, checkpoint_path, checkpoints=3):
+    def __init__(self, checkpoint_path, checkpoints=3, async_write=False):
         super().__init__()
         self.checkpoint_path = pathlib.Path(checkpoint_path)
         self.checkpoints = checkpoints
+        self.async_write = async_write
         self.target_epochs = set()
 
     def on_train_begin(self, logs=None):
@@ -172,25 +320,132 @@ class Checkpoint(tf.keras.callbacks.Callback):
                 tk.log.get(__name__).info(
                     f"Epoch {epoch}: Saving model to {self.checkpoint_path}"
                 )
-                self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
-                self.model.save(str(self.checkpoint_path))
+                if not self.async_write:
+                    self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+                    self.model.save(str(self.checkpoint_path))
+            if self.async_write:
+                tk.models.save(self.model, self.checkpoint_path, async_write=True)
+            else:
+                tk.hvd.barrier()
+
+    def on_train_end(self, logs=None):
+        del logs
+        if self.async_write:
+            # 学習終了時には書き込みを完了させておく
+            if tk.hvd.is_master():
+                tk.models.wait_for_save()
             tk.hvd.barrier()
 
 
 class ErrorOnNaN(tf.keras.callbacks.Callback):
-    """NaNやinfで異常終了させる。"""
+    """NaNやinfで異常終了させる。
+
+    lossが有限かどうかはtrain_stepの中(グラフ内)で調べて変数に記録しておき、
+    check_freqステップごとまたはepoch終了時にだけ読み出す。
+    (バッチごとにlogsを読み出すと非同期実行の妨げになるため)
 
-    def __init__(self, save_path=None):
+    Args:
+        save_path: 重みにinf/nanが含まれていた場合の調査用の保存先
+        check_freq: 何ステップごとに確認するか
+        keys: 確認するlogsのキー。(バッチによってはNaNになりうるメトリクスもあるので既定はlossのみ)
+
+    """
+
+    def __init__(self, save_path=None, check_freq=100, keys=("loss",)):
         super().__init__()
         self.save_path = pathlib.Path(save_path or "___broken___.h5")
+        self.check_freq = check_freq
+        self.keys = keys
+        self.nonfinite_count: typing.Optional[tf.Variable] = None
+        self.steps_since_check = 0
+        self.last_batch = -1
+        # logsをNumPyに変換させない
+        self._supports_tf_logs = True
+
+    def set_model(self, model):
+        super().set_model(model)
+        if getattr(model, "_tk_error_on_nan", None) is self:
+            return
+        # fit()はcallbacksの作成後にtrain_functionを作るので、ここでtrain_stepを差し替える
+        with model.distribute_strategy.scope():
+            nonfinite_count = tf.Variable(
+                0.0,
+                trainable=False,
+                synchronization=tf.VariableSynchronization.ON_READ,
+                aggregation=tf.VariableAggregation.SUM,
+            )
+        train_step = type(model).train_step.__get__(model)
+
+        def train_step_with_check(data):
+            logs = train_step(data)
+            values = [
+                logs[k]
+                for k in self.keys
+                if k in logs
+                and isinstance(logs[k], tf.Tensor)
+                and logs[k].dtype.is_floating
+            ]
+            if len(values) > 0:
+                nonfinite = tf.reduce_sum(
+                    [
+                        tf.reduce_sum(tf.cast(~tf.math.is_finite(v), tf.float32))
+                        for v in values
+                    ]
+                )
+                nonfinite_count.assign_add(nonfinite)
+            return logs
+
+        self.nonfinite_count = nonfinite_count
+        model.train_step = train_step_with_check
+        model.train_function = None
+        model._tk_error_on_nan = self  # pylint: disable=protected-access
+
+    def on_train_begin(self, logs=None):
+        del logs
+        if self.nonfinite_count is not None:
+            self.nonfinite_count.assign(0.0)
+        self.steps_since_check = 0
+        self.last_batch = -1
 
-    def on_batch_end(self, batch, logs=None):
-        logs = logs or {}
-        loss = logs.get("loss")
-        if loss is not None and (np.isnan(loss) or np.isinf(loss)):
+    def on_train_batch_end(self, batch, logs=None):
+        del logs
+        # steps_per_execution > 1の場合は実行単位の最後のbatchしか来ないので、前回との差分で数える
+        # (batchが戻ったら新しいepoch)
+        self.steps_since_check += (
+            batch - self.last_batch if batch > self.last_batch else batch + 1
+        )
+        self.last_batch = batch
+        if self.steps_since_check >= self.check_freq:
+            self.steps_since_check = 0
+            self._check_flag(f"Batch {batch}")
+
+    def on_epoch_end(self, epoch, logs=None):
+        del logs
+        self._check_flag(f"Epoch {epoch + 1}")
+
+    def on_train_end(self, logs=None):
+        del logs
+        self._restore_model()
+
+    def _restore_model(self):
+        """train_stepを元に戻す。"""
+        if getattr(self.model, "_tk_error_on_nan", None) is self:
+            del self.model.train_step
+            del self.model._tk_error_on_nan  # pylint: disable=protected-access
+            self.model.train_function = None
+
+    def _check_flag(self, desc):
+        """グラフ内で記録したinf/nanの数を確認し、あればエラーにする。"""
+        if self.nonfinite_count is None:
+            return
+        count = int(self.nonfinite_count.numpy())
+        if count > 0:
+            self._restore_model()
             self._check_model()
             # エラーを飛ばす
-            raise RuntimeError(f"Batch {batch}: Invalid loss ({logs=})")
+            raise RuntimeError(
+                f"{desc}: Invalid loss or metrics ({count} non-finite values)"
+            )
 
     def _check_model(self):
         """モデルの中に怪しい値が無いか調べる"""
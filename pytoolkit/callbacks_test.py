@@ -1,3 +1,4 @@
+import json
 import pathlib
 
 import numpy as np
@@ -15,9 +16,102 @@ def test_ErrorOnNaN(tmpdir):
     model.weights[0].assign(np.array([0.5, 1.5, np.inf]))
 
     save_path = str(tmpdir / "___broken___.h5")
-    cb = tk.callbacks.ErrorOnNaN(save_path=save_path)
-    cb.model = model
+    cb = tk.callbacks.ErrorOnNaN(save_path=save_path, check_freq=4)
+    cb.set_model(model)
+    cb.on_train_batch_end(3)  # 記録が無ければ何もしない
+    cb.nonfinite_count.assign(1.0)
+    cb.on_train_batch_end(0)  # check_freqごとにしか確認しない
     with pytest.raises(RuntimeError):
-        cb.on_batch_end(3, logs={"loss": np.nan})
+        cb.on_train_batch_end(3)
 
     assert pathlib.Path(save_path).exists()
+
+    # steps_per_execution > 1でbatchが飛び飛びでもcheck_freqステップごとに確認する
+    cb = tk.callbacks.ErrorOnNaN(save_path=save_path, check_freq=3)
+    cb.set_model(model)
+    cb.on_train_begin()
+    cb.nonfinite_count.assign(1.0)
+    cb.on_train_batch_end(1)
+    with pytest.raises(RuntimeError):
+        cb.on_train_batch_end(3)
+
+
+def test_ErrorOnNaN_fit():
+    inputs = x = tf.keras.layers.Input((2,))
+    x = tf.keras.layers.Dense(1)(x)
+    model = tf.keras.models.Model(inputs, x)
+    model.compile("sgd", "mse")
+    X = np.zeros((8, 2))
+    y = np.zeros((8, 1))
+
+    cb = tk.callbacks.ErrorOnNaN(check_freq=2)
+    model.fit(X, y, batch_size=2, epochs=1, verbose=0, callbacks=[cb])
+    # lossが有限ならメトリクスがNaNでも止めない
+    model.compile("sgd", "mse", metrics=[lambda y_true, y_pred: y_pred / 0.0 * 0.0])
+    model.fit(X, y, batch_size=2, epochs=1, verbose=0, callbacks=[cb])
+    model.compile("sgd", "mse")
+    y[5] = np.nan
+    with pytest.raises(RuntimeError):
+        model.fit(X, y, batch_size=2, epochs=1, verbose=0, callbacks=[cb])
+
+
+def test_EpochLogger(tmpdir):
+    inputs = x = tf.keras.layers.Input((2,))
+    x = tf.keras.layers.Dense(1)(x)
+    model = tf.keras.models.Model(inputs, x)
+    model.compile("sgd", "mse")
+
+    jsonl_path = pathlib.Path(str(tmpdir / "log.jsonl"))
+    cb = tk.callbacks.EpochLogger(jsonl_path=jsonl_path, batch_size=2)
+    model.fit(
+        np.zeros((8, 2)),
+        np.zeros((8, 1)),
+        batch_size=2,
+        epochs=2,
+        verbose=0,
+        callbacks=[cb],
+    )
+    records = [json.loads(line) for line in jsonl_path.read_text().splitlines()]
+    assert [r["epoch"] for r in records] == [1, 2]
+    assert records[0]["steps"] == 4
+    assert records[0]["samples_per_sec"] > 0
+    assert "loss" in records[0]
+
+    # スカラーでない値や数値でない値は無視する
+    cb.on_epoch_begin(1)
+    cb.on_epoch_end(1, {"loss": 1.0, "cm": np.zeros((2, 2)), "name": "abc"})
+    record = json.loads(jsonl_path.read_text().splitlines()[-1])
+    assert record["loss"] == 1.0
+    assert "cm" not in record and "name" not in record
+
+
+def test_EpochLogger_pipeline_stats(tmpdir):
+    inputs = x = tf.keras.layers.Input((2,))
+    x = tf.keras.layers.Dense(1)(x)
+    model = tf.keras.models.Model(inputs, x)
+    model.compile("sgd", "mse")
+
+    dataset = tk.data.Dataset(data=np.zeros((8, 2)), labels=np.zeros((8, 1)))
+    data_loader = tk.data.DataLoader(batch_size=2, collect_stats=True)
+    other_loader = tk.data.DataLoader(batch_size=2, collect_stats=True)
+    other_loader.stats.add("get_data", 1.0)
+    ds, steps = data_loader.get_ds(dataset, shuffle=True)
+
+    jsonl_path = pathlib.Path(str(tmpdir / "log.jsonl"))
+    model.fit(
+        ds,
+        steps_per_epoch=steps,
+        epochs=1,
+        verbose=0,
+        callbacks=[
+            tk.callbacks.EpochLogger(
+                jsonl_path=jsonl_path, batch_size=2, data_loaders=[data_loader]
+            )
+        ],
+    )
+    record = json.loads(jsonl_path.read_text())
+    assert "overhead_time" in record
+    assert 0 <= record["input_starvation"] <= 1
+    assert record["pipeline"]["DataLoader"]["steps"] >= steps
+    # 他のDataLoaderの統計は消さない
+    assert other_loader.stats.snapshot()["stages"]["get_data"]["count"] == 1
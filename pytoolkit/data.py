@@ -8,9 +8,24 @@ batch: sampleのバッチサイズ個の集合
 """
 from __future__ import annotations
 
+import collections
+import contextlib
 import dataclasses
+import hashlib
+import io
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import os
+import pathlib
+import pickle
 import random
+import tempfile
+import threading
+import time
 import typing
+import weakref
 
 import numpy as np
 import pandas as pd
@@ -24,6 +39,10 @@ DataType = typing.Union[typing.Sequence[typing.Any], pd.DataFrame, dict]
 LabelsType = typing.Union[
     np.ndarray, typing.List[np.ndarray], typing.Dict[str, np.ndarray]
 ]
+# DataLoader.sample_graph_fn/batch_graph_fnの型 (X, y, seed) -> (X, y)
+GraphFn = typing.Callable[
+    [typing.Any, typing.Any, tf.Tensor], typing.Tuple[typing.Any, typing.Any]
+]
 
 
 @dataclasses.dataclass()
@@ -43,6 +62,11 @@ class Dataset:
     get_dataをオーバーライドすることで逐次読み込みなども可能とする。
     (ただし、sliceとかで__init__が呼ばれるので注意。)
 
+    注意: dataやlabelsがDataFrameの場合、get_data/get_batchはdtypeごとの行優先の配列を
+    キャッシュして使う。data/labelsへの代入や、行数・列の増減(列名の変更)は自動的に検出して
+    作り直すが、値の書き換え(df.loc[...] = ...など)や既存の列のdtypeの変更は検出できないため、
+    その場合は必ずinvalidate_cache()を呼び出すこと。(呼ばないと古い値が返る)
+
     """
 
     data: DataType
@@ -63,8 +87,23 @@ class Dataset:
             return self.data[index], None
         return self._get(self.data, index), self._get(self.labels, index)
 
-    def _get(self, data, index: int):
-        """指定indexのデータ/ラベルを返す。"""
+    def get_batch(self, indices: np.ndarray) -> typing.Tuple[typing.Any, typing.Any]:
+        """複数件のdataとlabelをまとめて返す。
+
+        Args:
+            indices: インデックスの配列
+
+        Returns:
+            dataとlabelのバッチ。labelsがNoneの場合はlabelもNone。
+
+        """
+        indices = np.asarray(indices)
+        if self.labels is None:
+            return self._get(self.data, indices), None
+        return self._get(self.data, indices), self._get(self.labels, indices)
+
+    def _get(self, data, index: typing.Union[int, np.ndarray]):
+        """指定indexのデータ/ラベルを返す。(indexはインデックスの配列でも可)"""
         if isinstance(data, dict):
             # multiple input/output
             return {k: v[index] for k, v in data.items()}
@@ -73,19 +112,61 @@ class Dataset:
             return [v[index] for v in data]
         elif isinstance(data, pd.DataFrame):
             assert len(data) == len(self)
-            return data.values[index]
+            return self._get_frame_rows(data)[index]
         else:
             assert len(data) == len(self)
             return data[index]
 
+    def _get_frame_rows(self, data: pd.DataFrame) -> _FrameRows:
+        """DataFrameの行アクセス用のキャッシュを返す。(無ければ作る)"""
+        cache = self.__dict__.setdefault("_frame_rows_cache", {})
+        rows = cache.get(id(data))
+        if rows is None or not rows.is_valid_for(data):
+            rows = _FrameRows(data)
+            cache[id(data)] = rows
+        return rows
+
+    def invalidate_cache(self) -> None:
+        """DataFrameの行アクセス用のキャッシュを破棄する。
+
+        data/labelsへの代入時は自動的に破棄されるが、
+        DataFrameの中身を直接書き換えた場合はこれを呼び出す必要がある。
+
+        """
+        self.__dict__.pop("_frame_rows_cache", None)
+
+    def __setattr__(self, name: str, value) -> None:
+        if name in ("data", "labels"):
+            self.invalidate_cache()
+        super().__setattr__(name, value)
+
     def iter(
-        self, folds: tk.validation.FoldsType
+        self, folds: tk.validation.FoldsType, view: bool = False
     ) -> typing.Generator[typing.Tuple[Dataset, Dataset], None, None]:
-        """foldsに従って分割する。"""
+        """foldsに従って分割する。
+
+        Args:
+            folds: CVのindex
+            view: Trueならコピーせず、DatasetViewを返す。
+
+        """
         for train_indices, val_indices in folds:
-            train_set = self.slice(train_indices)
-            val_set = self.slice(val_indices)
-            yield train_set, val_set
+            if view:
+                yield self.view(train_indices), self.view(val_indices)
+            else:
+                yield self.slice(train_indices), self.slice(val_indices)
+
+    def view(self, rindex: typing.Sequence[int]) -> DatasetView:
+        """コピーせずに一部を参照するDatasetViewを作成して返す。
+
+        Args:
+            rindex: インデックスの配列 (またはboolのマスク)
+
+        Returns:
+            DatasetView
+
+        """
+        return DatasetView(self, rindex)
 
     def slice(self, rindex: typing.Sequence[int]) -> Dataset:
         """スライスを作成して返す。
@@ -108,13 +189,18 @@ class Dataset:
             metadata=self.metadata.copy(),
         )
 
-    def copy(self) -> Dataset:
+    def copy(self, deep: bool = True) -> Dataset:
         """コピーを作成して返す。
 
+        Args:
+            deep: Falseなら各値はコピーせずに共有する。(属性の再代入だけをする場合用)
+
         Returns:
             コピー
 
         """
+        if not deep:
+            return dataclasses.replace(self, metadata=self.metadata.copy())
         return self.__class__(
             data=self.__class__.copy_field(self.data),
             labels=self.__class__.copy_field(self.labels),
@@ -161,7 +247,7 @@ class Dataset:
             return None
         elif isinstance(d, dict):
             return {k: cls.copy_field(v) for k, v in d.items()}
-        assert isinstance(d, (list, np.ndarray, pd.Series, pd.DataFrame))
+        assert isinstance(d, (list, np.ndarray, pd.Series, pd.DataFrame, RecordArray))
         return d.copy()
 
     @classmethod
@@ -186,6 +272,208 @@ class Dataset:
         return np.concatenate([a, b], axis=0)
 
 
+class DatasetView(Dataset):
+    """Datasetの一部を参照するビュー。
+
+    親のDatasetとインデックスの配列だけを持ち、dataなどの値は初回のアクセス時に作成してキャッシュする。
+    (get_data/get_batchは親に委譲するので、行単位やバッチ単位でのアクセスならコピーは最小限になる)
+    親の属性を差し替えた場合はキャッシュも作り直すが、
+    親の配列などの中身を直接書き換えた場合はinvalidate_cacheを呼び出す必要がある。
+
+    dataなどの属性に代入した場合は、その値をビュー側で保持する。
+
+    Args:
+        parent: 親のDataset
+        indices: インデックスの配列 (またはboolのマスク)
+
+    """
+
+    def __init__(  # pylint: disable=super-init-not-called
+        self, parent: Dataset, indices: typing.Union[typing.Sequence[int], np.ndarray]
+    ):
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.where(indices)[0]
+        if isinstance(parent, DatasetView) and len(parent.overrides) == 0:
+            # ビューのビューは親を直接参照する
+            indices = parent.indices[indices]
+            parent = parent.parent
+        self.parent = parent
+        self.indices = indices
+        self.overrides: typing.Dict[str, typing.Any] = {}
+        self.metadata = parent.metadata.copy()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(parent={self.parent!r}, indices={self.indices!r})"
+
+    def __len__(self) -> int:
+        """データ件数を返す。"""
+        return len(self.indices)
+
+    def _get_field(self, name: str):
+        if name in self.overrides:
+            return self.overrides[name]
+        # 親の値ごとにスライスした結果をキャッシュする (親の値をisで比較する)
+        source = getattr(self.parent, name)
+        cache = self.__dict__.setdefault("_field_cache", {})
+        cached = cache.get(name)
+        if cached is None or cached[0] is not source:
+            cached = (source, Dataset.slice_field(source, self.indices))
+            cache[name] = cached
+        return cached[1]
+
+    def invalidate_cache(self) -> None:
+        """dataなどのスライスのキャッシュとDataFrameの行アクセス用のキャッシュを破棄する。"""
+        super().invalidate_cache()
+        self.__dict__.pop("_field_cache", None)
+
+    def _set_field(self, name: str, value) -> None:
+        if name in ("data", "labels"):
+            # get_dataで親に委譲できなくなるので、data/labelsは両方ビュー側で持つ
+            for k in ("data", "labels"):
+                if k not in self.overrides:
+                    self.overrides[k] = self._get_field(k)
+        self.overrides[name] = value
+
+    data = property(  # type: ignore[assignment]
+        lambda self: self._get_field("data"),
+        lambda self, value: self._set_field("data", value),
+    )
+    labels = property(  # type: ignore[assignment]
+        lambda self: self._get_field("labels"),
+        lambda self, value: self._set_field("labels", value),
+    )
+    groups = property(  # type: ignore[assignment]
+        lambda self: self._get_field("groups"),
+        lambda self, value: self._set_field("groups", value),
+    )
+    weights = property(  # type: ignore[assignment]
+        lambda self: self._get_field("weights"),
+        lambda self, value: self._set_field("weights", value),
+    )
+    ids = property(  # type: ignore[assignment]
+        lambda self: self._get_field("ids"),
+        lambda self, value: self._set_field("ids", value),
+    )
+    init_score = property(  # type: ignore[assignment]
+        lambda self: self._get_field("init_score"),
+        lambda self, value: self._set_field("init_score", value),
+    )
+
+    def get_data(self, index: int) -> typing.Tuple[typing.Any, typing.Any]:
+        """dataとlabelを返す。"""
+        if "data" in self.overrides:
+            return super().get_data(index)
+        return self.parent.get_data(self.indices[index])
+
+    def get_batch(self, indices: np.ndarray) -> typing.Tuple[typing.Any, typing.Any]:
+        """複数件のdataとlabelをまとめて返す。"""
+        if "data" in self.overrides:
+            return super().get_batch(indices)
+        return self.parent.get_batch(self.indices[np.asarray(indices)])
+
+    def iter_batches(
+        self, batch_size: int
+    ) -> typing.Generator[Dataset, None, None]:
+        """batch_size件ずつ実体化したDatasetを返す。"""
+        for offset in range(0, len(self), batch_size):
+            yield self.slice(np.arange(offset, min(offset + batch_size, len(self))))
+
+    def slice(self, rindex: typing.Sequence[int]) -> Dataset:
+        """スライスを作成して返す。(実体化する)"""
+        if len(self.overrides) > 0:
+            return self.materialize().slice(rindex)
+        return self.parent.slice(self.indices[np.asarray(rindex)])
+
+    def view(self, rindex: typing.Sequence[int]) -> DatasetView:
+        """コピーせずに一部を参照するDatasetViewを作成して返す。"""
+        return DatasetView(self, rindex)
+
+    def copy(self, deep: bool = True) -> Dataset:
+        """コピーを作成して返す。deep=Falseならビューのまま返す。"""
+        if deep:
+            return self.materialize()
+        v = DatasetView(self.parent, self.indices)
+        v.overrides = self.overrides.copy()
+        v.metadata = self.metadata.copy()
+        return v
+
+    def materialize(self) -> Dataset:
+        """実体化したDatasetを返す。"""
+        return self.parent.__class__(
+            data=self.data,
+            labels=self.labels,
+            groups=self.groups,
+            weights=self.weights,
+            ids=self.ids,
+            init_score=self.init_score,
+            metadata=self.metadata.copy(),
+        )
+
+    def resolve(self, index: int) -> typing.Tuple[Dataset, int]:
+        """大元のDatasetとそこでのインデックスを返す。(data/labelsを代入済みの場合は自身)"""
+        if "data" in self.overrides:
+            return self, index
+        if isinstance(self.parent, DatasetView):
+            return self.parent.resolve(self.indices[index])
+        return self.parent, self.indices[index]
+
+
+class _FrameRows:
+    """DataFrameを行単位で高速に取り出すための、dtypeごとのブロック表現。
+
+    DataFrame.valuesは混在したdtypeの場合に毎回全体のobject配列を作ってしまうので、
+    dtypeごとに行優先(C-contiguous)のndarrayを1回だけ作っておき、
+    行の取り出し時は該当行だけを.valuesと同じdtypeの配列に詰めて返す。
+
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame
+        self.shape = frame.shape
+        self.columns = frame.columns
+        self.dtype = frame.iloc[:1].values.dtype
+        self.num_columns = frame.shape[1]
+        self.blocks: typing.List[typing.Tuple[np.ndarray, np.ndarray]] = []
+        dtypes = list(frame.dtypes)
+        for dtype in dict.fromkeys(dtypes):
+            positions = np.array([i for i, d in enumerate(dtypes) if d == dtype])
+            block_frame = frame.iloc[:, positions]
+            if self.dtype == object and not _is_numpy_numeric(dtype):
+                # categoryやdatetimeなどは.valuesと同じくobjectにしておく
+                block = block_frame.to_numpy(dtype=object)
+            else:
+                block = block_frame.to_numpy()
+            self.blocks.append((positions, np.ascontiguousarray(block)))
+
+    def is_valid_for(self, frame: pd.DataFrame) -> bool:
+        """frameに対して使えるか否か(作成後に行数や列が変わっていないか)を返す。
+
+        dtypesの比較はDataFrame.dtypesの作成が行の取り出しより遅いので行わない。
+        (値やdtypeの変更はDataset.invalidate_cacheで破棄する)
+
+        """
+        return (
+            self.frame is frame
+            and self.shape == frame.shape
+            and self.columns is frame.columns
+        )
+
+    def __getitem__(self, index: typing.Union[int, np.ndarray]) -> np.ndarray:
+        if len(self.blocks) == 1 and self.blocks[0][1].dtype == self.dtype:
+            return self.blocks[0][1][index]
+        index = np.asarray(index)
+        out = np.empty(index.shape + (self.num_columns,), dtype=self.dtype)
+        for positions, block in self.blocks:
+            out[..., positions] = block[index]
+        return out
+
+
+def _is_numpy_numeric(dtype) -> bool:
+    """numpyの数値型(bool含む)か否かを返す。"""
+    return isinstance(dtype, np.dtype) and dtype.kind in "biuf"
+
+
 def split(dataset: Dataset, count: int, shuffle=False):
     """Datasetを指定個数に分割する。"""
     dataset_size = len(dataset)
@@ -200,6 +488,305 @@ def split(dataset: Dataset, count: int, shuffle=False):
     ]
 
 
+class Sampler:
+    """DataLoader.get_ds(shuffle=True)で1epoch分のインデックスを作るクラス。
+
+    既定の実装は一様なランダム順列。(tf.data.Dataset.shuffleのバッファを使わない)
+
+    """
+
+    def get_size(self, dataset: Dataset) -> int:
+        """1epochあたりのサンプル数を返す。"""
+        return len(dataset)
+
+    def sample(self, dataset: Dataset) -> np.ndarray:
+        """1epoch分のインデックスの配列を返す。"""
+        return np.random.permutation(len(dataset))
+
+
+class WeightedSampler(Sampler):
+    """重みに比例した確率で復元抽出するSampler。
+
+    重みはDataset.weightsを使う。(Noneなら一様)
+    alias methodにより1件あたりO(1)で抽出する。
+
+    Args:
+        num_samples: 1epochあたりのサンプル数。Noneならlen(dataset)。
+
+    """
+
+    def __init__(self, num_samples: int = None):
+        self.num_samples = num_samples
+        self._table_weights: typing.Optional[np.ndarray] = None
+        self._table: typing.Optional[AliasTable] = None
+
+    def get_size(self, dataset: Dataset) -> int:
+        return self.num_samples or len(dataset)
+
+    def get_weights(self, dataset: Dataset) -> typing.Optional[np.ndarray]:
+        """サンプルごとの重みを返す。"""
+        return dataset.weights
+
+    def sample(self, dataset: Dataset) -> np.ndarray:
+        weights = self.get_weights(dataset)
+        if weights is None:
+            return np.random.randint(len(dataset), size=self.get_size(dataset))
+        # 同じ重みの配列ならテーブルを使い回す
+        # (idだと解放後に別の配列と一致しうるので、参照を保持してisで比較する)
+        if self._table is None or self._table_weights is not weights:
+            self._table = AliasTable(weights)
+            self._table_weights = weights
+        return self._table.sample(self.get_size(dataset))
+
+
+class BalancedSampler(WeightedSampler):
+    """クラスごとの出現頻度が均等になるように復元抽出するSampler。
+
+    Dataset.labelsからクラスごとの件数を数え、件数の-power乗をサンプルの重みにする。
+    (少数クラスをデータセットを複製せずにオーバーサンプリングする)
+    labelsはクラスのインデックスの配列かone-hot表現を前提とする。
+    Dataset.weightsがあればそれも掛ける。
+
+    Args:
+        power: 1なら完全に均等、0なら一様 (WeightedSamplerと同じ)。
+        num_samples: 1epochあたりのサンプル数。Noneならlen(dataset)。
+
+    """
+
+    def __init__(self, power: float = 1.0, num_samples: int = None):
+        super().__init__(num_samples=num_samples)
+        self.power = power
+        self._weights_key: typing.Any = None
+        self._weights: typing.Optional[np.ndarray] = None
+
+    def get_weights(self, dataset: Dataset) -> typing.Optional[np.ndarray]:
+        labels, sample_weights = dataset.labels, dataset.weights
+        # 参照を保持してisで比較する (idだと別のfoldの配列と一致しうるため)
+        key = self._weights_key
+        if (
+            self._weights is None
+            or key[0] is not labels
+            or key[1] is not sample_weights
+            or key[2] != self.power
+        ):
+            assert isinstance(labels, np.ndarray), f"Invalid labels: {type(labels)}"
+            class_ids = labels.argmax(axis=-1) if labels.ndim > 1 else labels
+            _, inverse, counts = np.unique(
+                class_ids, return_inverse=True, return_counts=True
+            )
+            weights = counts[inverse].astype(np.float64) ** -self.power
+            if sample_weights is not None:
+                weights *= sample_weights
+            self._weights = weights
+            self._weights_key = (labels, sample_weights, self.power)
+        return self._weights
+
+
+class AliasTable:
+    """alias methodによる離散分布からのO(1)の抽出。(Vose's alias method)
+
+    Args:
+        weights: 各要素の重み。(非負で合計が正)
+
+    References:
+        - <https://www.keithschwarz.com/darts-dice-coins/>
+
+    """
+
+    def __init__(self, weights: np.ndarray):
+        weights = np.asarray(weights, dtype=np.float64)
+        assert weights.ndim == 1 and len(weights) > 0
+        assert (weights >= 0).all() and weights.sum() > 0, "Invalid weights"
+        n = len(weights)
+        scaled = weights * (n / weights.sum())
+        self.prob = np.ones((n,), dtype=np.float64)
+        self.alias = np.arange(n)
+        small = np.where(scaled < 1)[0]
+        large = np.where(scaled >= 1)[0]
+        if len(small) == 0 or len(large) == 0:
+            return  # 数値誤差の範囲で一様
+        # sweepingによる構築をcumsumとsearchsortedでベクトル化したもの。
+        # smallを先頭から順に、余剰の累積がそれまでの不足の累積を上回る最初のlargeで埋め、
+        # 余剰を使い切ったlargeは残りを自身の確率として次のlargeで埋める。
+        deficit = np.concatenate([[0.0], np.cumsum(1 - scaled[small])])
+        surplus = np.cumsum(scaled[large] - 1)
+        j = np.searchsorted(surplus, deficit[:-1], side="right")
+        self.prob[small] = scaled[small]
+        self.alias[small] = large[np.minimum(j, len(large) - 1)]
+        k = np.searchsorted(deficit[:-1], surplus, side="left")
+        prob_large = 1 + surplus - deficit[k]
+        self.prob[large[:-1]] = np.minimum(prob_large[:-1], 1)
+        self.alias[large[:-1]] = large[1:]
+        # 最後のlargeは数値誤差の範囲で1なのでprob=1のまま
+
+    def __len__(self) -> int:
+        return len(self.prob)
+
+    def sample(self, size: int) -> np.ndarray:
+        """size個抽出したインデックスの配列を返す。"""
+        columns = np.random.randint(len(self.prob), size=size)
+        accept = np.random.random_sample(size) < self.prob[columns]
+        return np.where(accept, columns, self.alias[columns])
+
+
+class PipelineStats:
+    """DataLoader.get_dsの処理段階ごとの処理時間などの統計。
+
+    各段階の処理時間の合計(wall time)と呼び出し回数に加え、
+    バッチを取り出した時点でキューに次のバッチ分のサンプルが無かった割合(starvation)を記録する。
+    (starvationが高いならデータの読み込みがボトルネック)
+
+    tk.data.collect_statsで全DataLoaderの分をまとめて取得できる。
+
+    Args:
+        name: 名前 (ログ用)
+        enabled: Falseなら何も記録しない。
+
+    """
+
+    def __init__(self, name: str, enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counts: typing.Dict[str, int] = collections.defaultdict(int)
+        self.times: typing.Dict[str, float] = collections.defaultdict(float)
+        self.batch_size = 0
+        self.produced = 0
+        self.consumed = 0
+        self.steps = 0
+        self.starved_steps = 0
+        _pipeline_stats.add(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """withで囲んだ部分の処理時間をstageの分として記録する。
+
+        DataLoaderを継承してget_data内のData Augmentationなどを個別に計測したい場合にも使える。
+
+        """
+        if not self.enabled:
+            yield
+            return
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    def add(self, stage: str, elapsed: float, count: int = 1) -> None:
+        """処理時間を記録する。"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counts[stage] += count
+            self.times[stage] += elapsed
+
+    def add_produced(self, num_samples: int) -> None:
+        """サンプルが作られたことを記録する。"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.produced += num_samples
+
+    def on_consume(self, num_samples) -> np.int64:
+        """バッチが取り出されたことを記録する。(tf.numpy_functionから呼ばれる)"""
+        num_samples = int(num_samples)
+        with self.lock:
+            self.consumed += num_samples
+            self.steps += 1
+            if self.produced - self.consumed < max(self.batch_size, 1):
+                self.starved_steps += 1
+        return np.int64(num_samples)
+
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        """現在の統計を返す。
+
+        Returns:
+            stages(段階ごとのcount, time, ms_per_call)、steps、starvationのdict
+
+        """
+        with self.lock:
+            return {
+                "stages": {
+                    stage: {
+                        "count": count,
+                        "time": self.times[stage],
+                        "ms_per_call": self.times[stage] * 1000 / max(count, 1),
+                    }
+                    for stage, count in self.counts.items()
+                },
+                "steps": self.steps,
+                "starvation": self.starved_steps / max(self.steps, 1),
+            }
+
+    def reset(self) -> None:
+        """統計をリセットする。(キューに残っているサンプル数は維持する)"""
+        with self.lock:
+            self.counts.clear()
+            self.times.clear()
+            self.produced -= self.consumed
+            self.consumed = 0
+            self.steps = 0
+            self.starved_steps = 0
+
+    def format(self) -> str:
+        """ログ用の文字列を返す。"""
+        snapshot = self.snapshot()
+        stages = " ".join(
+            f"{stage}={s['time']:.1f}s/{s['count']}({s['ms_per_call']:.1f}ms)"
+            for stage, s in snapshot["stages"].items()
+        )
+        return f"{self.name}: {stages} steps={snapshot['steps']} starvation={snapshot['starvation']:.1%}"
+
+
+_pipeline_stats: weakref.WeakSet = weakref.WeakSet()
+
+
+def collect_stats(
+    reset: bool = False, data_loaders: typing.Iterable[DataLoader] = None
+) -> typing.List[PipelineStats]:
+    """使用中の全DataLoaderのPipelineStatsのうち、記録があるものを返す。
+
+    Args:
+        reset: 返した後にリセットするか否か。(返す値には影響しない)
+        data_loaders: 指定した場合、これらのDataLoaderの分だけを対象にする。
+
+    Returns:
+        PipelineStatsのコピーのリスト
+
+    """
+    result = []
+    targets = (
+        list(_pipeline_stats)
+        if data_loaders is None
+        else list({id(dl.stats): dl.stats for dl in data_loaders}.values())
+    )
+    for stats in targets:
+        with stats.lock:
+            if stats.steps <= 0 and len(stats.counts) <= 0:
+                continue
+            copied = PipelineStats.__new__(PipelineStats)
+            copied.__setstate__(
+                {
+                    k: (v.copy() if isinstance(v, dict) else v)
+                    for k, v in stats.__getstate__().items()
+                }
+            )
+        result.append(copied)
+        if reset:
+            stats.reset()
+    return sorted(result, key=lambda s: s.name)
+
+
 class DataLoader:
     """データをモデルに渡す処理をするクラス。
 
@@ -209,7 +796,42 @@ class DataLoader:
         batch_size: バッチサイズ
         data_per_sample: sampleあたりのデータ数。mixupとかするなら2にする。
         parallel: self.get_dataの呼び出しを並列化するか否か。
+                  "process"ならワーカープロセスで並列化する。(GILの影響を受けない)
         num_replicas_in_sync: tf.distribute.Strategy.num_replicas_in_syncの値。
+        batch_mode: self.get_batchでバッチ単位に読み込むか否か。
+                    Noneなら自動判定。(get_batchがオーバーライドされている場合か、
+                    get_data/get_sampleが既定のままでデータがnumpy配列などの場合にTrue)
+        decode_cache: self.decodeの結果のキャッシュ。Noneならキャッシュしない。
+        num_workers: parallel="process"の場合のワーカープロセス数。Noneならos.cpu_count()。
+                     ワーカープロセスはforkserver(無ければspawn)で起動するため、
+                     DataLoader(のサブクラス)とDatasetはpickle可能である必要がある。
+                     ワーカープロセスは初回のget_dsで作られ、DataLoaderごとに使い回す。
+                     不要になったらclose()するかwith文で使う。
+        output_signature: 1サンプル分の(X, y)の型。tf.TensorSpecをtuple/list/dictで入れ子にしたもの。
+                          (yがNoneならラベル無し扱い)
+                          Noneなら先頭のデータを実際に読み込んで判定する。(shapeは不定になる)
+                          指定すると読み込みを省略でき、静的なshapeでグラフを作れる。
+        buckets: 画像サイズ(縦横比)でバケット分けしてバッチを作る場合の各バケットのサイズ((H, W)のリスト)。
+                 各サンプルは縦横比が最も近いバケットに割り当てられ、
+                 バッチ単位でバケットのサイズに揃えられる。(self.get_bucket_dataを参照)
+                 Noneならバケット分けしない。
+        sampler: shuffle=Trueの場合に1epoch分のインデックスを作るもの。
+                 Noneなら一様なランダム順列。(WeightedSampler, BalancedSamplerなど)
+        load_size: self.load_imageで画像を読み込む際の目安のサイズ (H, W)。
+                   JPEGならこのサイズを下回らない範囲で縮小しながらデコードする。(tk.ndimage.loadを参照)
+        sample_graph_fn: サンプル単位でtf.dataのグラフ内で行う処理。(tk.tfimageの変換など)
+                         fn(X, y, seed) -> (X, y)。seedは要素ごとのstatelessな乱数のseed。
+                         tf.numpy_functionを使わない処理ならGILの影響を受けずに並列に動く。
+                         without_label=Trueの場合(predict)は使わない。bucketsとは併用不可。
+                         seedの列はget_ds時にnp.randomから決めるので、np.random.seedで再現できる。
+                         サンプル単位で読み込む場合(get_data/get_sample)はバッチにする前に適用するので、
+                         サイズの異なる画像をここでリサイズしてもよい。
+                         バッチ単位で読み込む場合(batch_mode, parallel="process")は
+                         一旦unbatchして適用するため、読み込んだ時点で同じshapeである必要がある。
+        batch_graph_fn: バッチ単位でtf.dataのグラフ内で行う処理。(tk.tfimage.mixupなど)
+                        引数などはsample_graph_fnと同じ。
+        collect_stats: self.statsに処理時間などを記録するか否か。
+                       Trueにするとバッチの取り出しを数えるtf.numpy_functionがパイプラインの末尾に入る。
 
     """
 
@@ -217,12 +839,42 @@ class DataLoader:
         self,
         batch_size: int = 16,
         data_per_sample: int = 1,
-        parallel: bool = True,
+        parallel: typing.Union[bool, str] = True,
         num_replicas_in_sync: int = None,
+        batch_mode: bool = None,
+        decode_cache: DecodeCache = None,
+        num_workers: int = None,
+        output_signature: typing.Any = None,
+        buckets: typing.Sequence[typing.Tuple[int, int]] = None,
+        sampler: Sampler = None,
+        load_size: typing.Tuple[int, int] = None,
+        sample_graph_fn: GraphFn = None,
+        batch_graph_fn: GraphFn = None,
+        collect_stats: bool = False,
     ):
+        assert parallel in (True, False, "process"), f"Invalid parallel: {parallel}"
+        assert (
+            buckets is None or parallel != "process"
+        ), "buckets is not supported with parallel='process'"
+        assert (
+            buckets is None or sample_graph_fn is None
+        ), "buckets is not supported with sample_graph_fn"
         self.batch_size = batch_size
         self.data_per_sample = data_per_sample
         self.parallel = parallel
+        self.batch_mode = batch_mode
+        self.decode_cache = decode_cache
+        self.num_workers = num_workers
+        self.output_signature = output_signature
+        self.buckets = None if buckets is None else [tuple(b) for b in buckets]
+        self.sampler = sampler or Sampler()
+        self.load_size = load_size
+        self.sample_graph_fn = sample_graph_fn
+        self.batch_graph_fn = batch_graph_fn
+        self._schema_cache: typing.Dict[typing.Any, typing.Any] = {}
+        self._image_size_cache: typing.Dict[str, typing.Tuple[int, int]] = {}
+        self._process_pool: typing.Optional[_ProcessPool] = None
+        self.stats = PipelineStats(type(self).__name__, enabled=collect_stats)
         self.num_replicas_in_sync: int = (
             num_replicas_in_sync or tf.distribute.get_strategy().num_replicas_in_sync
         )
@@ -231,6 +883,25 @@ class DataLoader:
         """データを読み込んだことにする。"""
         return Iterator(self, dataset)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # ワーカープロセスには渡さない
+        state["_process_pool"] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del exc_type, exc_value, traceback
+        self.close()
+
+    def close(self) -> None:
+        """parallel="process"のワーカープロセスを終了する。(再度get_dsすると作り直す)"""
+        if self._process_pool is not None:
+            self._process_pool.close()
+            self._process_pool = None
+
     def get_ds(
         self,
         dataset: tk.data.Dataset,
@@ -248,95 +919,524 @@ class DataLoader:
             tf.data.Datasetと1epochあたりのステップ数のタプル
 
         """
-        # 試しに1件呼び出してdtypeやshapeを推定 (ダサいが…)
-        exsample_data = self.get_data(dataset, 0)
-        exsample_sample = self.get_sample(
-            [exsample_data for _ in range(self.data_per_sample)]
+        assert self.num_replicas_in_sync >= 1
+        global_batch_size = self.batch_size * self.num_replicas_in_sync
+        self.stats.batch_size = global_batch_size
+        ds_type = "batch"
+        if self.buckets is not None:
+            ds, steps = self._get_bucket_ds(
+                dataset, shuffle, without_label, global_batch_size
+            )
+        elif self.parallel == "process":
+            ds, steps = self._get_process_ds(
+                dataset, shuffle, without_label, global_batch_size
+            )
+        elif self.use_batch_mode(dataset):
+            ds, steps = self._get_batch_ds(
+                dataset, shuffle, without_label, global_batch_size
+            )
+        else:
+            ds, steps = self._get_sample_ds(
+                dataset, shuffle, without_label, global_batch_size
+            )
+            ds_type = "sample"
+        if not without_label:
+            # サンプル単位で読み込む場合はsample_graph_fnを_get_sample_ds内で適用済み
+            ds = self._apply_graph_fns(ds, sample_fn_applied=ds_type == "sample")
+        if self.stats.enabled:
+            ds = self._instrument_ds(ds)
+        return ds, steps
+
+    def _apply_graph_fns(
+        self, ds: tf.data.Dataset, sample_fn_applied: bool = False
+    ) -> tf.data.Dataset:
+        """self.sample_graph_fn/self.batch_graph_fnの処理を追加する。
+
+        バッチ単位で読み込んだ場合、サンプル単位の処理は一旦unbatchして行い、
+        元と同じバッチサイズで再びbatchする。
+
+        Args:
+            ds: バッチ単位のtf.data.Dataset
+            sample_fn_applied: sample_graph_fnを適用済みならTrue
+
+        """
+        sample_graph_fn = None if sample_fn_applied else self.sample_graph_fn
+        if sample_graph_fn is None and self.batch_graph_fn is None:
+            return ds
+
+        if sample_graph_fn is not None:
+            # 元のバッチサイズが静的なら端数は無いので、drop_remainderで静的なまま維持する
+            batch_dim = tf.nest.flatten(ds.element_spec)[0].shape[0]
+            ds = ds.unbatch()
+            ds = self._map_graph_fn(ds, sample_graph_fn)
+            ds = ds.batch(
+                self.batch_size * self.num_replicas_in_sync,
+                drop_remainder=batch_dim is not None,
+            )
+        if self.batch_graph_fn is not None:
+            ds = self._map_graph_fn(ds, self.batch_graph_fn)
+        return ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+    def _map_graph_fn(
+        self, ds: tf.data.Dataset, fn: GraphFn, deterministic: bool = False
+    ) -> tf.data.Dataset:
+        """要素ごとのseedを付けてfnをmapする。"""
+        # np.random.seedで再現できるようにseedを指定する
+        seed = np.random.randint(2 ** 31 - 1)
+        seeds = tf.data.experimental.RandomDataset(seed=seed).batch(2)
+        ds = tf.data.Dataset.zip((ds, seeds))
+        return ds.map(
+            lambda data, seed: fn(data[0], data[1], seed),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic,
         )
-        assert (
-            len(exsample_data) == 2
-        ), f"get_data returns {len(exsample_data)} values, but expects to see 2 values. {exsample_data=}"
-        assert (
-            len(exsample_sample) == 2
-        ), f"get_sample returns {len(exsample_sample)} values, but expects to see 2 values. {exsample_sample=}"
-        data_tf_type = _get_tf_types(exsample_data)
-        sample_tf_type = _get_tf_types(exsample_sample)
-        tk.log.get(__name__).info(f"DataLoader.get_data:   type={data_tf_type}")
-        tk.log.get(__name__).info(f"DataLoader.get_sample: type={sample_tf_type}")
-
-        def get_data(i):
-            X, y = self.get_data(dataset, i)
-            # tf.numpy_functionがNone未対応なので0にしちゃう
-            if y is None:
-                y = np.int32(0)
-            # tf.numpy_functionがdict未対応なのでlistに展開してしまう
-            # (並び順はexsample_dataに合わせる(一応))
-            if isinstance(exsample_data[0], dict):
-                X = [X[k] for k in exsample_data[0]]
-            if isinstance(exsample_data[1], dict):
-                y = [y[k] for k in exsample_data[1]]
-            data = _flatten([X, y])
-            return data
-
-        def get_sample(*data):
-            # flattenされたものをexsample_dataに従い戻す
-            if self.data_per_sample > 1:
-                for d in data:
-                    assert len(d) == self.data_per_sample, repr(data)
-                data_list = [
-                    _unflatten(exsample_data, [d[i] for d in data])
-                    for i in range(self.data_per_sample)
-                ]
-            else:
-                data_list = [_unflatten(exsample_data, data)]
-            assert len(data_list) == self.data_per_sample, repr(data_list)
 
-            X, y = self.get_sample(data_list)
+    def _instrument_ds(self, ds: tf.data.Dataset) -> tf.data.Dataset:
+        """バッチが取り出されたことをself.statsに記録する処理を追加する。"""
 
-            # tf.numpy_functionがNone未対応なので0にしちゃう
-            if y is None:
-                y = np.int32(0)
-            # tf.numpy_functionがdict未対応なのでlistに展開してしまう
-            # (並び順はexsample_dataに合わせる(一応))
-            if isinstance(exsample_sample[0], dict):
-                X = [X[k] for k in exsample_sample[0]]
-            if isinstance(exsample_sample[1], dict):
-                y = [y[k] for k in exsample_sample[1]]
-
-            sample = _flatten([X, y])
-            return sample
+        def on_consume(*batch):
+            num_samples = tf.shape(tf.nest.flatten(batch)[0])[0]
+            t = tf.numpy_function(
+                self.stats.on_consume, inp=[num_samples], Tout=tf.int64
+            )
+            with tf.control_dependencies([t]):
+                batch = tf.nest.map_structure(tf.identity, batch)
+            return batch[0] if len(batch) == 1 else batch
+
+        return ds.map(on_consume)
+
+    def _get_index_ds(self, dataset: Dataset, shuffle: bool) -> tf.data.Dataset:
+        """インデックスのtf.data.Datasetを作る。
+
+        シャッフルする場合はself.samplerで1epochずつインデックスを作って無限に繰り返す。
+
+        """
+        if not shuffle:
+            return tf.data.Dataset.from_tensor_slices(np.arange(len(dataset)))
+
+        def generator():
+            while True:
+                yield self.sampler.sample(dataset).astype(np.int64)
+
+        ds = tf.data.Dataset.from_generator(
+            generator, output_types=tf.int64, output_shapes=tf.TensorShape((None,))
+        )
+        return ds.unbatch()
+
+    def _get_steps(
+        self, dataset: Dataset, shuffle: bool, global_batch_size: int
+    ) -> int:
+        """1epochあたりのステップ数を返す。"""
+        size = self.sampler.get_size(dataset) if shuffle else len(dataset)
+        return -(-size // global_batch_size)
+
+    def _get_sample_ds(
+        self,
+        dataset: tk.data.Dataset,
+        shuffle: bool,
+        without_label: bool,
+        global_batch_size: int,
+    ) -> typing.Tuple[tf.data.Dataset, int]:
+        """self.get_data/self.get_sampleを使ってサンプル単位で読み込むtf.data.Datasetを作る。"""
 
-        def process1(i):
-            data = tf.numpy_function(get_data, inp=[i], Tout=data_tf_type)
-            return data
+        sample_spec = self.get_output_signature(dataset)
+        sample_tf_type = _get_tf_types(sample_spec)
 
-        def process2(*data):
-            sample = tf.numpy_function(get_sample, inp=data, Tout=sample_tf_type)
-            sample = _unflatten_tensor(exsample_sample, sample)
+        def get_sample(indices):
+            with self.stats.timer("get_data"):
+                data_list = [self.get_data(dataset, i) for i in indices]
+            assert len(data_list) == self.data_per_sample, repr(data_list)
+            with self.stats.timer("get_sample"):
+                sample = self.get_sample(data_list)
+            self.stats.add_produced(1)
+            assert (
+                len(sample) == 2
+            ), f"get_sample returns {len(sample)} values, but expects to see 2 values. {sample=}"
+            return _flatten_spec(sample_spec, sample)
+
+        def process(indices):
+            sample = tf.numpy_function(get_sample, inp=[indices], Tout=sample_tf_type)
+            sample = _unflatten_tensor(sample_spec, sample)
             if without_label:
                 return sample[0]
             return sample
 
-        assert self.num_replicas_in_sync >= 1
-        global_batch_size = self.batch_size * self.num_replicas_in_sync
+        # data_per_sample > 1ならサンプルの組み合わせを変えるためrepeatしてからbatch
+        # (shuffleする場合はバッチサイズを固定するため無限に繰り返す)
+        infinite = shuffle or self.data_per_sample > 1
+        ds = self._get_index_ds(dataset, shuffle)
+        ds = ds.repeat() if infinite and not shuffle else ds
+        ds = ds.batch(self.data_per_sample)
+        ds = ds.map(
+            process,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE if self.parallel else None,
+            deterministic=not shuffle,
+        )
+        if self.sample_graph_fn is not None and not without_label:
+            # バッチにする前に適用する (サイズの異なる画像のリサイズなどにも使えるように)
+            ds = self._map_graph_fn(ds, self.sample_graph_fn, deterministic=not shuffle)
+        # 無限に繰り返す場合は端数が出ないので、drop_remainderでバッチサイズを静的にする
+        ds = ds.batch(global_batch_size, drop_remainder=infinite)
+        ds = ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        steps = self._get_steps(dataset, shuffle, global_batch_size)
+        return ds, steps
+
+    def _get_batch_ds(
+        self,
+        dataset: tk.data.Dataset,
+        shuffle: bool,
+        without_label: bool,
+        global_batch_size: int,
+    ) -> typing.Tuple[tf.data.Dataset, int]:
+        """self.get_batchを使ってバッチ単位で読み込むtf.data.Datasetを作る。"""
+
+        batch_spec = _batch_spec(
+            self.get_output_signature(dataset), global_batch_size if shuffle else None
+        )
+        batch_tf_type = _get_tf_types(batch_spec)
+
+        def get_batch(indices):
+            with self.stats.timer("get_batch"):
+                X, y = self.get_batch(dataset, indices)
+            self.stats.add_produced(len(indices))
+            # tf.numpy_functionがNone未対応なので0にしちゃう
+            if y is None:
+                y = np.zeros((len(indices),), dtype=np.int32)
+            return _flatten_spec(batch_spec, (X, y))
 
-        ds = tf.data.Dataset.from_tensor_slices(np.arange(len(dataset)))
-        ds = ds.shuffle(buffer_size=len(dataset)) if shuffle else ds
+        def process(indices):
+            batch = tf.numpy_function(get_batch, inp=[indices], Tout=batch_tf_type)
+            batch = _unflatten_tensor(batch_spec, batch)
+            if without_label:
+                return batch[0]
+            return batch
+
+        # シャッフルする場合は無限に繰り返すので、drop_remainderでバッチサイズを固定する
+        ds = self._get_index_ds(dataset, shuffle)
+        ds = ds.batch(global_batch_size, drop_remainder=shuffle)
         ds = ds.map(
-            process1,
+            process,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE if self.parallel else None,
+            deterministic=not shuffle,
+        )
+        ds = ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        steps = self._get_steps(dataset, shuffle, global_batch_size)
+        return ds, steps
+
+    def _get_bucket_ds(
+        self,
+        dataset: tk.data.Dataset,
+        shuffle: bool,
+        without_label: bool,
+        global_batch_size: int,
+    ) -> typing.Tuple[tf.data.Dataset, int]:
+        """バケットごとにバッチを作るtf.data.Datasetを作る。
+
+        シャッフルする場合はバケット内でシャッフルしてバッチにし、バッチの順番をシャッフルする。
+        シャッフルしない場合は順番を維持するため、連続する同じバケットのサンプルをバッチにする。
+        (その分バッチサイズが小さくなることがある)
+
+        """
+        assert self.buckets is not None
+        assert self.data_per_sample == 1, "buckets requires data_per_sample == 1"
+        bucket_ids = self.get_bucket_ids(dataset)
+        # 画像サイズはバケットごとに異なるのでshapeは不定にする
+        batch_spec = _batch_spec(self.get_output_signature(dataset), None)
+        batch_tf_type = _get_tf_types(batch_spec)
+
+        def make_batches():
+            epoch_indices = self.sampler.sample(dataset) if shuffle else None
+            return _make_bucket_batches(bucket_ids, global_batch_size, epoch_indices)
+
+        steps = len(make_batches())
+
+        def generator():
+            while True:
+                yield from make_batches()
+                if not shuffle:
+                    break
+
+        def get_batch(bucket_id, indices):
+            assert self.buckets is not None
+            shape = self.buckets[int(bucket_id)]
+            samples = []
+            for i in indices:
+                with self.stats.timer("get_bucket_data"):
+                    X, y = self.get_bucket_data(dataset, int(i), shape)
+                # tf.numpy_functionと同様にNoneは0にしちゃう
+                if y is None:
+                    y = np.int32(0)
+                samples.append((X, y))
+            self.stats.add_produced(len(samples))
+            return _flatten_spec(batch_spec, _stack_samples(samples))
+
+        def process(bucket_id, indices):
+            batch = tf.numpy_function(
+                get_batch, inp=[bucket_id, indices], Tout=batch_tf_type
+            )
+            batch = _unflatten_tensor(batch_spec, batch)
+            if without_label:
+                return batch[0]
+            return batch
+
+        ds = tf.data.Dataset.from_generator(
+            generator,
+            output_types=(tf.int32, tf.int64),
+            output_shapes=(tf.TensorShape(()), tf.TensorShape((None,))),
+        )
+        ds = ds.map(
+            process,
             num_parallel_calls=tf.data.experimental.AUTOTUNE if self.parallel else None,
             deterministic=not shuffle,
         )
-        if self.data_per_sample > 1:
-            ds = ds.repeat().batch(self.data_per_sample)
-        else:
-            ds = ds.repeat() if shuffle else ds  # バッチサイズを固定するため先にrepeat
-        ds = ds.map(process2)
-        ds = ds.batch(global_batch_size)
         ds = ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-        steps = -(-len(dataset) // global_batch_size)
         return ds, steps
 
+    def _get_process_ds(
+        self,
+        dataset: tk.data.Dataset,
+        shuffle: bool,
+        without_label: bool,
+        global_batch_size: int,
+    ) -> typing.Tuple[tf.data.Dataset, int]:
+        """ワーカープロセスでバッチを作るtf.data.Datasetを作る。
+
+        ワーカープロセスはバッチ単位でget_data/get_sample(またはget_batch)を呼び出し、
+        結果を共有メモリに書き込んで返す。(ndarrayはpickleしない)
+
+        """
+        batch_mode = self.use_batch_mode(dataset)
+        # プールはDataLoaderごとに1つだけ作り、fit/evaluate/predictやepochをまたいで使い回す
+        # (tf.dataのスレッドからではなく、ここで作っておく)
+        if self._process_pool is None:
+            num_workers = self.num_workers or os.cpu_count() or 1
+            self._process_pool = _ProcessPool(self, num_workers)
+        pool = self._process_pool
+        dataset_path = pool.register_dataset(dataset)
+        data_size = len(dataset)
+        data_per_sample = self.data_per_sample
+        repeat = shuffle or data_per_sample > 1
+        # 無限に繰り返す場合は端数が出ないのでバッチサイズを静的にする
+        batch_spec = _batch_spec(
+            self.get_output_signature(dataset), global_batch_size if repeat else None
+        )
+
+        def generate_indices():
+            while True:
+                if shuffle:
+                    yield from self.sampler.sample(dataset)
+                else:
+                    yield from range(data_size)
+                if not repeat:
+                    break
+
+        def generate_batches():
+            index_groups: typing.List[typing.List[int]] = []
+            group: typing.List[int] = []
+            for i in generate_indices():
+                group.append(int(i))
+                if len(group) >= data_per_sample:
+                    index_groups.append(group)
+                    group = []
+                if len(index_groups) >= global_batch_size:
+                    yield index_groups
+                    index_groups = []
+            if len(index_groups) > 0:
+                yield index_groups
+
+        def generator():
+            # ワーカープロセス内の処理時間は結果と一緒に受け取ってself.statsに加算する
+            # (ここでは結果待ちの時間を記録する)
+            it = pool.imap(
+                generate_batches(), dataset_path, batch_spec, batch_mode, self.stats
+            )
+            try:
+                while True:
+                    with self.stats.timer("process_wait"):
+                        batch = next(it, None)
+                    if batch is None:
+                        break
+                    self.stats.add_produced(len(batch[0]))
+                    yield batch
+            finally:
+                it.close()
+
+        def process(*batch):
+            batch = _unflatten_tensor(batch_spec, batch)
+            if without_label:
+                return batch[0]
+            return batch
+
+        ds = tf.data.Dataset.from_generator(
+            generator,
+            output_types=tuple(_get_tf_types(batch_spec)),
+            output_shapes=tuple(spec.shape for spec in _flatten_specs(batch_spec)),
+        )
+        ds = ds.map(process)
+        ds = ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        steps = self._get_steps(dataset, shuffle, global_batch_size)
+        return ds, steps
+
+    def get_output_signature(self, dataset: Dataset) -> typing.Any:
+        """1サンプル分の(X, y)の型を返す。
+
+        output_signatureが指定されていればそれを使う。
+        指定されていなければ先頭のデータを読み込んで判定し、
+        データセットの型やdata/labelsのdtypeなどが同じ間は結果を使い回す。
+
+        Args:
+            dataset: データセット
+
+        Returns:
+            tf.TensorSpecの入れ子構造。(yがNoneの場合はダミーのスカラー)
+
+        """
+        if self.output_signature is not None:
+            return _normalize_spec(self.output_signature)
+
+        batch_mode = self.use_batch_mode(dataset)
+        key = (batch_mode,) + _get_schema_key(dataset)
+        spec = self._schema_cache.get(key)
+        if spec is None:
+            if batch_mode:
+                X, y = self.get_batch(dataset, np.zeros((1,), dtype=np.int64))
+                if y is None:
+                    y = np.zeros((1,), dtype=np.int32)
+                spec = _unbatch_spec(_spec_from_exsample((X, y)))
+            else:
+                data = [self.get_data(dataset, 0)] * self.data_per_sample
+                sample = self.get_sample(data)
+                assert (
+                    len(sample) == 2
+                ), f"get_sample returns {len(sample)} values, but expects to see 2 values. {sample=}"
+                spec = _spec_from_exsample(tuple(sample))
+            tk.log.get(__name__).info(f"DataLoader: output_signature={spec}")
+            self._schema_cache[key] = spec
+        return spec
+
+    def get_bucket_ids(self, dataset: Dataset) -> np.ndarray:
+        """各サンプルをどのバケットに割り当てるかを返す。
+
+        縦横比が最も近い(同程度なら面積が近い)バケットに割り当てる。
+
+        Args:
+            dataset: データセット
+
+        Returns:
+            self.bucketsのインデックスの配列。shape=(len(dataset),)
+
+        """
+        assert self.buckets is not None
+        sizes = np.array(
+            [self.get_image_size(dataset, i) for i in range(len(dataset))],
+            dtype=np.float32,
+        ).reshape(-1, 2)
+        buckets = np.array(self.buckets, dtype=np.float32)
+        aspect_diff = np.abs(
+            np.log(sizes[:, np.newaxis, 1] / sizes[:, np.newaxis, 0])
+            - np.log(buckets[np.newaxis, :, 1] / buckets[np.newaxis, :, 0])
+        )
+        area_diff = np.abs(
+            np.log(sizes[:, np.newaxis, 0] * sizes[:, np.newaxis, 1])
+            - np.log(buckets[np.newaxis, :, 0] * buckets[np.newaxis, :, 1])
+        )
+        # 縦横比の差を優先し、ほぼ同じなら面積の差で決める
+        return np.argmin(np.round(aspect_diff, 2) * 1e3 + area_diff, axis=1).astype(
+            np.int32
+        )
+
+    def get_image_size(self, dataset: Dataset, index: int) -> typing.Tuple[int, int]:
+        """バケット分け用に1件の画像サイズ(H, W)を返す。
+
+        既定の実装は、dataset.metadata["image_sizes"]((N, 2)の配列)があればそれを使い、
+        無ければtk.ndimage.get_image_sizeでヘッダーなどから取得する。
+        (ファイルパスの場合は結果をキャッシュする)
+
+        """
+        if isinstance(dataset, DatasetView):
+            dataset, index = dataset.resolve(index)
+        image_sizes = dataset.metadata.get("image_sizes")
+        if image_sizes is not None and len(image_sizes) == len(dataset):
+            h, w = image_sizes[index]
+            return int(h), int(w)
+        X = dataset.data[index]
+        if not isinstance(X, (str, pathlib.Path)):
+            return tk.ndimage.get_image_size(X)
+        key = str(X)
+        size = self._image_size_cache.get(key)
+        if size is None:
+            h, w = tk.ndimage.get_image_size(X)
+            size = self._image_size_cache[key] = (int(h), int(w))
+        return size
+
+    def get_bucket_data(
+        self, dataset: Dataset, index: int, shape: typing.Tuple[int, int]
+    ):
+        """バケット分けする場合の1件のデータを取得する。
+
+        既定の実装はself.get_dataの結果の画像をshapeにリサイズする。
+        (ラベルが同じサイズの画像(セグメンテーションのマスクなど)ならそれもリサイズする)
+        Data Augmentationでサイズを揃える場合などはオーバーライドしてshapeを使う。
+
+        Args:
+            dataset: データセット
+            index: インデックス
+            shape: バケットのサイズ (H, W)
+
+        Returns:
+            1件のデータ。通常は入力データとラベルのtuple。
+
+        """
+        X, y = self.get_data(dataset, index)
+        if isinstance(X, np.ndarray) and X.ndim in (2, 3):
+            height, width = shape
+            if (
+                isinstance(y, np.ndarray)
+                and y.ndim in (2, 3)
+                and y.shape[:2] == X.shape[:2]
+            ):
+                y = tk.ndimage.resize(y, width, height, interp="nearest")
+            X = tk.ndimage.resize(X, width, height)
+        return X, y
+
+    def use_batch_mode(self, dataset: Dataset) -> bool:
+        """get_dsでself.get_batchを使うか否かを返す。"""
+        if self.batch_mode is not None:
+            return self.batch_mode
+        cls = type(self)
+        if cls.get_batch is not DataLoader.get_batch:
+            return True
+        if isinstance(dataset, DatasetView) and "data" not in dataset.overrides:
+            # ビューなら親で判定する
+            dataset = dataset.resolve(0)[0] if len(dataset) > 0 else dataset.parent
+        return (
+            self.data_per_sample == 1
+            and cls.get_data is DataLoader.get_data
+            and cls.decode is DataLoader.decode
+            and cls.get_sample is DataLoader.get_sample
+            and type(dataset).get_data is Dataset.get_data
+            and type(dataset).get_batch is Dataset.get_batch
+            and _is_batchable(dataset.data)
+            and (dataset.labels is None or _is_batchable(dataset.labels))
+        )
+
+    def get_batch(self, dataset: Dataset, indices: np.ndarray):
+        """バッチ1個分のデータを取得する。
+
+        既定の実装はDataset.get_batchでdata/labelsをまとめてスライスする。
+        get_data/get_sampleの代わりにオーバーライドすると、
+        1件ずつではなくバッチ単位で読み込みやData Augmentationなどができる。
+
+        Args:
+            dataset: データセット
+            indices: バッチ1個分のインデックスの配列
+
+        Returns:
+            バッチ1個分のデータ。通常は入力データとラベルのtuple。
+
+        """
+        return dataset.get_batch(indices)
+
     def get_sample(self, data):
         """1件のサンプルを取得する。"""
         assert len(data) == self.data_per_sample
@@ -353,93 +1453,859 @@ class DataLoader:
         Returns:
             1件のデータ。通常は入力データとラベルのtuple。
 
+        """
+        return self.get_decoded(dataset, index)
+
+    def get_decoded(self, dataset: Dataset, index: int):
+        """self.decodeの結果を取得する。decode_cacheがあればキャッシュを使う。
+
+        get_dataをオーバーライドする場合も、
+        読み込み部分でこれを呼び出すようにするとキャッシュが効くようになる。
+
+        Args:
+            dataset: データセット
+            index: インデックス
+
+        Returns:
+            self.decodeの結果
+
+        """
+        def decode():
+            with self.stats.timer("decode"):
+                return self.decode(dataset, index)
+
+        if self.decode_cache is None:
+            return decode()
+        key = self.get_cache_key(dataset, index)
+        if key is None:
+            return decode()
+        return self.decode_cache.get(key, decode)
+
+    def decode(self, dataset: Dataset, index: int):
+        """1件のデータの決定的な読み込み処理。(画像のデコードなど)
+
+        decode_cacheでキャッシュされる部分なので、乱数を使う処理などは入れないこと。
+
+        Args:
+            dataset: データセット
+            index: インデックス
+
+        Returns:
+            1件のデータ。通常は入力データとラベルのtuple。
+
         """
         return dataset.get_data(index)
 
+    def load_image(self, path_or_array, grayscale: bool = False) -> np.ndarray:
+        """画像を読み込む。(self.load_sizeを考慮したtk.ndimage.load)
 
-def _flatten(a):
-    """1次元配列化。"""
-    if isinstance(a, (list, tuple)):
-        return sum([_flatten(t) for t in a], [])
-    assert not isinstance(a, dict)
-    return [a]
+        縮小された倍率が必要な場合はtk.ndimage.load_scaledを直接使うこと。
+        マスク画像などは同じ倍率で縮小されるとは限らないので注意。(JPEG以外は縮小しない)
 
+        """
+        return tk.ndimage.load(
+            path_or_array, grayscale=grayscale, target_size=self.load_size
+        )
 
-def _get_tf_types(exsample_data):
-    """exsample_dataからtf.dtypesの1次元リストを返す。"""
-    if exsample_data is None:
-        return [tf.int32]  # dummy
-    elif isinstance(exsample_data, tuple):
-        return sum([_get_tf_types(v) for v in exsample_data], [])
-    elif isinstance(exsample_data, list):
-        return sum([_get_tf_types(v) for v in exsample_data], [])
-    elif isinstance(exsample_data, dict):
-        # tf.numpy_functionがdict未対応なので、値の型だけリストで返す
-        return sum([_get_tf_types(v) for v in exsample_data.values()], [])
-    else:
-        return [tf.dtypes.as_dtype(exsample_data.dtype)]
+    def get_cache_key(self, dataset: Dataset, index: int) -> typing.Optional[str]:
+        """decode_cache用のキーを返す。
 
+        既定の実装は、dataset.data/labelsのファイルパスと更新日時から作る。
+        (foldの分割などでindexが変わってもキャッシュが効くように)
+        ファイルパスが無い場合はキャッシュしないものとしてNoneを返す。
 
-def _unflatten(exsample_data, data):
-    """flattenされたdataをexsample_dataに従い戻す。"""
-    if exsample_data is None:
-        return data  # dummy
-    elif isinstance(exsample_data, (tuple, list)):
-        lengths = [
-            len(v) if isinstance(v, (tuple, list, dict)) else 1 for v in exsample_data
+        """
+        if isinstance(dataset, DatasetView):
+            dataset, index = dataset.resolve(index)
+        values = [dataset.data[index]]
+        if isinstance(dataset.labels, np.ndarray):
+            values.append(dataset.labels[index])
+        paths = [v for v in values if isinstance(v, (str, pathlib.Path))]
+        if len(paths) <= 0:
+            return None
+        return "\n".join(f"{p}\t{os.stat(p).st_mtime_ns}" for p in paths)
+
+
+def _load_batch(
+    data_loader: DataLoader,
+    dataset: Dataset,
+    index_groups: typing.List[typing.List[int]],
+    batch_mode: bool,
+):
+    """バッチ1個分を読み込む。(parallel="process"用)
+
+    index_groupsはサンプルごとのインデックスのリスト。(長さはdata_per_sample)
+
+    """
+    stats = data_loader.stats
+    if batch_mode:
+        indices = np.array([group[0] for group in index_groups])
+        with stats.timer("get_batch"):
+            X, y = data_loader.get_batch(dataset, indices)
+        if y is None:
+            y = np.zeros((len(indices),), dtype=np.int32)
+        return X, y
+
+    samples = []
+    for group in index_groups:
+        with stats.timer("get_data"):
+            data_list = [data_loader.get_data(dataset, i) for i in group]
+        with stats.timer("get_sample"):
+            X, y = data_loader.get_sample(data_list)
+        # tf.numpy_functionと同様にNoneは0にしちゃう
+        if y is None:
+            y = np.int32(0)
+        samples.append((X, y))
+    return _stack_samples(samples)
+
+
+def _make_bucket_batches(
+    bucket_ids: np.ndarray,
+    batch_size: int,
+    epoch_indices: typing.Optional[np.ndarray],
+) -> typing.List[typing.Tuple[int, np.ndarray]]:
+    """バケットごとのバッチ(バケットのインデックスとサンプルのインデックスの配列)のリストを作る。
+
+    epoch_indicesはシャッフルする場合の1epoch分のインデックス。(Noneならシャッフルしない)
+
+    """
+    batches: typing.List[typing.Tuple[int, np.ndarray]] = []
+    if epoch_indices is not None:
+        epoch_buckets = bucket_ids[epoch_indices]
+        for bucket_id in np.unique(epoch_buckets):
+            indices = epoch_indices[epoch_buckets == bucket_id]
+            for i in range(0, len(indices), batch_size):
+                batches.append((int(bucket_id), indices[i : i + batch_size]))
+        return [batches[i] for i in np.random.permutation(len(batches))]
+    # 順番を維持して、バケットが変わるかバッチサイズに達したら区切る
+    start = 0
+    for i in range(1, len(bucket_ids) + 1):
+        if (
+            i == len(bucket_ids)
+            or bucket_ids[i] != bucket_ids[start]
+            or i - start >= batch_size
+        ):
+            batches.append((int(bucket_ids[start]), np.arange(start, i)))
+            start = i
+    return batches
+
+
+def _stack_samples(samples):
+    """サンプルのリストをバッチにする。"""
+    s = samples[0]
+    if isinstance(s, (tuple, list)):
+        return type(s)(
+            _stack_samples([sample[i] for sample in samples]) for i in range(len(s))
+        )
+    elif isinstance(s, dict):
+        return {k: _stack_samples([sample[k] for sample in samples]) for k in s}
+    return np.stack([np.asarray(sample) for sample in samples], axis=0)
+
+
+class _ProcessPool:
+    """DataLoader(parallel="process")用のワーカープロセスのプール。
+
+    TFのスレッドが動いているプロセスをforkするとデッドロックすることがあるため、
+    forkserver(無ければspawn)でワーカープロセスを起動する。
+    DataLoaderは起動時に1回だけ、Datasetは一時ファイル経由で渡す。(バッチごとにはpickleしない)
+
+    Args:
+        data_loader: データローダー
+        num_workers: ワーカープロセス数
+
+    """
+
+    def __init__(self, data_loader: DataLoader, num_workers: int):
+        self.num_workers = num_workers
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn"
+        )
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="pytoolkit-")
+        self.datasets: typing.List[typing.Tuple[Dataset, str]] = []
+        self.pool = context.Pool(
+            num_workers, initializer=_process_worker_init, initargs=(data_loader,)
+        )
+        self._finalizer = weakref.finalize(
+            self, _close_process_pool, self.pool, self.temp_dir
+        )
+
+    def register_dataset(self, dataset: Dataset) -> str:
+        """datasetを一時ファイルに保存してパスを返す。(同じオブジェクトなら使い回す)"""
+        for d, path in self.datasets:
+            if d is dataset:
+                return path
+        path = os.path.join(self.temp_dir.name, f"dataset{len(self.datasets)}.pkl")
+        with open(path, "wb") as f:
+            pickle.dump(dataset, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.datasets.append((dataset, path))
+        return path
+
+    def imap(
+        self,
+        batches: typing.Iterator[typing.List[typing.List[int]]],
+        dataset_path: str,
+        batch_spec: typing.Any,
+        batch_mode: bool,
+        stats: PipelineStats,
+    ):
+        """バッチのインデックスを受け取り、読み込んだバッチを順番に返す。
+
+        同時に処理するバッチ数はnum_workers * 2までに制限する。
+        ワーカープロセス内の処理時間はstatsに加算する。
+
+        """
+        pending: typing.Deque[multiprocessing.pool.AsyncResult] = collections.deque()
+
+        def receive():
+            result, worker_stats = pending.popleft().get()
+            for stage, (elapsed, count) in worker_stats.items():
+                stats.add(stage, elapsed, count)
+            return _receive_shared(result)
+
+        try:
+            for index_groups in batches:
+                pending.append(
+                    self.pool.apply_async(
+                        _process_worker,
+                        (dataset_path, batch_spec, batch_mode, index_groups),
+                    )
+                )
+                if len(pending) >= self.num_workers * 2:
+                    yield receive()
+            while len(pending) > 0:
+                yield receive()
+        finally:
+            # 途中で終了した場合も共有メモリは解放する
+            while len(pending) > 0:
+                try:
+                    receive()
+                except Exception:
+                    tk.log.get(__name__).warning("worker error", exc_info=True)
+
+    def close(self) -> None:
+        """終了する。"""
+        self._finalizer()
+
+
+def _close_process_pool(
+    pool: multiprocessing.pool.Pool, temp_dir: tempfile.TemporaryDirectory
+) -> None:
+    pool.terminate()
+    pool.join()
+    temp_dir.cleanup()
+
+
+_process_worker_data_loader: typing.Optional[DataLoader] = None
+_process_worker_datasets: typing.Dict[str, Dataset] = {}
+
+
+def _process_worker_init(data_loader: DataLoader):
+    """ワーカープロセスの初期化。"""
+    global _process_worker_data_loader
+    _process_worker_data_loader = data_loader
+    # ワーカープロセスごとに乱数を変える
+    seed = (os.getpid() * 7919 + int.from_bytes(os.urandom(4), "little")) % (2 ** 32)
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def _process_worker(
+    dataset_path: str,
+    batch_spec: typing.Any,
+    batch_mode: bool,
+    index_groups: typing.List[typing.List[int]],
+):
+    """ワーカープロセスの処理。バッチを読み込んで共有メモリに書き込む。
+
+    Returns:
+        (共有メモリの名前, 配列の配置のリスト)と、処理段階ごとの(処理時間, 回数)のdict
+
+    """
+    data_loader = _process_worker_data_loader
+    assert data_loader is not None
+    dataset = _process_worker_datasets.get(dataset_path)
+    if dataset is None:
+        # 直近のものだけ保持する
+        _process_worker_datasets.clear()
+        with open(dataset_path, "rb") as f:
+            dataset = pickle.load(f)
+        _process_worker_datasets[dataset_path] = dataset
+    batch = _load_batch(data_loader, dataset, index_groups, batch_mode)
+    arrays = [np.ascontiguousarray(a) for a in _flatten_spec(batch_spec, batch)]
+    size = sum(a.nbytes for a in arrays)
+    shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        layouts = []
+        offset = 0
+        for a in arrays:
+            dst = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf, offset=offset)
+            dst[...] = a
+            del dst  # 参照が残っているとcloseできないので消しておく
+            layouts.append((offset, a.shape, a.dtype.str))
+            offset += a.nbytes
+        name = shm.name
+    finally:
+        shm.close()
+    # 解放は受け取った側で行うのでresource_trackerの管理から外す
+    multiprocessing.resource_tracker.unregister(  # type: ignore
+        shm._name, "shared_memory"  # pylint: disable=protected-access
+    )
+    # 処理時間の統計は親プロセスに返してリセットする
+    stats = data_loader.stats
+    with stats.lock:
+        worker_stats = {
+            stage: (stats.times[stage], count) for stage, count in stats.counts.items()
+        }
+        stats.counts.clear()
+        stats.times.clear()
+    return (name, layouts), worker_stats
+
+
+def _receive_shared(result) -> typing.Tuple[np.ndarray, ...]:
+    """_process_workerの結果を共有メモリから読み込んで解放する。"""
+    name, layouts = result
+    shm = multiprocessing.shared_memory.SharedMemory(name=name)
+    try:
+        arrays = tuple(
+            np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset).copy()
+            for offset, shape, dtype in layouts
+        )
+    finally:
+        shm.close()
+        shm.unlink()
+    return arrays
+
+
+class DecodeCache:
+    """DataLoader.decodeの結果をディスクにキャッシュするクラス。
+
+    キーのハッシュ値でシャードに振り分け、シャードごとにデータファイルへ追記していく。
+    読み込みはmemory-mapで行うため、2epoch目以降や別のfoldではデコードが不要になる。
+
+    Args:
+        cache_dir: 保存先ディレクトリ
+        num_shards: シャード数
+        long_side: 指定した場合、画像(3次元のndarray)の長辺がこれ以下になるようにリサイズしてから保存する。
+                   ラベルも同じサイズの画像(マスクなど)ならnearestでリサイズする。
+                   (bboxなどの座標はリサイズしないので注意)
+
+    """
+
+    def __init__(
+        self,
+        cache_dir: tk.typing.PathLike,
+        num_shards: int = 16,
+        long_side: int = None,
+    ):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.num_shards = num_shards
+        self.long_side = long_side
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Horovod使用時に追記が衝突しないようにrankごとに分ける
+        prefix = f"shard{tk.hvd.rank()}_"
+        self.shards = [
+            _DecodeCacheShard(self.cache_dir / f"{prefix}{i:03d}")
+            for i in range(num_shards)
         ]
-        assert sum(lengths) == len(data), f"{exsample_data=} {data=}"
-        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
-        return tuple(
-            _unflatten(v, data[o : o + l])
-            for v, o, l in zip(exsample_data, offsets, lengths)
+
+    def __len__(self) -> int:
+        """キャッシュ済みの件数を返す。"""
+        return sum(len(shard) for shard in self.shards)
+
+    def get(self, key: str, decode_fn: typing.Callable[[], typing.Any]):
+        """キャッシュがあれば読み、無ければdecode_fnを呼び出して保存する。"""
+        h = hashlib.md5(key.encode("utf-8")).digest()
+        shard = self.shards[int.from_bytes(h[:4], "little") % self.num_shards]
+        found, value = shard.get(key)
+        if found:
+            return value
+        value = decode_fn()
+        if self.long_side is not None:
+            value = self._resize(value)
+        shard.put(key, value)
+        return value
+
+    def _resize(self, value):
+        """長辺がself.long_side以下になるようにリサイズする。"""
+        if not isinstance(value, tuple) or len(value) != 2:
+            return value
+        X, y = value
+        if not isinstance(X, np.ndarray) or X.ndim != 3:
+            return value
+        assert self.long_side is not None
+        X2 = tk.ndimage.resize_long_side(X, self.long_side, expand=False)
+        if isinstance(y, np.ndarray) and y.ndim == 3 and y.shape[:2] == X.shape[:2]:
+            y = tk.ndimage.resize(y, X2.shape[1], X2.shape[0], interp="nearest")
+        return X2, y
+
+
+class _DecodeCacheShard:
+    """DecodeCacheのシャード1個分。
+
+    データファイル(.bin)にndarrayのバイト列を追記し、
+    インデックスファイル(.idx)にキーと配置情報をpickleで追記していく。
+
+    DataLoader(parallel="process")などで複数プロセスから同じファイルに追記するため、
+    追記はOSのファイルロック(.lock)の中で行い、その都度ファイルの末尾の位置と
+    他のプロセスが追記したインデックスを読み直す。(fcntlが無い環境ではプロセス内のロックのみ)
+
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.data_path = path.with_suffix(".bin")
+        self.index_path = path.with_suffix(".idx")
+        self.lock_path = path.with_suffix(".lock")
+        self.lock = threading.Lock()
+        self.index: typing.Dict[str, typing.Any] = {}
+        self.index_pos = 0
+        self.mmap: typing.Optional[np.memmap] = None
+        self._refresh()
+        size = self.data_path.stat().st_size if self.data_path.exists() else 0
+        # 書き込み途中で落ちたデータファイルの末尾を参照しているものは捨てる
+        self.index = {
+            k: e for k, e in self.index.items() if _get_cache_end(e) <= size
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["mmap"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, key: str) -> typing.Tuple[bool, typing.Any]:
+        """キャッシュを読み込む。(見つかったか否か, 値)を返す。"""
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return False, None
+            end = _get_cache_end(entry)
+            if end > 0 and (self.mmap is None or len(self.mmap) < end):
+                self.mmap = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+            mm = self.mmap
+        return True, _restore_cache_entry(mm, entry)
+
+    def put(self, key: str, value) -> None:
+        """キャッシュを追記する。"""
+        with self.lock, _file_lock(self.lock_path):
+            # 他のプロセスが追記した分を読み込む
+            self._refresh()
+            if key in self.index:
+                return
+            with self.data_path.open("ab") as f:
+                # 追記位置は実際のファイルの末尾 (他のプロセスの追記や書き込み途中の残骸の後ろ)
+                arrays: typing.List[np.ndarray] = []
+                entry = _make_cache_entry(value, arrays, f.seek(0, os.SEEK_END))
+                for a in arrays:
+                    f.write(a.tobytes())
+            with self.index_path.open("ab") as f:
+                pickle.dump((key, entry), f)
+                self.index_pos = f.tell()
+            self.index[key] = entry
+
+    def _refresh(self) -> None:
+        """インデックスファイルの未読の部分を読み込む。"""
+        if not self.index_path.exists():
+            return
+        with self.index_path.open("rb") as f:
+            f.seek(self.index_pos)
+            while True:
+                try:
+                    key, entry = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    break  # 書き込み途中で落ちた場合などは末尾を無視
+                self.index[key] = entry
+                self.index_pos = f.tell()
+
+
+@contextlib.contextmanager
+def _file_lock(path: pathlib.Path):
+    """OSのファイルロック。(fcntlが無い環境では何もしない)"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with path.open("ab") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@dataclasses.dataclass()
+class _CachedArray:
+    """DecodeCacheのデータファイル内のndarrayの位置など。"""
+
+    offset: int
+    shape: typing.Tuple[int, ...]
+    dtype: str
+
+    @property
+    def end(self) -> int:
+        """データファイル内の終了位置。"""
+        return self.offset + int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+def _make_cache_entry(value, arrays: typing.List[np.ndarray], offset: int):
+    """ndarrayを_CachedArrayに置き換えた構造を作る。ndarrayはarraysに追加していく。"""
+    if isinstance(value, tuple):
+        return tuple(_make_cache_entry(v, arrays, offset) for v in value)
+    elif isinstance(value, list):
+        return [_make_cache_entry(v, arrays, offset) for v in value]
+    elif isinstance(value, dict):
+        return {k: _make_cache_entry(v, arrays, offset) for k, v in value.items()}
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        value = np.ascontiguousarray(value)
+        offset += sum(a.nbytes for a in arrays)
+        arrays.append(value)
+        return _CachedArray(offset, value.shape, value.dtype.str)
+    return value
+
+
+def _restore_cache_entry(mm: typing.Optional[np.memmap], entry):
+    """_make_cache_entryの逆変換。"""
+    if isinstance(entry, tuple):
+        return tuple(_restore_cache_entry(mm, e) for e in entry)
+    elif isinstance(entry, list):
+        return [_restore_cache_entry(mm, e) for e in entry]
+    elif isinstance(entry, dict):
+        return {k: _restore_cache_entry(mm, e) for k, e in entry.items()}
+    elif isinstance(entry, _CachedArray):
+        assert mm is not None
+        # memory-mapのままだと後続の処理で書き換えられないのでコピーする
+        a = mm[entry.offset : entry.end].view(np.dtype(entry.dtype))
+        return a.reshape(entry.shape).copy()
+    return entry
+
+
+def _get_cache_end(entry) -> int:
+    """エントリが参照するデータファイル内の終了位置を返す。"""
+    if isinstance(entry, (tuple, list)):
+        return max([_get_cache_end(e) for e in entry], default=0)
+    elif isinstance(entry, dict):
+        return max([_get_cache_end(e) for e in entry.values()], default=0)
+    elif isinstance(entry, _CachedArray):
+        return entry.end
+    return 0
+
+
+def write_records(
+    dataset: Dataset,
+    output_dir: tk.typing.PathLike,
+    shard_size: int = 2 ** 30,
+    use_tqdm: bool = True,
+) -> None:
+    """Datasetを大きなシャードファイル群にまとめて保存する。(RecordDataset.openで読み込む)
+
+    dataset.dataの各要素は、ファイルパスならファイルの中身(エンコード済みのバイト列)を、
+    ndarrayならその生データを保存する。(.npy/.npzのファイルは読み込んで生データとして保存)
+    labelsなどその他の値はインデックスファイルにそのまま保存する。
+
+    Args:
+        dataset: 保存するデータセット
+        output_dir: 保存先ディレクトリ
+        shard_size: 1シャードあたりの最大サイズ(バイト数)の目安
+        use_tqdm: tqdmを使用するか否か
+
+    """
+    output_dir = pathlib.Path(output_dir)
+    if tk.hvd.is_master():
+        output_dir.mkdir(parents=True, exist_ok=True)
+        shard_ids = np.zeros((len(dataset),), dtype=np.int32)
+        offsets = np.zeros((len(dataset),), dtype=np.int64)
+        sizes = np.zeros((len(dataset),), dtype=np.int64)
+        # 生データならshapeとdtype、エンコード済みならNone
+        array_infos: typing.List[typing.Optional[typing.Tuple[tuple, str]]] = []
+        shard_id, offset = 0, 0
+        f = (output_dir / _record_shard_name(shard_id)).open("wb")
+        try:
+            for i in tk.utils.tqdm(
+                range(len(dataset)), desc="write_records", disable=not use_tqdm
+            ):
+                buf, array_info = _encode_record(dataset.data[i])
+                if offset > 0 and offset + len(buf) > shard_size:
+                    f.close()
+                    shard_id, offset = shard_id + 1, 0
+                    f = (output_dir / _record_shard_name(shard_id)).open("wb")
+                f.write(buf)
+                shard_ids[i], offsets[i], sizes[i] = shard_id, offset, len(buf)
+                array_infos.append(array_info)
+                offset += len(buf)
+        finally:
+            f.close()
+        tk.utils.dump(
+            {
+                "num_shards": shard_id + 1,
+                "shard_ids": shard_ids,
+                "offsets": offsets,
+                "sizes": sizes,
+                "array_infos": array_infos,
+                "labels": dataset.labels,
+                "groups": dataset.groups,
+                "weights": dataset.weights,
+                "ids": dataset.ids,
+                "init_score": dataset.init_score,
+                "metadata": dataset.metadata,
+            },
+            output_dir / "index.pkl",
+        )
+    tk.hvd.barrier()
+
+
+def _record_shard_name(shard_id: int) -> str:
+    return f"shard{shard_id:05d}.bin"
+
+
+def _encode_record(x) -> typing.Tuple[bytes, typing.Optional[typing.Tuple[tuple, str]]]:
+    """write_records用に1件分をバイト列にする。"""
+    if isinstance(x, (str, pathlib.Path)):
+        if pathlib.Path(x).suffix.lower() in (".npy", ".npz"):
+            x = tk.ndimage.load(x)
+        else:
+            return pathlib.Path(x).read_bytes(), None
+    x = np.ascontiguousarray(x)
+    assert x.dtype != object, f"Unsupported data: {type(x)}"
+    return x.tobytes(), (x.shape, x.dtype.str)
+
+
+class RecordArray:
+    """write_recordsで保存したシャードファイル群をmemory-mapで参照する配列もどき。
+
+    要素はエンコード済みのデータならio.BytesIO (tk.ndimage.loadでそのまま読める)、
+    生データならndarrayとして返す。ndarrayでインデックスを指定するとサブセットを返す。
+
+    Args:
+        records_dir: write_recordsの保存先ディレクトリ
+        index: インデックスファイルの内容
+        rindex: 参照する要素のインデックスの配列 (Noneなら全体)
+
+    """
+
+    def __init__(
+        self,
+        records_dir: pathlib.Path,
+        index: typing.Dict[str, typing.Any],
+        rindex: np.ndarray = None,
+    ):
+        self.records_dir = records_dir
+        self.index = index
+        self.rindex = (
+            np.arange(len(index["offsets"])) if rindex is None else np.asarray(rindex)
+        )
+        self._mmaps: typing.Dict[int, np.memmap] = {}
+
+    def __getstate__(self):
+        # memory-mapはpickleせず、プロセスごとに開き直す
+        state = self.__dict__.copy()
+        state["_mmaps"] = {}
+        return state
+
+    def __len__(self) -> int:
+        return len(self.rindex)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or np.ndim(index) > 0:
+            return RecordArray(self.records_dir, self.index, self.rindex[index])
+        i = self.rindex[index]
+        shard_id = int(self.index["shard_ids"][i])
+        mm = self._mmaps.get(shard_id)
+        if mm is None:
+            mm = np.memmap(
+                self.records_dir / _record_shard_name(shard_id), dtype=np.uint8, mode="r"
+            )
+            self._mmaps[shard_id] = mm
+        offset = int(self.index["offsets"][i])
+        buf = mm[offset : offset + int(self.index["sizes"][i])]
+        array_info = self.index["array_infos"][i]
+        if array_info is None:
+            return io.BytesIO(buf.tobytes())
+        shape, dtype = array_info
+        return np.array(buf.view(np.dtype(dtype)).reshape(shape))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def copy(self) -> RecordArray:
+        """コピーを作成して返す。(ファイルは共有)"""
+        return RecordArray(self.records_dir, self.index, self.rindex.copy())
+
+
+@dataclasses.dataclass()
+class RecordDataset(Dataset):
+    """write_recordsで保存したデータを読み込むDataset。
+
+    dataはRecordArrayで、get_dataのたびにmemory-mapから1件分だけ読み込む。
+    (open()やstat()の呼び出しは発生しない)
+
+    """
+
+    @classmethod
+    def open(cls, records_dir: tk.typing.PathLike) -> RecordDataset:
+        """write_recordsで保存したデータを開く。"""
+        records_dir = pathlib.Path(records_dir)
+        index = tk.utils.load(records_dir / "index.pkl")
+        return cls(
+            data=RecordArray(records_dir, index),
+            labels=index["labels"],
+            groups=index["groups"],
+            weights=index["weights"],
+            ids=index["ids"],
+            init_score=index["init_score"],
+            metadata=index["metadata"],
         )
-    elif isinstance(exsample_data, dict):
-        assert len(exsample_data) == len(data), f"{exsample_data=} {data=}"
-        return {k: _unflatten(v, d) for (k, v), d in zip(exsample_data.items(), data)}
-    else:
-        if isinstance(data, (tuple, list)):
-            assert len(data) == 1, f"{exsample_data=} {data=}"
-            data = data[0]
-        return np.asarray(data, dtype=exsample_data.dtype)
 
 
-def _unflatten_tensor(exsample_data, tensor):
-    """numpyのサンプルデータに従いtf.ensure_shapeする。"""
+def _is_batchable(d) -> bool:
+    """Dataset.get_batchで一括スライスできる値か否かを返す。"""
+    if isinstance(d, dict):
+        return all(_is_batchable(v) for v in d.values())
+    elif isinstance(d, list):
+        return all(_is_batchable(v) for v in d)
+    elif isinstance(d, pd.DataFrame):
+        return all(dtype != object for dtype in d.dtypes)
+    return isinstance(d, np.ndarray) and d.dtype != object
+
+
+def _get_schema_key(dataset: Dataset) -> typing.Tuple[typing.Any, ...]:
+    """DataLoader.get_output_signatureのキャッシュのキーを返す。"""
+    if isinstance(dataset, DatasetView) and len(dataset) > 0:
+        dataset = dataset.resolve(0)[0]
+    return (
+        type(dataset),
+        _get_field_signature(dataset.data),
+        _get_field_signature(dataset.labels),
+    )
+
+
+def _get_field_signature(d) -> typing.Any:
+    """Dataset.dataなどの型を表すhash可能な値を返す。"""
+    if d is None:
+        return None
+    elif isinstance(d, dict):
+        return tuple((k, _get_field_signature(v)) for k, v in d.items())
+    elif isinstance(d, list):
+        return tuple(_get_field_signature(v) for v in d)
+    elif isinstance(d, np.ndarray):
+        return ("ndarray", d.dtype.str, d.shape[1:])
+    elif isinstance(d, pd.DataFrame):
+        return ("DataFrame", tuple(d.columns), tuple(str(t) for t in d.dtypes))
+    return type(d).__name__
+
+
+def _spec_from_exsample(exsample_data) -> typing.Any:
+    """numpyのサンプルデータからtf.TensorSpecの構造を作る。(shapeは全部None)"""
     if exsample_data is None:
-        return tf.ensure_shape(tensor, ())  # dummy
+        return tf.TensorSpec((), tf.int32)  # dummy
     elif isinstance(exsample_data, tuple):
-        if len(exsample_data) == len(tensor):
-            return tuple(_unflatten_tensor(v, t) for v, t in zip(exsample_data, tensor))
-        else:
-            # tf.numpy_functionがdict未対応なので展開しているのでここで戻す
-            assert len(exsample_data) == 2, f"{exsample_data=} {tensor=}"
-            if isinstance(exsample_data[0], (tuple, list, dict)):
-                len1 = len(exsample_data[0])
-                X = _unflatten_tensor(exsample_data[0], tensor[:len1])
-            else:
-                len1 = 1
-                X = _unflatten_tensor(exsample_data[0], tensor[0])
-            if isinstance(exsample_data[1], (tuple, list, dict)):
-                len2 = len(exsample_data[1])
-                y = _unflatten_tensor(exsample_data[1], tensor[len1:])
-            else:
-                len2 = 1
-                y = _unflatten_tensor(exsample_data[1], tensor[len1])
-            assert len1 + len2 == len(tensor), f"{exsample_data=} {tensor=}"
-            return X, y
+        return tuple(_spec_from_exsample(v) for v in exsample_data)
     elif isinstance(exsample_data, list):
-        assert len(exsample_data) == len(tensor), f"{exsample_data=} {tensor=}"
-        return [_unflatten_tensor(v, t) for v, t in zip(exsample_data, tensor)]
+        return [_spec_from_exsample(v) for v in exsample_data]
     elif isinstance(exsample_data, dict):
-        # tf.numpy_functionがdict未対応なのでtensorはlistになっている
-        assert len(exsample_data) == len(tensor), f"{exsample_data=} {tensor=}"
-        return {
-            k: _unflatten_tensor(v, t)
-            for (k, v), t in zip(exsample_data.items(), tensor)
-        }
-    else:
-        return tf.ensure_shape(tensor, [None] * exsample_data.ndim)
+        return {k: _spec_from_exsample(v) for k, v in exsample_data.items()}
+    exsample_data = np.asarray(exsample_data)
+    return tf.TensorSpec(
+        [None] * exsample_data.ndim, tf.dtypes.as_dtype(exsample_data.dtype)
+    )
+
+
+def _normalize_spec(spec) -> typing.Any:
+    """output_signatureのNoneをダミーのtf.TensorSpecにする。"""
+    if spec is None:
+        return tf.TensorSpec((), tf.int32)  # dummy
+    elif isinstance(spec, tuple):
+        return tuple(_normalize_spec(v) for v in spec)
+    elif isinstance(spec, list):
+        return [_normalize_spec(v) for v in spec]
+    elif isinstance(spec, dict):
+        return {k: _normalize_spec(v) for k, v in spec.items()}
+    assert isinstance(spec, tf.TensorSpec), f"Invalid output_signature: {spec}"
+    return spec
+
+
+def _batch_spec(spec, batch_size: typing.Optional[int]) -> typing.Any:
+    """サンプルのtf.TensorSpecにバッチの次元を追加する。"""
+    if isinstance(spec, tuple):
+        return tuple(_batch_spec(v, batch_size) for v in spec)
+    elif isinstance(spec, list):
+        return [_batch_spec(v, batch_size) for v in spec]
+    elif isinstance(spec, dict):
+        return {k: _batch_spec(v, batch_size) for k, v in spec.items()}
+    return tf.TensorSpec([batch_size] + spec.shape.as_list(), spec.dtype)
+
+
+def _unbatch_spec(spec) -> typing.Any:
+    """_batch_specの逆変換。"""
+    if isinstance(spec, tuple):
+        return tuple(_unbatch_spec(v) for v in spec)
+    elif isinstance(spec, list):
+        return [_unbatch_spec(v) for v in spec]
+    elif isinstance(spec, dict):
+        return {k: _unbatch_spec(v) for k, v in spec.items()}
+    return tf.TensorSpec(spec.shape[1:], spec.dtype)
+
+
+def _flatten_specs(spec) -> typing.List[tf.TensorSpec]:
+    """tf.TensorSpecの構造を1次元リストにする。"""
+    if isinstance(spec, (tuple, list)):
+        return sum([_flatten_specs(v) for v in spec], [])
+    elif isinstance(spec, dict):
+        return sum([_flatten_specs(v) for v in spec.values()], [])
+    return [spec]
+
+
+def _get_tf_types(spec) -> typing.List[tf.dtypes.DType]:
+    """tf.TensorSpecの構造からtf.dtypesの1次元リストを返す。"""
+    return [s.dtype for s in _flatten_specs(spec)]
+
+
+def _flatten_spec(spec, data) -> typing.List[np.ndarray]:
+    """specに従ってdataを1次元リストにする。
+
+    tf.numpy_functionがNoneやdict未対応なので、Noneは0に、dictはspecの並び順でlistにする。
+    dtypeもspecに合わせる。
+
+    """
+    if isinstance(spec, (tuple, list)):
+        assert isinstance(data, (tuple, list)), f"{spec=} {data=}"
+        assert len(spec) == len(data), f"{spec=} {data=}"
+        return sum([_flatten_spec(s, d) for s, d in zip(spec, data)], [])
+    elif isinstance(spec, dict):
+        assert isinstance(data, dict), f"{spec=} {data=}"
+        return sum([_flatten_spec(s, data[k]) for k, s in spec.items()], [])
+    if data is None:
+        data = 0
+    return [np.asarray(data, dtype=spec.dtype.as_numpy_dtype)]
+
+
+def _unflatten_tensor(spec, tensor):
+    """1次元リストのtensorをspecに従って戻し、静的なshapeを設定する。"""
+    tensor = list(tensor)
+    result = _unflatten_tensor_impl(spec, tensor)
+    assert len(tensor) == 0, f"{spec=} {tensor=}"
+    return result
+
+
+def _unflatten_tensor_impl(spec, tensor: typing.List[tf.Tensor]):
+    if isinstance(spec, tuple):
+        return tuple(_unflatten_tensor_impl(v, tensor) for v in spec)
+    elif isinstance(spec, list):
+        return [_unflatten_tensor_impl(v, tensor) for v in spec]
+    elif isinstance(spec, dict):
+        return {k: _unflatten_tensor_impl(v, tensor) for k, v in spec.items()}
+    t = tensor.pop(0)
+    # tf.ensure_shapeと違い実行時のチェックはしない
+    t.set_shape(spec.shape)
+    return t
 
 
 @dataclasses.dataclass()
@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import pytest
 
 import pytoolkit as tk
@@ -76,3 +77,417 @@ def test_data_loader_dict_and_none(data_per_sample):
         assert X_batch["a"].numpy() == pytest.approx(np.array([0, 0]))
         assert X_batch["b"].numpy() == pytest.approx(np.array([[0, 0], [0, 0]]))
     assert y_batch.numpy() == pytest.approx(np.array([0, 0]))
+
+
+def test_data_loader_batch():
+    """get_batchのケース"""
+
+    class MyDataLoader(tk.data.DataLoader):
+        def get_batch(self, dataset, indices):
+            X_batch, y_batch = dataset.get_batch(indices)
+            return {"x": X_batch * 2, "x2": X_batch}, y_batch
+
+    dataset = tk.data.Dataset(data=np.arange(3), labels=np.arange(4, 7))
+    data_loader = MyDataLoader(batch_size=2)
+    assert data_loader.use_batch_mode(dataset)
+    assert tk.data.DataLoader().use_batch_mode(dataset)
+    ds, steps = data_loader.get_ds(dataset, shuffle=False)
+    assert steps == 2
+    g = iter(ds)
+
+    X_batch, y_batch = next(g)
+    assert X_batch["x"].numpy() == pytest.approx(np.array([0, 2]))
+    assert X_batch["x2"].numpy() == pytest.approx(np.array([0, 1]))
+    assert y_batch.numpy() == pytest.approx(np.array([4, 5]))
+
+    X_batch, y_batch = next(g)
+    assert X_batch["x"].numpy() == pytest.approx(np.array([4]))
+    assert y_batch.numpy() == pytest.approx(np.array([6]))
+
+    with pytest.raises(StopIteration):
+        next(g)
+
+
+def test_decode_cache(data_dir, tmpdir):
+    decode_count = 0
+
+    class MyDataLoader(tk.data.DataLoader):
+        def decode(self, dataset, index):
+            nonlocal decode_count
+            decode_count += 1
+            X, y = dataset.get_data(index)
+            return tk.ndimage.load(X), y
+
+    dataset = tk.data.Dataset(
+        data=np.array([data_dir / "Lenna.png", data_dir / "cifar.png"]),
+        labels=np.array([0, 1]),
+    )
+    cache_dir = str(tmpdir / "cache")
+    data_loader = MyDataLoader(
+        decode_cache=tk.data.DecodeCache(cache_dir, num_shards=2, long_side=64)
+    )
+    X1, y1 = data_loader.get_data(dataset, 0)
+    X2, y2 = data_loader.get_data(dataset, 0)
+    assert decode_count == 1
+    assert max(X1.shape[:2]) <= 64
+    assert (X1 == X2).all() and y1 == y2 == 0
+
+    # 別のfold(スライス)や再起動後でもキャッシュが効く
+    data_loader = MyDataLoader(decode_cache=tk.data.DecodeCache(cache_dir, num_shards=2))
+    X3, _ = data_loader.get_data(dataset.slice([1, 0]), 1)
+    assert decode_count == 1
+    assert (X1 == X3).all()
+
+
+def test_decode_cache_multiprocess(tmpdir):
+    """複数プロセスから同じシャードに追記しても壊れないこと"""
+    import multiprocessing
+
+    cache_dir = str(tmpdir / "cache")
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        pool.starmap(_put_decode_cache, [(cache_dir, p) for p in range(4)])
+
+    cache = tk.data.DecodeCache(cache_dir, num_shards=2)
+    assert len(cache) == 4 * 16
+    for p in range(4):
+        for i in range(16):
+            value = cache.get(f"{p}-{i}", lambda: pytest.fail("not cached"))
+            assert (value == np.full((i + 1, 3), p * 100 + i)).all()
+
+
+def _put_decode_cache(cache_dir, p):
+    cache = tk.data.DecodeCache(cache_dir, num_shards=2)
+    for i in range(16):
+        cache.get(f"{p}-{i}", lambda i=i: np.full((i + 1, 3), p * 100 + i))
+
+
+class _ProcessDataLoader(tk.data.DataLoader):
+    """test_data_loader_process用。(ワーカープロセスに渡すのでモジュールレベルで定義する)"""
+
+    def get_data(self, dataset, index):
+        X, y = dataset.get_data(index)
+        return {"a": X * 2, "b": np.full((2,), X)}, y
+
+
+def test_data_loader_process():
+    """parallel="process"のケース"""
+    dataset = tk.data.Dataset(data=np.arange(5), labels=np.arange(5, 10))
+    with _ProcessDataLoader(
+        batch_size=2, parallel="process", num_workers=2, collect_stats=True
+    ) as data_loader:
+        ds, steps = data_loader.get_ds(dataset, shuffle=False)
+        assert steps == 3
+        for _ in range(2):  # 2epoch目はプールを使い回す
+            batches = list(ds)
+            assert len(batches) == 3
+            X_batch, y_batch = batches[0]
+            assert X_batch["a"].numpy() == pytest.approx(np.array([0, 2]))
+            assert X_batch["b"].numpy() == pytest.approx(np.array([[0, 0], [1, 1]]))
+            assert y_batch.numpy() == pytest.approx(np.array([5, 6]))
+            X_batch, y_batch = batches[2]
+            assert X_batch["a"].numpy() == pytest.approx(np.array([8]))
+            assert y_batch.numpy() == pytest.approx(np.array([9]))
+        # ワーカープロセス内の処理時間も集計される
+        stats = [s for s in tk.data.collect_stats() if s.name == "_ProcessDataLoader"]
+        assert stats[0].snapshot()["stages"]["get_data"]["count"] == 10
+
+        # 別のget_dsでも同じプールを使う
+        pool = data_loader._process_pool  # pylint: disable=protected-access
+        ds, steps = data_loader.get_ds(dataset.slice([4, 3]), shuffle=False)
+        assert data_loader._process_pool is pool  # pylint: disable=protected-access
+        X_batch, _ = next(iter(ds))
+        assert X_batch["a"].numpy() == pytest.approx(np.array([8, 6]))
+    assert data_loader._process_pool is None  # pylint: disable=protected-access
+
+
+def test_dataset_view():
+    dataset = tk.data.Dataset(
+        data=np.arange(10).reshape(5, 2), labels=np.arange(5), weights=np.ones(5)
+    )
+    view = dataset.view([3, 1, 4])
+    assert len(view) == 3
+    assert view.get_data(0)[0] == pytest.approx(np.array([6, 7]))
+    assert view.get_batch(np.array([1, 2]))[1] == pytest.approx(np.array([1, 4]))
+    assert view.labels == pytest.approx(np.array([3, 1, 4]))
+    # スライスはキャッシュし、親の値が差し替えられたら作り直す
+    assert view.labels is view.labels
+    view_labels = view.labels
+    dataset.labels = np.arange(5) * 2
+    assert view.labels == pytest.approx(np.array([6, 2, 8]))
+    dataset.labels = np.arange(5)
+    assert view.labels is not view_labels
+    dataset.labels[3] = 30
+    view.invalidate_cache()
+    assert view.labels == pytest.approx(np.array([30, 1, 4]))
+    dataset.labels[3] = 3
+    view.invalidate_cache()
+
+    view2 = view.view(np.array([False, True, True]))
+    assert view2.parent is dataset
+    assert view2.labels == pytest.approx(np.array([1, 4]))
+    assert tk.data.DataLoader().use_batch_mode(view2)
+
+    # 代入はビュー側で保持する
+    view3 = view.copy(deep=False)
+    view3.data = view3.data * 10
+    assert view3.get_data(1) == (pytest.approx(np.array([20, 30])), 1)
+    assert view.get_data(1)[0] == pytest.approx(np.array([2, 3]))
+    assert (dataset.data[1] == [2, 3]).all()
+
+    assert [len(b) for b in view.iter_batches(2)] == [2, 1]
+    for (t1, v1), (t2, v2) in zip(
+        dataset.iter([([0, 1], [2])], view=True), dataset.iter([([0, 1], [2])])
+    ):
+        assert isinstance(t1, tk.data.DatasetView)
+        assert (t1.data == t2.data).all() and (v1.labels == v2.labels).all()
+
+
+def test_dataset_dataframe():
+    df = pd.DataFrame(
+        {
+            "a": np.arange(4, dtype=np.int32),
+            "b": np.linspace(0, 1, 4),
+            "c": pd.Categorical(["x", "y", "x", "z"]),
+            "d": np.arange(4, dtype=np.int32) * 2,
+        }
+    )
+    dataset = tk.data.Dataset(data=df, labels=np.arange(4))
+    for i in range(4):
+        X, y = dataset.get_data(i)
+        assert X.dtype == df.values.dtype
+        assert list(X) == list(df.values[i])
+        assert y == i
+    X_batch, _ = dataset.get_batch(np.array([3, 1]))
+    assert X_batch.tolist() == df.values[[3, 1]].tolist()
+
+    # 代入でキャッシュが破棄される
+    dataset.data = df[["a", "d"]].copy()
+    X, _ = dataset.get_data(2)
+    assert X.dtype == np.int32
+    assert X.tolist() == [2, 4]
+
+    # 列の追加は自動的に検出する
+    dataset.data["e"] = np.arange(4, dtype=np.int32) * 3
+    assert dataset.get_data(2)[0].tolist() == [2, 4, 6]
+    # 値の書き換えはinvalidate_cacheが必要
+    dataset.data.loc[2, "a"] = 20
+    dataset.invalidate_cache()
+    assert dataset.get_data(2)[0].tolist() == [20, 4, 6]
+
+
+def test_records(data_dir, tmpdir):
+    paths = [data_dir / "Lenna.png", data_dir / "cifar.png", data_dir / "Lenna.png"]
+    dataset = tk.data.Dataset(
+        data=np.array(paths), labels=np.array([0, 1, 2]), metadata={"a": 1}
+    )
+    tk.data.write_records(dataset, str(tmpdir), shard_size=1, use_tqdm=False)
+
+    loaded = tk.data.RecordDataset.open(str(tmpdir))
+    assert len(loaded) == 3
+    assert loaded.metadata == {"a": 1}
+    for i, path in enumerate(paths):
+        X, y = loaded.get_data(i)
+        assert (tk.ndimage.load(X) == tk.ndimage.load(path)).all()
+        assert y == i
+
+    sliced = loaded.slice([2, 1])
+    assert isinstance(sliced, tk.data.RecordDataset)
+    X, y = sliced.get_data(1)
+    assert (tk.ndimage.load(X) == tk.ndimage.load(paths[1])).all()
+    assert y == 1
+
+    # 生データ
+    dataset = tk.data.Dataset(data=np.arange(12).reshape(3, 2, 2))
+    tk.data.write_records(dataset, str(tmpdir / "raw"), use_tqdm=False)
+    loaded = tk.data.RecordDataset.open(str(tmpdir / "raw"))
+    assert (loaded.get_data(1)[0] == dataset.data[1]).all()
+
+
+def test_data_loader_output_signature():
+    """output_signatureを指定したケース"""
+    import tensorflow as tf
+
+    get_data_count = 0
+
+    class MyDataLoader(tk.data.DataLoader):
+        def get_data(self, dataset, index):
+            nonlocal get_data_count
+            get_data_count += 1
+            X, y = dataset.get_data(index)
+            return {"a": np.full((3,), X), "b": np.float32(X)}, y
+
+    dataset = tk.data.Dataset(data=np.arange(5), labels=np.arange(5, 10))
+    data_loader = MyDataLoader(
+        batch_size=2,
+        output_signature=(
+            {
+                "a": tf.TensorSpec((3,), tf.float32),
+                "b": tf.TensorSpec((), tf.float32),
+            },
+            tf.TensorSpec((), tf.int32),
+        ),
+    )
+    ds, steps = data_loader.get_ds(dataset, shuffle=True)
+    assert steps == 3
+    assert get_data_count == 0  # 型の推定のための読み込みをしない
+    X_spec, y_spec = ds.element_spec
+    assert X_spec["a"].shape.as_list() == [2, 3]
+    assert X_spec["a"].dtype == tf.float32
+    assert y_spec.shape.as_list() == [2]
+    X_batch, y_batch = next(iter(ds))
+    assert X_batch["a"].numpy().shape == (2, 3)
+    assert (X_batch["a"].numpy()[:, 0] + 5 == y_batch.numpy()).all()
+
+    # 未指定なら1回だけ推定してキャッシュする
+    get_data_count = 0
+    data_loader = MyDataLoader(batch_size=2)
+    data_loader.get_ds(dataset)
+    data_loader.get_ds(dataset.slice([0, 1]))
+    assert get_data_count == 1
+
+
+def test_data_loader_buckets():
+    """bucketsのケース"""
+    shapes = [(32, 64), (64, 32), (30, 62), (66, 30), (33, 63)]
+    data = np.empty(len(shapes), dtype=object)
+    data[:] = [np.zeros(shape + (3,), dtype=np.uint8) for shape in shapes]
+    dataset = tk.data.Dataset(data=data, labels=np.arange(len(shapes)))
+    data_loader = tk.data.DataLoader(batch_size=2, buckets=[(16, 32), (32, 16)])
+    assert data_loader.get_bucket_ids(dataset).tolist() == [0, 1, 0, 1, 0]
+
+    # シャッフルしない場合は順番を維持する
+    ds, steps = data_loader.get_ds(dataset, shuffle=False)
+    assert steps == 5
+    batches = list(ds)
+    assert [tuple(X.shape) for X, _ in batches] == [
+        (1, 16, 32, 3),
+        (1, 32, 16, 3),
+        (1, 16, 32, 3),
+        (1, 32, 16, 3),
+        (1, 16, 32, 3),
+    ]
+    assert np.concatenate([y.numpy() for _, y in batches]).tolist() == [0, 1, 2, 3, 4]
+
+    # シャッフルする場合はバケットごとにバッチを作る
+    ds, steps = data_loader.get_ds(dataset, shuffle=True)
+    assert steps == 3
+    for X_batch, y_batch in ds.take(6):
+        assert tuple(X_batch.shape[1:]) in ((16, 32, 3), (32, 16, 3))
+        bucket = 0 if X_batch.shape[1] == 16 else 1
+        assert all(y % 2 == bucket for y in y_batch.numpy())
+
+
+def test_data_loader_graph_fn_color():
+    """チャンネル数が静的に不明な(シグネチャを推定した)場合も色の変換が効く"""
+
+    class MyDataLoader(tk.data.DataLoader):
+        def get_data(self, dataset, index):
+            return dataset.get_data(index)
+
+    X = np.tile(np.array([10, 100, 200], dtype=np.float32), (4, 8, 8, 1))
+    dataset = tk.data.Dataset(data=X, labels=np.arange(4))
+    for aug in [
+        tk.tfimage.RandomSaturation(p=1),
+        tk.tfimage.RandomHue(p=1),
+        tk.tfimage.RandomColorAugmentors(),
+    ]:
+        data_loader = MyDataLoader(
+            batch_size=2,
+            sample_graph_fn=lambda X, y, seed, aug=aug: (aug(X, seed), y),
+        )
+        ds, _ = data_loader.get_ds(dataset, shuffle=True)
+        X_batch, _ = next(iter(ds))
+        assert X_batch.shape == (2, 8, 8, 3)
+        if not isinstance(aug, tk.tfimage.RandomColorAugmentors):
+            assert not np.allclose(X_batch.numpy(), X[:2])
+
+
+def test_data_loader_graph_fn_resize():
+    """サンプル単位で読み込む場合はバッチにする前にsample_graph_fnを適用する"""
+
+    class MyDataLoader(tk.data.DataLoader):
+        def get_data(self, dataset, index):
+            size = dataset.data[index]
+            return np.zeros((size, size * 2, 3), dtype=np.uint8), index
+
+    dataset = tk.data.Dataset(data=np.array([8, 16, 12, 20, 10]), labels=np.arange(5))
+    aug = tk.tfimage.RandomTransform(size=(8, 8))
+    data_loader = MyDataLoader(
+        batch_size=2, sample_graph_fn=lambda X, y, seed: (aug(X, seed), y)
+    )
+    ds, steps = data_loader.get_ds(dataset, shuffle=False)
+    batches = list(ds)
+    assert len(batches) == steps == 3
+    assert [tuple(X.shape) for X, _ in batches] == [(2, 8, 8, 3)] * 2 + [(1, 8, 8, 3)]
+    assert np.concatenate([y.numpy() for _, y in batches]).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_pipeline_stats():
+    class MyDataLoader(tk.data.DataLoader):
+        def get_data(self, dataset, index):
+            return dataset.get_data(index)
+
+    dataset = tk.data.Dataset(data=np.arange(5), labels=np.arange(5, 10))
+    data_loader = MyDataLoader(batch_size=2, collect_stats=True)
+    ds, _ = data_loader.get_ds(dataset, shuffle=False)
+    assert len(list(ds)) == 3
+
+    snapshot = data_loader.stats.snapshot()
+    assert snapshot["stages"]["get_data"]["count"] == 5
+    assert snapshot["stages"]["get_sample"]["count"] == 5
+    assert snapshot["steps"] == 3
+    assert 0 <= snapshot["starvation"] <= 1
+    assert "get_data=" in data_loader.stats.format()
+
+    stats_list = tk.data.collect_stats(reset=True)
+    assert any(s.name == "MyDataLoader" for s in stats_list)
+    assert data_loader.stats.snapshot()["steps"] == 0
+
+    # 既定では何も記録しない
+    data_loader = MyDataLoader(batch_size=2)
+    ds, _ = data_loader.get_ds(dataset, shuffle=False)
+    assert len(list(ds)) == 3
+    assert data_loader.stats.snapshot() == {"stages": {}, "steps": 0, "starvation": 0}
+
+
+def test_samplers():
+    table = tk.data.AliasTable(np.array([1.0, 0.0, 3.0]))
+    counts = np.bincount(table.sample(40000), minlength=3)
+    assert counts[1] == 0
+    assert counts[2] / counts[0] == pytest.approx(3, rel=0.1)
+
+    # テーブルが表す分布が重みに一致する
+    weights = np.random.RandomState(0).exponential(size=1000) ** 3
+    weights[::7] = 0
+    table = tk.data.AliasTable(weights)
+    p = table.prob + np.bincount(table.alias, weights=1 - table.prob, minlength=1000)
+    assert p / 1000 == pytest.approx(weights / weights.sum(), abs=1e-9)
+    assert ((table.prob >= 0) & (table.prob <= 1)).all()
+
+    labels = np.array([0] * 90 + [1] * 10)
+    dataset = tk.data.Dataset(data=np.arange(100), labels=labels)
+    indices = tk.data.BalancedSampler(num_samples=20000).sample(dataset)
+    assert len(indices) == 20000
+    assert labels[indices].mean() == pytest.approx(0.5, abs=0.03)
+
+    dataset.weights = np.where(np.arange(100) < 50, 0.0, 1.0)
+    indices = tk.data.WeightedSampler().sample(dataset)
+    assert len(indices) == 100 and (indices >= 50).all()
+
+    # foldごとのDatasetViewで重みが変わればテーブルも作り直す
+    sampler = tk.data.WeightedSampler(num_samples=1000)
+    folds = [(np.arange(25, 75), None), (np.arange(40, 90), None)]
+    indices_list = [sampler.sample(dataset.view(rindex)) for rindex, _ in folds]
+    assert (indices_list[0] >= 25).all()
+    assert (indices_list[1] >= 10).all() and (indices_list[1] < 25).any()
+
+    assert sorted(tk.data.Sampler().sample(dataset)) == list(range(100))
+
+    dataset.weights = None
+    data_loader = tk.data.DataLoader(
+        batch_size=10, sampler=tk.data.BalancedSampler(num_samples=50)
+    )
+    ds, steps = data_loader.get_ds(dataset, shuffle=True)
+    assert steps == 5
+    y = np.concatenate([y_batch.numpy() for _, y_batch in ds.take(100)])
+    assert y.mean() == pytest.approx(0.5, abs=0.05)
@@ -1,7 +1,9 @@
 """画像処理関連。"""
 from __future__ import annotations
 
+import collections
 import random
+import threading
 import typing
 import warnings
 
@@ -15,6 +17,10 @@ import tensorflow as tf
 import pytoolkit as tk
 
 
+# 画素ごとの変換をLUTにするための入力 (0～255の1x256の画像)
+_LUT_INPUT = np.arange(256, dtype=np.uint8).reshape((1, 256, 1))
+
+
 class RandomCompose(A.Compose):
     """シャッフル付きCompose。"""
 
@@ -167,30 +173,8 @@ class RandomTransform(A.DualTransform):
 
     def apply(self, image, m, interp=None, **params):
         # pylint: disable=arguments-differ
-        cv2_border, borderValue = {
-            "edge": (cv2.BORDER_REPLICATE, None),
-            "reflect": (cv2.BORDER_REFLECT_101, None),
-            "wrap": (cv2.BORDER_WRAP, None),
-            "zero": (cv2.BORDER_CONSTANT, [0, 0, 0]),
-            "half": (cv2.BORDER_CONSTANT, [127, 127, 127]),
-            "one": (cv2.BORDER_CONSTANT, [255, 255, 255]),
-        }[self.border_mode]
-
-        if interp == "nearest":
-            cv2_interp = cv2.INTER_NEAREST
-        else:
-            # 縮小ならINTER_AREA, 拡大ならINTER_LANCZOS4
-            sh, sw = image.shape[:2]
-            dr = cv2.perspectiveTransform(
-                np.array([(0, 0), (sw, 0), (sw, sh), (0, sh)])
-                .reshape((-1, 1, 2))
-                .astype(np.float32),
-                m,
-            ).reshape((4, 2))
-            dw = min(np.linalg.norm(dr[1] - dr[0]), np.linalg.norm(dr[2] - dr[3]))
-            dh = min(np.linalg.norm(dr[3] - dr[0]), np.linalg.norm(dr[2] - dr[1]))
-            cv2_interp = cv2.INTER_AREA if dw <= sw or dh <= sh else cv2.INTER_LANCZOS4
-
+        cv2_border, borderValue = self._get_cv2_border()
+        cv2_interp = self._get_cv2_interp(image.shape, m, interp)
         if image.ndim == 2 or image.shape[-1] in (1, 3):
             image = cv2.warpPerspective(
                 image,
@@ -203,20 +187,119 @@ class RandomTransform(A.DualTransform):
             if image.ndim == 2:
                 image = np.expand_dims(image, axis=-1)
         else:
-            resized_list = [
-                cv2.warpPerspective(
-                    image[:, :, ch],
+            borderValue4 = tk.ndimage.to_border_value4(borderValue)
+            image = tk.ndimage.apply_channel_groups(
+                image,
+                lambda x: cv2.warpPerspective(
+                    x,
                     m,
                     self.size[::-1],
                     flags=cv2_interp,
                     borderMode=cv2_border,
-                    borderValue=borderValue,
-                )
-                for ch in range(image.shape[-1])
-            ]
-            image = np.transpose(resized_list, (1, 2, 0))
+                    borderValue=borderValue4,
+                ),
+                self.size,
+            )
         return image
 
+    def _get_cv2_border(self):
+        return {
+            "edge": (cv2.BORDER_REPLICATE, None),
+            "reflect": (cv2.BORDER_REFLECT_101, None),
+            "wrap": (cv2.BORDER_WRAP, None),
+            "zero": (cv2.BORDER_CONSTANT, [0, 0, 0]),
+            "half": (cv2.BORDER_CONSTANT, [127, 127, 127]),
+            "one": (cv2.BORDER_CONSTANT, [255, 255, 255]),
+        }[self.border_mode]
+
+    def _get_cv2_interp(self, image_shape, m, interp=None) -> int:
+        if interp == "nearest":
+            return cv2.INTER_NEAREST
+        # 縮小ならINTER_AREA, 拡大ならINTER_LANCZOS4
+        sh, sw = image_shape[:2]
+        dr = cv2.perspectiveTransform(
+            np.array([(0, 0), (sw, 0), (sw, sh), (0, sh)])
+            .reshape((-1, 1, 2))
+            .astype(np.float32),
+            m,
+        ).reshape((4, 2))
+        dw = min(np.linalg.norm(dr[1] - dr[0]), np.linalg.norm(dr[2] - dr[3]))
+        dh = min(np.linalg.norm(dr[3] - dr[0]), np.linalg.norm(dr[2] - dr[1]))
+        return cv2.INTER_AREA if dw <= sw or dh <= sh else cv2.INTER_LANCZOS4
+
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。
+
+        パラメータはapplyと同じくサンプルごとに生成し、出力は事前に確保した配列に書き込む。
+        バッチを揃えるため、pで変換しないことになったサンプルもリサイズ(base_scale込み)だけは行う。
+
+        画像の変換(cv2.warpPerspective)自体はベクトル化せず、サンプルごとに呼び出す。
+        (変換行列と補間方法(縮小ならINTER_AREA、拡大ならINTER_LANCZOS4)がサンプルごとに異なり、
+        NumPyの座標計算でまとめて処理するとcv2より遅く、補間の品質もapplyと揃わないため)
+        このため画像の処理時間はapplyをループで呼ぶ場合とほぼ同じで、削減されるのはAlbumentationsの
+        呼び出しのオーバーヘッドと出力のコピーのみ。
+
+        Args:
+            images: 画像のバッチ。shape=(N, H, W, C)
+            masks: マスクのバッチ。shape=(N, H, W) or (N, H, W, C)
+            bboxes: サンプルごとのbounding box((物体数, 4)の[0, 1]の相対座標)のリスト
+
+        Returns:
+            images, masks, bboxesのdict (masks, bboxesは指定した場合のみ)
+
+        """
+        images = np.asarray(images)
+        batch_size = len(images)
+        enabled = _batch_enabled(self, batch_size)
+        out_images = np.empty(
+            (batch_size,) + tuple(self.size) + images.shape[3:], dtype=images.dtype
+        )
+        out_masks = (
+            None
+            if masks is None
+            else np.empty(
+                (batch_size,) + tuple(self.size) + masks.shape[3:], dtype=masks.dtype
+            )
+        )
+        out_bboxes = None if bboxes is None else []
+        for i in range(batch_size):
+            if enabled[i]:
+                m = self._make_matrix(images.shape[1:3], **self._get_random_params())
+            else:
+                m = self._make_matrix(images.shape[1:3], scale=self.base_scale)
+            out_images[i] = self.apply(images[i], m=m).reshape(out_images.shape[1:])
+            if out_masks is not None:
+                assert masks is not None
+                out_masks[i] = self.apply(masks[i], m=m, interp="nearest").reshape(
+                    out_masks.shape[1:]
+                )
+            if out_bboxes is not None:
+                assert bboxes is not None
+                out_bboxes.append(
+                    self._transform_bboxes(bboxes[i], m, images.shape[1:3])
+                )
+        return _batch_result(out_images, out_masks, out_bboxes)
+
+    def _transform_bboxes(self, bboxes, m, image_size) -> np.ndarray:
+        """apply_to_bboxのベクトル化版。"""
+        bboxes = np.asarray(bboxes, dtype=np.float32).reshape((-1, 4))
+        if len(bboxes) <= 0:
+            return bboxes
+        bboxes = bboxes * np.array([image_size[1], image_size[0]] * 2, dtype=np.float32)
+        bboxes = cv2.perspectiveTransform(bboxes.reshape((-1, 1, 2)), m)
+        bboxes = bboxes.reshape((-1, 4))
+        bboxes = np.concatenate(
+            [
+                np.minimum(bboxes[:, :2], bboxes[:, 2:]),
+                np.maximum(bboxes[:, :2], bboxes[:, 2:]),
+            ],
+            axis=-1,
+        )
+        bboxes /= np.array([self.size[1], self.size[0]] * 2, dtype=np.float32)
+        if self.clip_bboxes:
+            bboxes = np.clip(bboxes, 0, 1)
+        return bboxes
+
     def apply_to_bbox(self, bbox, m, image_size, **params):
         # pylint: disable=arguments-differ
         del params
@@ -252,6 +335,11 @@ class RandomTransform(A.DualTransform):
 
     def get_params_dependent_on_targets(self, params):
         image = params["image"]
+        m = self._make_matrix(image.shape[:2], **self._get_random_params())
+        return {"m": m, "image_size": image.shape[:2]}
+
+    def _get_random_params(self) -> typing.Dict[str, typing.Any]:
+        """_make_matrixのパラメータをランダムに生成する。(applyとapply_batchで共通)"""
         scale = (
             self.base_scale
             * np.exp(
@@ -272,8 +360,6 @@ class RandomTransform(A.DualTransform):
 
         flip_v = self.flip[0] and random.random() <= 0.5
         flip_h = self.flip[1] and random.random() <= 0.5
-        scale_v = scale / np.sqrt(ar)
-        scale_h = scale * np.sqrt(ar)
         degrees = (
             random.uniform(self.rotate_range[0], self.rotate_range[1])
             if random.random() <= self.rotate_prob
@@ -283,20 +369,48 @@ class RandomTransform(A.DualTransform):
         pos_h = random.uniform(0, 1)
         translate_v = random.uniform(-self.translate[0], self.translate[0])
         translate_h = random.uniform(-self.translate[1], self.translate[1])
+        return {
+            "scale": scale,
+            "ar": ar,
+            "flip_v": flip_v,
+            "flip_h": flip_h,
+            "degrees": degrees,
+            "pos_v": pos_v,
+            "pos_h": pos_h,
+            "translate_v": translate_v,
+            "translate_h": translate_h,
+        }
+
+    def _make_matrix(
+        self,
+        image_size: typing.Tuple[int, int],
+        scale: float = 1.0,
+        ar: float = 1.0,
+        flip_v: bool = False,
+        flip_h: bool = False,
+        degrees: float = 0.0,
+        pos_v: float = 0.5,
+        pos_h: float = 0.5,
+        translate_v: float = 0.0,
+        translate_h: float = 0.0,
+    ) -> np.ndarray:
+        """パラメータから変換行列を作る。(既定値ならリサイズのみ)"""
+        scale_v = scale / np.sqrt(ar)
+        scale_h = scale * np.sqrt(ar)
         # 左上から時計回りに座標を用意
         src_points = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32)
         if self.preserve_aspect:
             # アスペクト比を維持するように縮小する
-            if image.shape[0] < image.shape[1]:
+            if image_size[0] < image_size[1]:
                 # 横長
-                hr = image.shape[0] / image.shape[1]
+                hr = image_size[0] / image_size[1]
                 yr = (1 - hr) / 2
                 dst_points = np.array(
                     [[0, yr], [1, yr], [1, yr + hr], [0, yr + hr]], dtype=np.float32
                 )
             else:
                 # 縦長
-                wr = image.shape[1] / image.shape[0]
+                wr = image_size[1] / image_size[0]
                 xr = (1 - wr) / 2
                 dst_points = np.array(
                     [[xr, 0], [xr + wr, 0], [xr + wr, 1], [xr, 1]], dtype=np.float32
@@ -323,12 +437,13 @@ class RandomTransform(A.DualTransform):
         src_points[:, 0] -= (1 / scale_h - 1) * pos_h
         src_points[:, 1] -= (1 / scale_v - 1) * pos_v
         # 変換行列の作成
-        src_points[:, 0] *= image.shape[1]
-        src_points[:, 1] *= image.shape[0]
+        src_points[:, 0] *= image_size[1]
+        src_points[:, 1] *= image_size[0]
         dst_points[:, 0] *= self.size[1]
         dst_points[:, 1] *= self.size[0]
-        m = cv2.getPerspectiveTransform(src_points, dst_points)
-        return {"m": m, "image_size": image.shape[:2]}
+        return cv2.getPerspectiveTransform(
+            src_points.astype(np.float32), dst_points.astype(np.float32)
+        )
 
     @property
     def targets_as_params(self):
@@ -413,10 +528,15 @@ class RandomColorAugmentors(RandomCompose):
     Args:
         noisy: Trueを指定すると細かいノイズ系も有効になる。
         grayscale: RGBではなくグレースケールならTrue。
+        fused: 画素ごとの色変換(get_color_stageを持つもの)が連続する場合、
+               まとめて1パスで適用する。(tk.ndimage.apply_color_stages)
+               適用順や乱数の使い方は変わらないので、結果は(誤差を除き)Falseの場合と同じ。
 
     """
 
-    def __init__(self, noisy: bool = False, grayscale: bool = False, p=1):
+    def __init__(
+        self, noisy: bool = False, grayscale: bool = False, fused: bool = True, p=1
+    ):
         argumentors = [
             RandomBrightness(p=0.25),
             RandomContrast(p=0.25),
@@ -442,9 +562,50 @@ class RandomColorAugmentors(RandomCompose):
                 [A.ISONoise(color_shift=(0, 0.05), intensity=(0, 0.5), p=0.125)]
             )
         super().__init__(argumentors, p=p)
+        self.noisy = noisy
+        self.grayscale = grayscale
+        self.fused = fused
+
+    def __call__(self, force_apply=False, **data):
+        """変換の適用。"""
+        if not self.fused or "image" not in data:
+            return super().__call__(force_apply=force_apply, **data)
+
+        # RandomCompose/A.Composeと同じ順番で乱数を使う
+        transforms = list(self.transforms.transforms)
+        random.shuffle(transforms)
+        need_to_run = force_apply or random.random() < self.p
+        transforms = [t for t in transforms if need_to_run or t.always_apply]
+        stages: typing.List[typing.Tuple[str, typing.Any]] = []
+        for t in transforms:
+            if not hasattr(t, "get_color_stage"):
+                if len(stages) > 0:
+                    data["image"] = tk.ndimage.apply_color_stages(data["image"], stages)
+                    stages = []
+                data = t(force_apply=force_apply, **data)
+            elif random.random() < t.p or t.always_apply or force_apply:
+                stage = t.get_color_stage(data["image"], **t.get_params())
+                if stage is not None:
+                    stages.append(stage)
+        if len(stages) > 0:
+            data["image"] = tk.ndimage.apply_color_stages(data["image"], stages)
+        return data
+
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。(適用順はバッチ内で共通)"""
+        transforms = list(self.transforms.transforms)
+        random.shuffle(transforms)
+        enabled = _batch_enabled(self, len(images))
+        if enabled.any():
+            sub_images = images[enabled]
+            for t in transforms:
+                sub_images = apply_batch(t, sub_images)["images"]
+            images = images.copy()
+            images[enabled] = sub_images
+        return _batch_result(images, masks, bboxes)
 
     def get_transform_init_args_names(self):
-        return ("noisy", "grayscale")
+        return ("noisy", "grayscale", "fused")
 
 
 class GaussNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-method
@@ -459,6 +620,17 @@ class GaussNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         rand = np.random.RandomState(random.randrange(2 ** 32))
         return tk.ndimage.gaussian_noise(image, rand, scale)
 
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+
+        def fn(x):
+            scale = np.random.uniform(*self.scale, size=(len(x), 1, 1, 1))
+            noise = np.random.standard_normal(size=x.shape).astype(np.float32)
+            return x + noise * scale.astype(np.float32)
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_params(self):
         return {"scale": random.uniform(*self.scale)}
 
@@ -491,7 +663,16 @@ class SaltAndPepperNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-meth
 
 
 class PerlinNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-method
-    """Perlin noise。"""
+    """Perlin noise。
+
+    Args:
+        bank_size: 0より大きい場合、入力サイズごとにこの枚数のノイズを事前に生成しておき、
+                   適用時はそこからランダムに切り出し・90度単位の回転・反転をして使う。(高速化用)
+                   パラメータはノイズの生成時に決まるので、ar以外の分布は変わらない。
+                   (arは回転により逆数にもなるので、範囲が1を中心に対称でない場合は分布が変わる)
+        bank_max_shapes: bank_size > 0の場合に保持する入力サイズの種類の最大数。(LRU)
+
+    """
 
     def __init__(
         self,
@@ -499,6 +680,8 @@ class PerlinNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         frequency=(2.0, 4.0),
         octaves=(3, 5),
         ar=(0.5, 2.0),
+        bank_size: int = 0,
+        bank_max_shapes: int = 8,
         always_apply=False,
         p=0.5,
     ):
@@ -507,9 +690,22 @@ class PerlinNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         self.frequency = frequency
         self.octaves = octaves
         self.ar = ar
+        self.bank_size = bank_size
+        self.bank_max_shapes = bank_max_shapes
+        self.bank = _TextureBank(bank_size, bank_max_shapes)
 
     def apply(self, image, alpha, frequency, octaves, ar, seed, **params):
         # pylint: disable=arguments-differ
+        if self.bank_size > 0:
+            noise = self.bank.get(image.shape[:2], self._generate_tile, seed)
+            if image.ndim != 2:
+                noise = np.repeat(np.expand_dims(noise, axis=-1), image.shape[-1], -1)
+            # cv2.addWeightedは入力の型が揃っている必要がある (float32の画像など)
+            noise = noise.astype(image.dtype, copy=False)
+            return cv2.addWeighted(image, 1 - alpha, noise, alpha, 0).reshape(
+                image.shape
+            )
+
         noise = PerlinNoise.perlin_noise(
             image.shape[:2], frequency=frequency, octaves=octaves, ar=ar, seed=seed
         )
@@ -606,6 +802,21 @@ class PerlinNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         # reshape
         return g.reshape(shape)
 
+    def _generate_tile(self, shape, tile_size, seed):
+        """バンク用のノイズを1枚生成する。(周波数はshapeの短辺基準に補正)"""
+        # パラメータもseedから決める (グローバルな乱数の状態に依存させない)
+        rand = random.Random(seed)
+        frequency = rand.uniform(*self.frequency)
+        octaves = rand.randint(*self.octaves)
+        ar = np.exp(rand.uniform(np.log(self.ar[0]), np.log(self.ar[1])))
+        return PerlinNoise.perlin_noise(
+            (tile_size, tile_size),
+            frequency=frequency * tile_size / min(shape),
+            octaves=octaves,
+            ar=ar,
+            seed=seed,
+        )
+
     def get_params(self):
         return {
             "alpha": random.uniform(*self.alpha),
@@ -616,7 +827,7 @@ class PerlinNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         }
 
     def get_transform_init_args_names(self):
-        return ("alpha", "frequency", "octaves", "ar")
+        return ("alpha", "frequency", "octaves", "ar", "bank_size", "bank_max_shapes")
 
 
 class RandomBlur(A.ImageOnlyTransform):  # pylint: disable=abstract-method
@@ -667,6 +878,21 @@ class RandomBrightness(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         # pylint: disable=arguments-differ
         return tk.ndimage.brightness(image, shift)
 
+    def get_color_stage(self, image, shift):
+        """RandomColorAugmentorsでまとめて適用するための変換を返す。"""
+        del image
+        return ("lut", tk.ndimage.brightness(_LUT_INPUT, shift))
+
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+
+        def fn(x):
+            shift = np.random.uniform(*self.shift, size=(len(x), 1, 1, 1))
+            return x + shift.astype(np.float32)
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_params(self):
         return {"shift": random.uniform(*self.shift)}
 
@@ -685,6 +911,21 @@ class RandomContrast(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         # pylint: disable=arguments-differ
         return tk.ndimage.contrast(image, alpha)
 
+    def get_color_stage(self, image, alpha):
+        """RandomColorAugmentorsでまとめて適用するための変換を返す。"""
+        del image
+        return ("lut", tk.ndimage.contrast(_LUT_INPUT, alpha))
+
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+
+        def fn(x):
+            alpha = _random_loguniform_batch(*self.alpha, size=(len(x), 1, 1, 1))
+            return x * alpha + 127.5 * (1 - alpha)
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_params(self):
         return {"alpha": _random_loguniform(*self.alpha)}
 
@@ -705,6 +946,31 @@ class RandomSaturation(A.ImageOnlyTransform):  # pylint: disable=abstract-method
             return image
         return tk.ndimage.saturation(image, alpha)
 
+    def get_color_stage(self, image, alpha):
+        """RandomColorAugmentorsでまとめて適用するための変換を返す。"""
+        if image.shape[-1] != 3:
+            return None
+        # alpha * rgb + (1 - alpha) * gray
+        gray_weights = np.array([[0.299, 0.587, 0.114]], dtype=np.float32)
+        matrix = alpha * np.eye(3, dtype=np.float32) + (1 - alpha) * np.repeat(
+            gray_weights, 3, axis=0
+        )
+        return ("matrix", (matrix, np.zeros((3,), dtype=np.float32)))
+
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+        if images.shape[-1] != 3:
+            return _batch_result(images, masks, bboxes)
+
+        def fn(x):
+            alpha = _random_loguniform_batch(*self.alpha, size=(len(x), 1, 1, 1))
+            gray_weights = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+            gs = (x * gray_weights).sum(axis=-1, keepdims=True)
+            return alpha * x + (1 - alpha) * gs
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_params(self):
         return {"alpha": _random_loguniform(*self.alpha)}
 
@@ -726,6 +992,31 @@ class RandomHue(A.ImageOnlyTransform):  # pylint: disable=abstract-method
             return image
         return tk.ndimage.hue_lite(image, alpha, beta)
 
+    def get_color_stage(self, image, alpha, beta):
+        """RandomColorAugmentorsでまとめて適用するための変換を返す。"""
+        if image.shape[-1] != 3:
+            return None
+        # tk.ndimage.hue_liteと同じ計算
+        ma = 3 / (1 / (alpha + 1e-7)).sum()
+        mb = np.mean(beta.astype(np.float32))
+        return ("matrix", (np.diag(alpha / ma), beta - mb))
+
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+        if images.shape[-1] != 3:
+            return _batch_result(images, masks, bboxes)
+
+        def fn(x):
+            # tk.ndimage.hue_liteと同じ計算
+            alpha = _random_loguniform_batch(*self.alpha, size=(len(x), 1, 1, 3))
+            beta = np.random.uniform(*self.beta, size=(len(x), 1, 1, 3))
+            ma = 3 / (1 / (alpha + 1e-7)).sum(axis=-1, keepdims=True)
+            mb = beta.mean(axis=-1, keepdims=True)
+            return x * (alpha / ma) + (beta - mb).astype(np.float32)
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_params(self):
         return {
             "alpha": np.array(
@@ -780,6 +1071,18 @@ class RandomAutoContrast(A.ImageOnlyTransform):  # pylint: disable=abstract-meth
         # pylint: disable=arguments-differ
         return tk.ndimage.auto_contrast(image)
 
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+
+        def fn(x):
+            gray = x.mean(axis=-1)
+            b = gray.min(axis=(1, 2)).reshape((-1, 1, 1, 1))
+            w = gray.max(axis=(1, 2)).reshape((-1, 1, 1, 1))
+            return np.where(b < w, (x - b) * (255 / np.maximum(w - b, 1e-7)), x)
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_transform_init_args_names(self):
         return ()
 
@@ -802,6 +1105,22 @@ class RandomPosterize(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         # pylint: disable=arguments-differ
         return tk.ndimage.posterize(image, bits)
 
+    def get_color_stage(self, image, bits):
+        """RandomColorAugmentorsでまとめて適用するための変換を返す。"""
+        del image
+        return ("lut", tk.ndimage.posterize(_LUT_INPUT, bits))
+
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+
+        def fn(x):
+            bits = np.random.randint(self.bits[0], self.bits[1] + 1, size=len(x))
+            t = (2.0 ** bits / 255).astype(np.float32).reshape((-1, 1, 1, 1))
+            return np.round(x * t) / t
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_params(self):
         return {"bits": random.randint(*self.bits)}
 
@@ -935,6 +1254,55 @@ class RandomErasing(A.ImageOnlyTransform):  # pylint: disable=abstract-method
             )
         return image
 
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。
+
+        object_aware=Falseなら矩形の選択と塗りつぶしをバッチ単位でまとめて行う。
+        object_aware=Trueの場合はサンプルごとにapplyを呼び出す。
+
+        """
+        enabled = _batch_enabled(self, len(images))
+        if not enabled.any():
+            return _batch_result(images, masks, bboxes)
+        images = images.copy()
+        if self.object_aware:
+            assert bboxes is not None
+            for i in np.where(enabled)[0]:
+                images[i] = self.apply(images[i], bboxes=np.asarray(bboxes[i]))
+            return _batch_result(images, masks, bboxes)
+
+        # 各サンプルでmax_tries個の候補を作り、最初の有効なものを使う
+        sub_images = images[enabled]
+        n, h, w = sub_images.shape[:3]
+        size = (n, self.max_tries)
+        s = h * w * np.random.uniform(self.scale_low, self.scale_high, size=size)
+        r = np.exp(np.random.uniform(np.log(self.rate_1), np.log(self.rate_2), size=size))
+        ew = np.sqrt(s / r).astype(int)
+        eh = np.sqrt(s * r).astype(int)
+        valid = (ew > 0) & (eh > 0) & (ew < w) & (eh < h)
+        found = valid.any(axis=1)
+        first = valid.argmax(axis=1)
+        ew, eh = ew[np.arange(n), first], eh[np.arange(n), first]
+        ex = (np.random.random_sample(n) * (w - ew)).astype(int)
+        ey = (np.random.random_sample(n) * (h - eh)).astype(int)
+        ys = np.arange(h).reshape((1, h, 1))
+        xs = np.arange(w).reshape((1, 1, w))
+        region = (
+            found.reshape((n, 1, 1))
+            & (ys >= ey.reshape((n, 1, 1)))
+            & (ys < (ey + eh).reshape((n, 1, 1)))
+            & (xs >= ex.reshape((n, 1, 1)))
+            & (xs < (ex + ew).reshape((n, 1, 1)))
+        )
+        color = np.random.randint(0, 256, size=(n, 1, 1, sub_images.shape[-1]))
+        np.copyto(
+            sub_images,
+            np.broadcast_to(color.astype(sub_images.dtype), sub_images.shape),
+            where=np.expand_dims(region, axis=-1),
+        )
+        images[enabled] = sub_images
+        return _batch_result(images, masks, bboxes)
+
     def get_transform_init_args_names(self):
         return (
             "scale_low",
@@ -953,6 +1321,10 @@ class GridMask(A.ImageOnlyTransform):  # pylint: disable=abstract-method
     - rは大きいほどマスクが小さくなる
     - d1, d2は入力サイズに対する比率で指定
     - pは(Albumentationsの流儀とは合わせず)(しかし可変にするのも面倒なので)Faster-RCNNでの実験で一番良かった0.7に
+    - bank_size > 0の場合、入力サイズごとにこの枚数のマスクを事前に生成しておき、
+      適用時はそこからランダムに切り出し・90度単位の回転・反転をして使う。(高速化用)
+      マスクは元々ランダムに回転させているので、分布は(バンクの枚数による偏りを除き)変わらない。
+    - bank_max_shapesはbank_size > 0の場合に保持する入力サイズの種類の最大数。(LRU)
 
     """
 
@@ -962,6 +1334,8 @@ class GridMask(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         d: typing.Tuple[float, float] = (0.4, 1.0),
         random_color: bool = False,
         fill_value: int = 0,
+        bank_size: int = 0,
+        bank_max_shapes: int = 8,
         always_apply: bool = False,
         p: float = 0.7,
     ):
@@ -970,61 +1344,119 @@ class GridMask(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         self.d: typing.Tuple[float, float] = d
         self.random_color = random_color
         self.fill_value = fill_value
+        self.bank_size = bank_size
+        self.bank_max_shapes = bank_max_shapes
+        self.bank = _TextureBank(bank_size, bank_max_shapes)
 
     def apply(self, image, **params):
         # pylint: disable=arguments-differ
-        # ↓<https://github.com/PyCQA/pylint/issues/3139>
-        # pylint: disable=unsubscriptable-object
-        h, w = image.shape[:2]
-        d = int(min(h, w) * random.uniform(*self.d))
-        r = random.uniform(*self.r)
-        l_ = int(d * r)
-
-        # 少し大きくマスクを作成
-        hh, ww = int(h * 1.5), int(w * 1.5)
-        mask = np.zeros((hh, ww, 1), np.float32)
-        for ox in range(0, ww, d):
-            mask[:, ox : ox + l_, :] = 1
-        for oy in range(0, hh, d):
-            mask[oy : oy + l_, :, :] = 1
+        if image.ndim == 2:
+            image = np.expand_dims(image, axis=-1)
+        source, color = self._get_random_params(image.shape[:2], image.shape[-1])
+        mask = self._make_masks(image.shape[:2], [source])[0]
+        return np.where(np.expand_dims(mask, axis=-1), image, color.astype(image.dtype))
 
-        # 回転
-        degrees = random.uniform(0, 360)
-        center = (mask.shape[1] // 2, mask.shape[0] // 2)
-        m = cv2.getRotationMatrix2D(center=center, angle=degrees, scale=1.0)
-        mask = cv2.warpAffine(
-            mask,
-            m,
-            (mask.shape[1], mask.shape[0]),
-            flags=cv2.INTER_NEAREST,
-            borderMode=cv2.BORDER_WRAP,
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。
+
+        パラメータはapplyと同じくサンプルごとに生成し、マスクの作成と適用はバッチ分まとめて行う。
+
+        """
+        enabled = _batch_enabled(self, len(images))
+        if not enabled.any():
+            return _batch_result(images, masks, bboxes)
+        sub_images = images[enabled]
+        params = [
+            self._get_random_params(sub_images.shape[1:3], sub_images.shape[-1])
+            for _ in range(len(sub_images))
+        ]
+        mask = self._make_masks(sub_images.shape[1:3], [source for source, _ in params])
+        color = np.array([c for _, c in params]).astype(sub_images.dtype)
+        images = images.copy()
+        images[enabled] = np.where(
+            np.expand_dims(mask, axis=-1), sub_images, color[:, np.newaxis, np.newaxis]
         )
-        assert mask.ndim == 2
-        mask = np.expand_dims(mask, axis=-1)
+        return _batch_result(images, masks, bboxes)
 
-        # 使うサイズをrandom crop
-        cy = random.randint(0, hh - h - 1)
-        cx = random.randint(0, ww - w - 1)
-        mask = mask[cy : cy + h, cx : cx + w, :]
+    def _get_random_params(
+        self, shape: typing.Tuple[int, int], channels: int
+    ) -> typing.Tuple[typing.Any, np.ndarray]:
+        """1サンプル分のマスクの元と色をランダムに決める。(applyとapply_batchで共通)
 
-        # マスクを適用
-        if image.ndim == 2:
-            image = np.expand_dims(image, axis=-1)
+        Returns:
+            マスクの元(bank_size > 0ならバンクから切り出したマスク、
+            それ以外なら_make_masksに渡すパラメータ)と、マスク部分の色(shape=(channels,))
+
+        """
+        h, w = shape
+        if self.bank_size > 0:
+            seed = random.randint(0, 2 ** 32 - 1)
+            source: typing.Any = self.bank.get((h, w), self._generate_tile, seed)
+        else:
+            # 少し大きいマスクを回転したものから、使うサイズをrandom crop
+            hh, ww = int(h * 1.5), int(w * 1.5)
+            d, l_, degrees = self._get_grid_params((h, w))
+            cy = random.randint(0, hh - h - 1)
+            cx = random.randint(0, ww - w - 1)
+            source = ((hh, ww), d, l_, degrees, cy, cx)
         if self.random_color:
             # ランダムな色でマスク (オリジナル)
-            color = np.array(
-                [random.randint(0, 255) for _ in range(image.shape[-1])],
-                dtype=np.uint8,
-            )
-            return (image * mask + color * (1 - mask)).astype(image.dtype)
-        elif self.fill_value != 0:
-            color = np.asarray(self.fill_value)
-            return (image * mask + color * (1 - mask)).astype(image.dtype)
+            color = np.array([random.randint(0, 255) for _ in range(channels)])
         else:
-            return (image * mask).astype(image.dtype)
+            color = np.full((channels,), self.fill_value)
+        return source, color
+
+    def _get_grid_params(
+        self, shape: typing.Tuple[int, int], rand: random.Random = None
+    ) -> typing.Tuple[int, int, float]:
+        """グリッドの周期、マスクしない幅、回転角度をランダムに決める。(周期はshapeの短辺に対する比率)
+
+        Args:
+            shape: 入力サイズ (H, W)
+            rand: 乱数。Noneならrandomモジュールのものを使う。
+
+        """
+        # ↓<https://github.com/PyCQA/pylint/issues/3139>
+        # pylint: disable=unsubscriptable-object
+        rand_: typing.Any = random if rand is None else rand
+        d = max(int(min(shape) * rand_.uniform(*self.d)), 1)
+        l_ = int(d * rand_.uniform(*self.r))
+        degrees = rand_.uniform(0, 360)
+        return d, l_, degrees
+
+    @staticmethod
+    def _make_masks(shape: typing.Tuple[int, int], sources: list) -> np.ndarray:
+        """_get_random_paramsのマスクの元からマスク(bool)のバッチを作る。
+
+        回転したグリッドは出力画素ごとの座標計算でまとめて作る。
+        (mask_shapeのマスクを中心で回転し、はみ出た分は折り返したものを(cy, cx)から切り出すのと同じ)
+
+        """
+        if len(sources) > 0 and isinstance(sources[0], np.ndarray):
+            return np.array(sources).astype(bool)
+        h, w = shape
+        (hh, ww), *_ = sources[0]
+        assert all(s[0] == (hh, ww) for s in sources)
+        d, l_, degrees, cy, cx = (
+            np.array([s[i] for s in sources]).reshape((-1, 1, 1)) for i in range(1, 6)
+        )
+        theta = degrees * np.pi / 180
+        # 出力画素 → 回転前のマスク上の座標
+        dy = np.arange(h).reshape((1, h, 1)) + cy - hh // 2
+        dx = np.arange(w).reshape((1, 1, w)) + cx - ww // 2
+        c, s = np.cos(theta), np.sin(theta)
+        u = np.rint(c * dx - s * dy + ww // 2).astype(int) % ww
+        v = np.rint(s * dx + c * dy + hh // 2).astype(int) % hh
+        return (u % d < l_) | (v % d < l_)
+
+    def _generate_tile(self, shape, tile_size, seed):
+        """バンク用のマスクを1枚生成する。"""
+        d, l_, degrees = self._get_grid_params(shape, random.Random(seed))
+        source = ((tile_size, tile_size), d, l_, degrees, 0, 0)
+        return self._make_masks((tile_size, tile_size), [source])[0].astype(np.uint8)
 
     def get_transform_init_args_names(self):
-        return ("r", "d", "random_color")
+        return ("r", "d", "random_color", "fill_value", "bank_size", "bank_max_shapes")
 
 
 class Standardize(A.ImageOnlyTransform):  # pylint: disable=abstract-method
@@ -1034,6 +1466,17 @@ class Standardize(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         # pylint: disable=arguments-differ
         return tk.ndimage.standardize(image)
 
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+
+        def fn(x):
+            mean = x.mean(axis=(1, 2, 3), keepdims=True)
+            std = x.std(axis=(1, 2, 3), keepdims=True)
+            return (x - mean) / (std + 1e-5) * 64 + 127
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_transform_init_args_names(self):
         return ()
 
@@ -1108,6 +1551,18 @@ class SpeckleNoise(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         noise = scipy.ndimage.gaussian_filter(noise, 1)
         return np.uint8(np.clip(image + noise, 0, 255))
 
+    def apply_batch(self, images, masks=None, bboxes=None):
+        """NHWCのバッチ単位の変換。"""
+
+        def fn(x):
+            scale = np.random.uniform(*self.scale, size=(len(x), 1, 1, 1))
+            noise = np.random.standard_normal(size=x.shape).astype(np.float32)
+            noise = scipy.ndimage.gaussian_filter(noise * scale, (0, 1, 1, 1))
+            return x + noise.astype(np.float32)
+
+        images = _apply_enabled(images, _batch_enabled(self, len(images)), fn)
+        return _batch_result(images, masks, bboxes)
+
     def get_params(self):
         return {"scale": random.uniform(*self.scale)}
 
@@ -1251,6 +1706,165 @@ class To1Channel(A.ImageOnlyTransform):  # pylint: disable=abstract-method
         return ()
 
 
+class _TextureBank:
+    """PerlinNoise/GridMask用の事前生成したテクスチャの置き場。
+
+    入力サイズごとにsize枚の正方形のタイルを生成して保持し(LRU)、
+    取得時はランダムに選んだタイルを90度単位で回転・反転して入力サイズに切り出す。
+
+    Args:
+        size: 入力サイズごとのタイルの枚数 (0なら無効)
+        max_shapes: 保持する入力サイズの種類の最大数
+
+    """
+
+    def __init__(self, size: int, max_shapes: int):
+        self.size = size
+        self.max_shapes = max_shapes
+        self.tiles: typing.OrderedDict[
+            typing.Tuple[int, int], typing.List[np.ndarray]
+        ] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # 生成済みのタイルとロックはpickleしない
+        return {"size": self.size, "max_shapes": self.max_shapes}
+
+    def __setstate__(self, state):
+        self.size = state["size"]
+        self.max_shapes = state["max_shapes"]
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(
+        self,
+        shape: typing.Tuple[int, int],
+        generate: typing.Callable[[typing.Tuple[int, int], int, int], np.ndarray],
+        seed: int,
+    ) -> np.ndarray:
+        """shapeのテクスチャを返す。
+
+        Args:
+            shape: 入力サイズ (H, W)
+            generate: タイルの生成関数。generate(shape, tile_size, seed) -> (tile_size, tile_size)
+            seed: タイルの選択や切り出しに使う乱数シード
+
+        """
+        assert self.size > 0
+        shape = (int(shape[0]), int(shape[1]))
+        random_state = np.random.RandomState(seed)
+        with self.lock:
+            tiles = self.tiles.setdefault(shape, [])
+            self.tiles.move_to_end(shape)
+            while len(self.tiles) > self.max_shapes:
+                self.tiles.popitem(last=False)
+            tile = (
+                tiles[random_state.randint(len(tiles))]
+                if len(tiles) >= self.size
+                else None
+            )
+        if tile is None:
+            # 足りなければ生成する (切り出しの余地を残して少し大きめ)
+            # 生成は重いのでロックの外で行う (同時に生成された分が溢れたら捨てる)
+            tile_size = int(np.ceil(max(shape) * 1.25))
+            tile = generate(shape, tile_size, random_state.randint(0, 2 ** 31))
+            with self.lock:
+                tiles = self.tiles.get(shape)
+                if tiles is not None and len(tiles) < self.size:
+                    tiles.append(tile)
+
+        tile = np.rot90(tile, k=random_state.randint(4))
+        if random_state.randint(2):
+            tile = tile[:, ::-1]
+        h, w = shape
+        y = random_state.randint(tile.shape[0] - h + 1)
+        x = random_state.randint(tile.shape[1] - w + 1)
+        return np.ascontiguousarray(tile[y : y + h, x : x + w])
+
+
+def apply_batch(
+    transform: A.BasicTransform,
+    images: np.ndarray,
+    masks: np.ndarray = None,
+    bboxes: typing.Sequence[np.ndarray] = None,
+) -> typing.Dict[str, typing.Any]:
+    """NHWCのバッチにtransformを適用する。
+
+    apply_batchを持つ変換はパラメータの生成と画素の処理をバッチ単位でまとめて行う。
+    持たない変換はサンプルごとに通常の呼び出しを行う。(bboxesはそのまま返す)
+
+    Args:
+        transform: 変換
+        images: 画像のバッチ。shape=(N, H, W, C)
+        masks: マスクのバッチ。shape=(N, H, W) or (N, H, W, C)
+        bboxes: サンプルごとのbounding box((物体数, 4)の[0, 1]の相対座標)のリスト
+
+    Returns:
+        images, masks, bboxesのdict (masks, bboxesは指定した場合のみ)
+
+    """
+    if hasattr(transform, "apply_batch"):
+        return transform.apply_batch(images, masks=masks, bboxes=bboxes)
+
+    out_images: typing.List[np.ndarray] = []
+    out_masks: typing.List[np.ndarray] = []
+    for i, image in enumerate(images):
+        data = {"image": image}
+        if masks is not None:
+            data["mask"] = masks[i]
+        data = transform(**data)
+        out_images.append(data["image"])
+        if masks is not None:
+            out_masks.append(data["mask"])
+    return _batch_result(
+        np.asarray(out_images), None if masks is None else np.asarray(out_masks), bboxes
+    )
+
+
+def _batch_enabled(transform: A.BasicTransform, batch_size: int) -> np.ndarray:
+    """apply_batch用に、サンプルごとの適用の有無を決める。"""
+    if transform.always_apply:
+        return np.ones((batch_size,), dtype=bool)
+    return np.random.random_sample(batch_size) < transform.p
+
+
+def _apply_enabled(
+    images: np.ndarray,
+    enabled: np.ndarray,
+    fn: typing.Callable[[np.ndarray], np.ndarray],
+) -> np.ndarray:
+    """enabledなサンプルだけをfloat32でfnに通し、uint8に戻して書き込む。"""
+    if not enabled.any():
+        return images
+    output = images.copy()
+    output[enabled] = tk.ndimage.to_uint8(fn(images[enabled].astype(np.float32)))
+    return output
+
+
+def _batch_result(
+    images: np.ndarray,
+    masks: typing.Optional[np.ndarray],
+    bboxes: typing.Optional[typing.Sequence[np.ndarray]],
+) -> typing.Dict[str, typing.Any]:
+    """apply_batchの戻り値を作る。"""
+    result: typing.Dict[str, typing.Any] = {"images": images}
+    if masks is not None:
+        result["masks"] = masks
+    if bboxes is not None:
+        result["bboxes"] = bboxes
+    return result
+
+
+def _random_loguniform_batch(
+    lower: float, upper: float, size: typing.Tuple[int, ...]
+) -> np.ndarray:
+    """_random_loguniformのバッチ版。"""
+    assert 0 < lower < 1 < upper
+    return np.exp(np.random.uniform(np.log(lower), np.log(upper), size=size)).astype(
+        np.float32
+    )
+
+
 def _random_loguniform(lower: float, upper: float) -> float:
     """3/4 ～ 4/3みたいな乱数を作って返す。"""
     assert 0 < lower < 1 < upper
@@ -1,4 +1,6 @@
 # pylint: disable=redefined-outer-name
+import random
+
 import albumentations as A
 import numpy as np
 import pytest
@@ -55,6 +57,81 @@ def test_data_augmentation(data_dir, save_dir, filename):
         tk.ndimage.save(save_dir / f"{img_path.stem}.DA.{i}.png", img)
 
 
+@pytest.mark.parametrize("grayscale", [False, True])
+def test_RandomColorAugmentors_fused(data_dir, grayscale):
+    """fused=Trueでも結果が(誤差を除き)変わらないことの確認"""
+    original_img = tk.ndimage.load(data_dir / "Lenna.png", grayscale=grayscale)
+    fused = tk.image.RandomColorAugmentors(grayscale=grayscale)
+    sequential = tk.image.RandomColorAugmentors(grayscale=grayscale, fused=False)
+    for i in range(16):
+        random.seed(i)
+        np.random.seed(i)
+        img1 = fused(image=original_img)["image"]
+        random.seed(i)
+        np.random.seed(i)
+        img2 = sequential(image=original_img)["image"]
+        assert img1.shape == img2.shape
+        diff = np.abs(img1.astype(np.int32) - img2.astype(np.int32))
+        # 丸めの差が後段のコントラストなどで拡大されることはある
+        assert diff.max() <= 4 and diff.mean() < 0.1
+
+
+def test_apply_batch(data_dir, save_dir):
+    """apply_batch"""
+    img = tk.ndimage.load(data_dir / "Lenna.png")
+    img = tk.ndimage.resize(img, 64, 64)
+    images = np.array([img] * 4)
+    masks = np.zeros(images.shape[:3], dtype=np.uint8)
+    bboxes = [np.array([[0.25, 0.25, 0.75, 0.75]], dtype=np.float32)] * 4
+    aug = A.Compose(
+        [
+            tk.image.RandomTransform(size=(32, 48), p=1),
+            tk.image.RandomColorAugmentors(noisy=True),
+            tk.image.GaussNoise(p=1),
+            tk.image.SpeckleNoise(p=1),
+            tk.image.RandomErasing(p=1),
+            tk.image.GridMask(random_color=True, p=1),
+            tk.image.Standardize(p=1),
+        ]
+    )
+    data = {"images": images, "masks": masks, "bboxes": bboxes}
+    for t in aug.transforms:
+        data = tk.image.apply_batch(t, **data)
+        assert data["images"].dtype == np.uint8
+        assert len(data["images"]) == len(images)
+        assert len(data["bboxes"]) == len(images)
+    assert data["images"].shape == (4, 32, 48, 3)
+    assert data["masks"].shape == (4, 32, 48)
+    for i, x in enumerate(data["images"]):
+        tk.ndimage.save(save_dir / f"Lenna.apply_batch.{i}.png", x)
+
+
+def test_apply_batch_consistency(data_dir):
+    """apply_batchは同じseedならapplyと同じ結果になる"""
+    img = tk.ndimage.load(data_dir / "Lenna.png")
+    img = tk.ndimage.resize(img, 64, 64)
+    images = np.array([img] * 3)
+    aug = tk.image.RandomTransform(size=(32, 48), base_scale=0.5, p=1)
+    random.seed(1)
+    result = aug.apply_batch(images)["images"]
+    random.seed(1)
+    for x, r in zip(images, result):
+        params = aug.get_params_dependent_on_targets({"image": x})
+        assert (aug.apply(x, **params) == r).all()
+    # 変換しないサンプルもbase_scaleは反映する
+    aug = tk.image.RandomTransform(size=(32, 48), base_scale=0.5, p=0)
+    m = aug._make_matrix(img.shape[:2], scale=0.5)  # pylint: disable=protected-access
+    assert (aug.apply_batch(images)["images"][0] == aug.apply(img, m=m)).all()
+
+    for bank_size in [0, 2]:
+        aug = tk.image.GridMask(bank_size=bank_size, random_color=True, p=1)
+        random.seed(1)
+        result = aug.apply_batch(images)["images"]
+        random.seed(1)
+        for x, r in zip(images, result):
+            assert (aug.apply(x) == r).all()
+
+
 def test_ToGrayScale(data_dir, save_dir):
     """ToGrayScale"""
     aug = tk.image.ToGrayScale(p=1)
@@ -105,6 +182,41 @@ def test_PerlinNoise(data_dir, save_dir):
         )
 
 
+def test_texture_bank(data_dir, save_dir):
+    """PerlinNoise/GridMaskのbank_size"""
+    import pickle
+
+    img = tk.ndimage.load(data_dir / "Lenna.png")
+    for aug in [
+        tk.image.PerlinNoise(bank_size=2, bank_max_shapes=1, p=1),
+        tk.image.GridMask(bank_size=2, bank_max_shapes=1, random_color=True, p=1),
+    ]:
+        name = type(aug).__name__
+        for i in range(4):
+            result = aug(image=img)["image"]
+            assert result.shape == img.shape
+            assert result.dtype == np.uint8
+            tk.ndimage.save(save_dir / f"Lenna.{name}.bank.{i}.png", result)
+        assert len(aug.bank.tiles[img.shape[:2]]) == 2
+        # サイズが変わったら古いものは捨てる
+        assert aug(image=img[:100, :200])["image"].shape == (100, 200, 3)
+        assert list(aug.bank.tiles) == [(100, 200)]
+        # pickleではタイルは捨てる
+        aug2 = pickle.loads(pickle.dumps(aug))
+        assert len(aug2.bank.tiles) == 0
+        # タイルはseedだけで決まる (グローバルな乱数の状態に依存しない)
+        tile1 = aug._generate_tile((64, 64), 80, 123)  # pylint: disable=protected-access
+        random.seed(1)
+        tile2 = aug._generate_tile((64, 64), 80, 123)  # pylint: disable=protected-access
+        assert (tile1 == tile2).all()
+
+    # float32の画像でも使える
+    aug = tk.image.PerlinNoise(bank_size=2, p=1)
+    result = aug(image=img.astype(np.float32))["image"]
+    assert result.shape == img.shape
+    assert result.dtype == np.float32
+
+
 def test_gray_scale(data_dir):
     img = tk.ndimage.load(data_dir / "Lenna.png", grayscale=True)
     aug = A.Compose(
@@ -24,7 +24,8 @@ def listup_classification(
     Args:
         class_names: クラス名の配列
         use_tqdm: tqdmを使用するか否か
-        check_image: 画像として読み込みチェックを行い、読み込み可能なファイルのみ返すか否か (遅いので注意)
+        check_image: 画像としてチェックを行い、読み込み可能なファイルのみ返すか否か
+                     (ヘッダーのみのチェック。tk.ndimage.scanを参照)
 
     Returns:
         class_names, X, y
@@ -72,7 +73,8 @@ def listup_files(dirpath, recurse=False, use_tqdm=True, check_image=False):
     Args:
         recurse: 再帰的に配下もリストアップするか否か
         use_tqdm: tqdmを使用するか否か
-        check_image: 画像として読み込みチェックを行い、読み込み可能なファイルのみ返すか否か (遅いので注意)
+        check_image: 画像としてチェックを行い、読み込み可能なファイルのみ返すか否か
+                     (ヘッダーのみのチェック。tk.ndimage.scanを参照)
 
     """
     result, errors = _listup_files(dirpath, recurse, use_tqdm, check_image)
@@ -96,12 +98,6 @@ def _listup_files(dirpath, recurse, use_tqdm, check_image):
             return False
         if p.name.lower() == "thumbs.db":
             return False
-        if check_image:
-            try:
-                tk.ndimage.load(p)
-            except Exception:
-                errors.append(f"Load error: {p}")
-                return False
         return True
 
     result = [
@@ -109,6 +105,10 @@ def _listup_files(dirpath, recurse, use_tqdm, check_image):
         for p in tk.utils.tqdm(list(it), desc="listup", disable=not use_tqdm)
         if _is_valid_file(p)
     ]
+    if check_image and len(result) > 0:
+        index = tk.ndimage.scan(result)
+        errors.extend(f"Load error: {p}" for p in index["path"][index["error"]])
+        result = [p for p, error in zip(result, index["error"]) if not error]
     return result, errors
 
 
@@ -8,9 +8,12 @@ Horovodに対応した簡単なwrapperなど。
 from __future__ import annotations
 
 import hashlib
+import json
 import os
 import pathlib
+import queue
 import tempfile
+import threading
 import typing
 
 import numpy as np
@@ -104,6 +107,7 @@ def load(
     compile: bool = False,  # pylint: disable=redefined-outer-name
 ):
     """モデルの読み込み。"""
+    wait_for_save()
     with tk.log.trace(f"load({path})"):
         model = tf.keras.models.load_model(
             str(path), custom_objects=custom_objects, compile=compile
@@ -137,6 +141,7 @@ def load_weights(
         読み込んだか否か。skip_not_exist=Trueの場合に限りFalseが返る可能性がある。
 
     """
+    wait_for_save()
     path = pathlib.Path(path)
     if path.exists():
         with tk.log.trace(f"load_weights({path})"):
@@ -180,6 +185,7 @@ def save(
     path: tk.typing.PathLike,
     mode: str = "hdf5",
     include_optimizer: bool = False,
+    async_write: bool = False,
 ):
     """モデルの保存。
 
@@ -188,14 +194,25 @@ def save(
         path: 保存先。saved_modelの場合はディレクトリ
         mode: "hdf5", "saved_model", "onnx", "tflite"のいずれか
         include_optimizer: HDF5形式で保存する場合にoptimizerを含めるか否か
+        async_write: Trueの場合、重みをNumPy配列にコピーだけして、書き込みはバックグラウンドで行う。
+                     (mode="hdf5"かつinclude_optimizer=Falseのみ対応。書き込み中のものがあれば完了を待つ)
+                     書き込み完了を待つ場合はwait_for_save()を呼ぶ。
 
     """
     assert mode in ("hdf5", "saved_model", "onnx", "tflite")
+    assert not async_write or (
+        mode == "hdf5" and not include_optimizer
+    ), f"async_write is not supported: {mode=} {include_optimizer=}"
     path = pathlib.Path(path)
     if tk.hvd.is_master():
+        # 書き込み中のものと競合しないように待つ
+        wait_for_save()
         with tk.log.trace(f"save({path})"):
             path.parent.mkdir(parents=True, exist_ok=True)
-            if mode in ("hdf5", "saved_model"):
+            if async_write:
+                snapshot = _snapshot_hdf5(model)
+                _async_writer.submit(lambda: _write_hdf5(path, snapshot))
+            elif mode in ("hdf5", "saved_model"):
                 model.save(
                     str(path),
                     overwrite=True,
@@ -216,11 +233,133 @@ def save(
                     f.write(tflite_model)
             else:
                 raise ValueError(f"Invalid save format: {mode}")
-            # 念のため重みのfingerprintをログ出力しておく
-            tk.log.get(__name__).info(f"fingerprint: {tk.models.fingerprint(model)}")
+            # 念のため重みのfingerprintをログ出力しておく (async_writeなら取得済みの重みから)
+            fp = snapshot["fingerprint"] if async_write else tk.models.fingerprint(model)
+            tk.log.get(__name__).info(f"fingerprint: {fp}")
     tk.hvd.barrier()
 
 
+def wait_for_save():
+    """save(async_write=True)の書き込みの完了を待つ。(書き込みでエラーが起きていた場合はここで送出する)"""
+    _async_writer.wait()
+
+
+class _AsyncWriter:
+    """バックグラウンドで書き込みを行う。(同時に実行するのは1つだけ)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread: typing.Optional[threading.Thread] = None
+        self.error: typing.Optional[BaseException] = None
+
+    def submit(self, fn: typing.Callable[[], None]):
+        """書き込み中のものがあれば完了を待ってから、fnを別スレッドで実行する。"""
+        self.wait()
+        with self.lock:
+            self.thread = threading.Thread(target=self._run, args=(fn,))
+            self.thread.start()
+
+    def wait(self):
+        """書き込みの完了を待つ。"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _run(self, fn: typing.Callable[[], None]):
+        try:
+            fn()
+        except BaseException as e:  # pylint: disable=broad-except
+            tk.log.get(__name__).error("Async save failed.", exc_info=True)
+            self.error = e
+
+
+_async_writer = _AsyncWriter()
+
+
+def _snapshot_hdf5(model: tf.keras.models.Model) -> typing.Dict[str, typing.Any]:
+    """HDF5形式での保存に必要な情報を取得する。(重みは1回でまとめてNumPy配列にコピー)"""
+    values = model.get_weights()
+    value_map = {id(w): v for w, v in zip(model.weights, values)}
+    # Kerasと同じく、レイヤーごとにtrainable→non-trainableの順で保存する
+    layers = []
+    for layer in model.layers:
+        weights = layer.trainable_weights + layer.non_trainable_weights
+        layers.append(
+            (layer.name, [w.name for w in weights], [value_map[id(w)] for w in weights])
+        )
+    model_config = json.loads(model.to_json())
+    return {
+        "model_config": json.dumps(
+            {
+                "class_name": model_config["class_name"],
+                "config": model_config["config"],
+            }
+        ),
+        "layers": layers,
+        "fingerprint": _fingerprint(values),
+    }
+
+
+def _write_hdf5(path: pathlib.Path, snapshot: typing.Dict[str, typing.Any]):
+    """_snapshot_hdf5の結果をtf.keras.models.load_model()で読み込める形式で書き込む。
+
+    一時ファイルに書き込んでからリネームするので、書き込み途中のファイルが読まれることは無い。
+
+    """
+    import h5py
+
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tk.log.trace(f"write_hdf5({path})"):
+        with h5py.File(str(tmp_path), mode="w") as f:
+            keras_version = str(tf.keras.__version__).encode("utf8")
+            backend = tf.keras.backend.backend().encode("utf8")
+            f.attrs["keras_version"] = keras_version
+            f.attrs["backend"] = backend
+            f.attrs["model_config"] = snapshot["model_config"].encode("utf8")
+            g = f.create_group("model_weights")
+            g.attrs["keras_version"] = keras_version
+            g.attrs["backend"] = backend
+            _save_hdf5_attributes(
+                g,
+                "layer_names",
+                [name.encode("utf8") for name, _, _ in snapshot["layers"]],
+            )
+            for layer_name, weight_names, weight_values in snapshot["layers"]:
+                layer_group = g.create_group(layer_name)
+                _save_hdf5_attributes(
+                    layer_group,
+                    "weight_names",
+                    [name.encode("utf8") for name in weight_names],
+                )
+                for name, value in zip(weight_names, weight_values):
+                    dset = layer_group.create_dataset(
+                        name, value.shape, dtype=value.dtype
+                    )
+                    dset[()] = value
+            f.flush()
+        os.replace(str(tmp_path), str(path))
+
+
+def _save_hdf5_attributes(group, name: str, data: typing.List[bytes]):
+    """HDF5の属性の保存。(Kerasと同じく、サイズ制限を超える場合は分割する)"""
+    header_limit = 64512
+    data_npy = np.asarray(data)
+    num_chunks = 1
+    chunked_data = np.array_split(data_npy, num_chunks)
+    while any(x.nbytes > header_limit for x in chunked_data):
+        num_chunks += 1
+        chunked_data = np.array_split(data_npy, num_chunks)
+    if num_chunks > 1:
+        for i, chunk in enumerate(chunked_data):
+            group.attrs[f"{name}{i}"] = chunk
+    else:
+        group.attrs[name] = data
+
+
 def summary(model: tf.keras.models.Model):
     """summaryを実行するだけ。"""
     model.summary(
@@ -376,6 +515,16 @@ def fit(
         tk.log.get(__name__).info(f"fit(val):   {val_ds.element_spec} {val_steps=}")
 
     callbacks = make_callbacks(callbacks, training=True)
+    for cb in callbacks:
+        if isinstance(cb, tk.callbacks.EpochLogger) and cb.batch_size is None:
+            cb.batch_size = (
+                train_iterator.data_loader.batch_size
+                * train_iterator.data_loader.num_replicas_in_sync
+            )
+        if isinstance(cb, tk.callbacks.EpochLogger) and cb.data_loaders is None:
+            cb.data_loaders = [train_iterator.data_loader]
+            if val_iterator is not None:
+                cb.data_loaders.append(val_iterator.data_loader)
 
     fit_kwargs = {}
     if val_freq is not None:
@@ -439,17 +588,22 @@ def predict(
     callbacks: typing.List[tf.keras.callbacks.Callback] = None,
     verbose: int = 1,
     on_batch_fn: OnBatchFnType = None,
+    output_dir: tk.typing.PathLike = None,
 ) -> ModelIOType:
     """推論。
 
+    on_batch_fnかoutput_dirを指定した場合、最初のミニバッチの結果から出力先の配列を確保し、
+    ミニバッチごとに書き込んでいく。(サンプルごとのリストは作らない)
+
     Args:
         model: モデル
         iterator: 推論したい入力データ
         callbacks: コールバック
         verbose: プログレスバーを表示するか否か
         on_batch_fn: モデルとミニバッチ分の入力データを受け取り、推論結果を返す処理。(TTA用)
-        flow: 結果をgeneratorで返すならTrue
-        desc: flow時のtqdmのdesc
+        output_dir: 指定した場合、推論結果を.npyのメモリマップとしてこのディレクトリに書き込む。
+                    (出力が1つなら"output.npy"、複数なら"output_{i}.npy"、dictなら"{key}.npy")
+                    Horovod使用時は各プロセスの結果をallgatherした後、masterだけが書き込む。
 
     Returns:
         推論結果。
@@ -462,8 +616,8 @@ def predict(
         dataset = tk.hvd.split(iterator.dataset) if use_horovod else iterator.dataset
         ds, steps = iterator.data_loader.get_ds(dataset, without_label=True)
         tk.log.get(__name__).info(f"predict: {ds.element_spec} {steps=}")
-        if on_batch_fn is not None:
-            gen = _predict_flow(
+        if on_batch_fn is not None or output_dir is not None:
+            gen = _predict_batches(
                 model=model,
                 ds=ds,
                 steps=steps,
@@ -472,13 +626,11 @@ def predict(
                 on_batch_fn=on_batch_fn,
                 desc="predict",
             )
-            results = list(gen)
-            if isinstance(results[0], (list, tuple)):  # multiple output
-                values = [
-                    np.array([r[i] for r in results]) for i in range(len(results[0]))
-                ]
-            else:
-                values = np.array(results)
+            # Horovod使用時は同じファイルを複数プロセスで開かないよう、
+            # 各プロセスではメモリ上に確保してallgather後にmasterだけが書き込む
+            values = _write_batches(
+                gen, len(dataset), None if use_horovod else output_dir
+            )
         else:
             values = model.predict(
                 ds,
@@ -486,7 +638,12 @@ def predict(
                 verbose=verbose,
                 callbacks=callbacks,
             )
-        values = tk.hvd.allgather(values) if use_horovod else values
+        if use_horovod:
+            values = tk.hvd.allgather(values)
+            if output_dir is not None and tk.hvd.is_master():
+                values = _write_batches(
+                    iter([values]), len(iterator.dataset), output_dir
+                )
         return values
 
 
@@ -538,6 +695,27 @@ def _predict_flow(
     on_batch_fn: OnBatchFnType = None,
     desc: str = "predict",
 ):
+    for pred_batch in _predict_batches(
+        model, ds, steps, callbacks, verbose, on_batch_fn, desc
+    ):
+        if isinstance(pred_batch, (list, tuple)):  # multiple output
+            assert len(pred_batch) >= 2
+            for b in zip(*pred_batch):
+                yield list(b)
+        else:
+            yield from pred_batch
+
+
+def _predict_batches(
+    model: tf.keras.models.Model,
+    ds: tf.data.Dataset,
+    steps: int,
+    callbacks: typing.List[tf.keras.callbacks.Callback],
+    verbose: int,
+    on_batch_fn: OnBatchFnType = None,
+    desc: str = "predict",
+) -> typing.Iterator[ModelIOType]:
+    """ミニバッチごとの推論結果を返すgenerator。"""
     on_batch_fn = on_batch_fn or _predict_on_batch
     for cb in callbacks:
         cb.on_predict_begin()
@@ -548,19 +726,73 @@ def _predict_flow(
         pred_batch = on_batch_fn(model, X)
         for cb in callbacks:
             cb.on_predict_batch_end(batch)
-
-        if isinstance(pred_batch, (list, tuple)):  # multiple output
-            assert len(pred_batch) >= 2
-            for b in zip(*pred_batch):
-                yield list(b)
-        else:
-            yield from pred_batch
-
+        yield pred_batch
         batch += 1
     for cb in callbacks:
         cb.on_predict_end()
 
 
+def _write_batches(
+    gen: typing.Iterator[ModelIOType],
+    num_samples: int,
+    output_dir: tk.typing.PathLike = None,
+) -> ModelIOType:
+    """ミニバッチごとの推論結果を確保済みの配列に書き込んでいく。"""
+    outputs: typing.Optional[typing.Dict[str, np.ndarray]] = None
+    output_type: typing.Any = None
+    offset = 0
+    for pred_batch in gen:
+        # 出力を名前→配列のdictに揃える
+        if isinstance(pred_batch, dict):
+            batch_dict = {k: np.asarray(v) for k, v in pred_batch.items()}
+        elif isinstance(pred_batch, (list, tuple)):  # multiple output
+            batch_dict = {f"output_{i}": np.asarray(v) for i, v in enumerate(pred_batch)}
+        else:
+            batch_dict = {"output": np.asarray(pred_batch)}
+        if outputs is None:
+            output_type = type(pred_batch)
+            outputs = {
+                name: _allocate_output(
+                    (num_samples,) + v.shape[1:], v.dtype, name, output_dir
+                )
+                for name, v in batch_dict.items()
+            }
+        batch_size = len(next(iter(batch_dict.values())))
+        assert (
+            offset + batch_size <= num_samples
+        ), f"Too many predictions: {offset + batch_size} > {num_samples}"
+        for name, v in batch_dict.items():
+            outputs[name][offset : offset + batch_size] = v
+        offset += batch_size
+    assert outputs is not None, "No predictions"
+    assert offset == num_samples, f"Too few predictions: {offset} < {num_samples}"
+
+    for v in outputs.values():
+        if isinstance(v, np.memmap):
+            v.flush()
+    if issubclass(output_type, dict):
+        return outputs
+    if issubclass(output_type, (list, tuple)):
+        return list(outputs.values())
+    return outputs["output"]
+
+
+def _allocate_output(
+    shape: typing.Tuple[int, ...],
+    dtype: np.dtype,
+    name: str,
+    output_dir: tk.typing.PathLike = None,
+) -> np.ndarray:
+    """推論結果の出力先を確保する。"""
+    if output_dir is None:
+        return np.empty(shape, dtype=dtype)
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return np.lib.format.open_memmap(
+        str(output_dir / f"{name}.npy"), mode="w+", dtype=dtype, shape=shape
+    )
+
+
 def _predict_on_batch(model: tf.keras.models.Model, X):
     return model.predict_on_batch(X)
 
@@ -671,10 +903,533 @@ def predict_on_batch_augmented(
     return result
 
 
+class TTATransform:
+    """predict_on_batch_ttaで使う変換の基底クラス。
+
+    apply()で入力のミニバッチを変換し、inverse()で(画像などの密な)出力を元に戻す。
+
+    """
+
+    def apply(self, X_batch: np.ndarray) -> np.ndarray:
+        """入力の変換。"""
+        raise NotImplementedError()
+
+    def inverse(
+        self, y_batch: np.ndarray, input_shape: typing.Tuple[int, ...]
+    ) -> np.ndarray:
+        """出力の逆変換。(dense=Trueの場合のみ使用。input_shapeは変換前の入力のshape)"""
+        del input_shape
+        return y_batch
+
+    def transformed_shape(
+        self, input_shape: typing.Tuple[int, ...]
+    ) -> typing.Tuple[int, ...]:
+        """変換後の入力のshapeを返す。"""
+        return input_shape
+
+
+class IdentityTTA(TTATransform):
+    """何もしない変換。"""
+
+    def apply(self, X_batch: np.ndarray) -> np.ndarray:
+        return X_batch
+
+
+class FlipTTA(TTATransform):
+    """反転。
+
+    Args:
+        vertical: 垂直方向に反転するか否か
+        horizontal: 水平方向に反転するか否か
+
+    """
+
+    def __init__(self, vertical: bool = False, horizontal: bool = True):
+        self.vertical = vertical
+        self.horizontal = horizontal
+
+    def apply(self, X_batch: np.ndarray) -> np.ndarray:
+        if self.vertical:
+            X_batch = X_batch[:, ::-1]
+        if self.horizontal:
+            X_batch = X_batch[:, :, ::-1]
+        return X_batch
+
+    def inverse(
+        self, y_batch: np.ndarray, input_shape: typing.Tuple[int, ...]
+    ) -> np.ndarray:
+        return self.apply(y_batch)
+
+
+class CropTTA(TTATransform):
+    """パディングしてから元のサイズで切り出す。(つまり平行移動)
+
+    Args:
+        offset: パディング後の画像での切り出し位置。(v, h)
+        padding_size: パディングするサイズ。(v, h)
+        padding_mode: パディングの種類。(np.padのmode)
+
+    """
+
+    def __init__(
+        self,
+        offset: typing.Tuple[int, int],
+        padding_size: typing.Tuple[int, int] = (32, 32),
+        padding_mode: str = "edge",
+    ):
+        self.offset = offset
+        self.padding_size = padding_size
+        self.padding_mode = padding_mode
+
+    def apply(self, X_batch: np.ndarray) -> np.ndarray:
+        return self._crop(X_batch, self.offset, self.padding_size)
+
+    def inverse(
+        self, y_batch: np.ndarray, input_shape: typing.Tuple[int, ...]
+    ) -> np.ndarray:
+        # 出力が縮小されている場合は移動量も縮小する (端数は丸め)
+        ry = y_batch.shape[1] / input_shape[1]
+        rx = y_batch.shape[2] / input_shape[2]
+        shift_v = int(round((self.offset[0] - self.padding_size[0]) * ry))
+        shift_h = int(round((self.offset[1] - self.padding_size[1]) * rx))
+        padding_size = (abs(shift_v), abs(shift_h))
+        offset = (padding_size[0] - shift_v, padding_size[1] - shift_h)
+        return self._crop(y_batch, offset, padding_size)
+
+    def _crop(self, X_batch, offset, padding_size):
+        pad_width = [
+            (0, 0),
+            (padding_size[0], padding_size[0]),
+            (padding_size[1], padding_size[1]),
+        ] + [(0, 0)] * (X_batch.ndim - 3)
+        X_padded = np.pad(X_batch, pad_width, mode=self.padding_mode)
+        return X_padded[
+            :,
+            offset[0] : offset[0] + X_batch.shape[1],
+            offset[1] : offset[1] + X_batch.shape[2],
+        ]
+
+
+class ScaleTTA(TTATransform):
+    """拡大・縮小。(モデルが可変サイズの入力を受け付ける場合用)
+
+    Args:
+        scale: 拡大率
+
+    """
+
+    def __init__(self, scale: float):
+        self.scale = scale
+
+    def apply(self, X_batch: np.ndarray) -> np.ndarray:
+        _, height, width = self.transformed_shape(X_batch.shape)[:3]
+        return self._resize(X_batch, width, height)
+
+    def inverse(
+        self, y_batch: np.ndarray, input_shape: typing.Tuple[int, ...]
+    ) -> np.ndarray:
+        # 出力の縮小率は保ったまま、変換前の入力に対応するサイズに戻す
+        scaled_shape = self.transformed_shape(input_shape)
+        height = int(round(y_batch.shape[1] * input_shape[1] / scaled_shape[1]))
+        width = int(round(y_batch.shape[2] * input_shape[2] / scaled_shape[2]))
+        return self._resize(y_batch, width, height)
+
+    def transformed_shape(
+        self, input_shape: typing.Tuple[int, ...]
+    ) -> typing.Tuple[int, ...]:
+        height = int(round(input_shape[1] * self.scale))
+        width = int(round(input_shape[2] * self.scale))
+        return input_shape[:1] + (height, width) + input_shape[3:]
+
+    def _resize(self, X_batch, width, height):
+        return np.array(
+            [
+                tk.ndimage.resize(X, width=width, height=height).reshape(
+                    (height, width) + X.shape[2:]
+                )
+                for X in X_batch
+            ]
+        )
+
+
+class ComposeTTA(TTATransform):
+    """複数の変換を順に適用する。(逆変換は逆順)
+
+    Args:
+        transforms: 変換のリスト
+
+    """
+
+    def __init__(self, transforms: typing.Sequence[TTATransform]):
+        self.transforms = list(transforms)
+
+    def apply(self, X_batch: np.ndarray) -> np.ndarray:
+        for t in self.transforms:
+            X_batch = t.apply(X_batch)
+        return X_batch
+
+    def inverse(
+        self, y_batch: np.ndarray, input_shape: typing.Tuple[int, ...]
+    ) -> np.ndarray:
+        # 各変換の入力のshapeを求めてから逆順に戻す
+        shapes = [input_shape]
+        for t in self.transforms[:-1]:
+            shapes.append(t.transformed_shape(shapes[-1]))
+        for t, shape in zip(reversed(self.transforms), reversed(shapes)):
+            y_batch = t.inverse(y_batch, shape)
+        return y_batch
+
+    def transformed_shape(
+        self, input_shape: typing.Tuple[int, ...]
+    ) -> typing.Tuple[int, ...]:
+        for t in self.transforms:
+            input_shape = t.transformed_shape(input_shape)
+        return input_shape
+
+
+def make_tta_transforms(
+    flip: typing.Tuple[bool, bool] = (False, True),
+    crop_size: typing.Tuple[int, int] = (3, 3),
+    padding_size: typing.Tuple[int, int] = (32, 32),
+    padding_mode: str = "edge",
+    scales: typing.Sequence[float] = (),
+) -> typing.List[TTATransform]:
+    """predict_on_batch_augmentedと同じ組み合わせ(＋拡大・縮小)の変換のリストを作る。
+
+    Args:
+        flip: 水平/垂直方向の反転を行うか否か。(v, h)
+        crop_size: 縦横のcropのパターンの数。(v, h)
+        padding_size: crop前にパディングするサイズ。(v, h)
+        padding_mode: パディングの種類。(np.padのmode)
+        scales: 追加で行う拡大率のリスト。(反転やcropとは組み合わせない)
+
+    Returns:
+        変換のリスト
+
+    """
+    flips = [(False, False)]
+    if flip[0]:
+        flips.append((True, False))
+    if flip[1]:
+        flips.append((False, True))
+    if flip[0] and flip[1]:
+        flips.append((True, True))
+
+    transforms: typing.List[TTATransform] = []
+    for y in np.linspace(0, padding_size[0] * 2, crop_size[0], dtype=np.int32):
+        for x in np.linspace(0, padding_size[1] * 2, crop_size[1], dtype=np.int32):
+            crop = CropTTA((int(y), int(x)), padding_size, padding_mode)
+            for fv, fh in flips:
+                if fv or fh:
+                    transforms.append(ComposeTTA([crop, FlipTTA(fv, fh)]))
+                else:
+                    transforms.append(crop)
+    transforms.extend(ScaleTTA(scale) for scale in scales)
+    return transforms
+
+
+def predict_on_batch_tta(
+    model: tf.keras.models.Model,
+    X_batch: np.ndarray,
+    transforms: typing.Sequence[TTATransform] = None,
+    reduce: str = "mean",
+    dense: typing.Union[bool, typing.Sequence[bool]] = False,
+    micro_batch_size: int = None,
+) -> typing.Union[np.ndarray, typing.List[np.ndarray]]:
+    """ミニバッチ1個分の推論処理＆TTA。(結果はその場で集計する)
+
+    predict_on_batch_augmentedと異なり、変換1つ・micro_batch_size件ずつ推論して
+    集計していくため、使用メモリは変換の数に依存しない。
+    tk.models.predictのon_batch_fnにfunctools.partialなどで渡して使う想定。
+
+    Args:
+        model: モデル。
+        X_batch: データ。
+        transforms: 変換のリスト。Noneならmake_tta_transforms()の既定値。
+        reduce: 集計方法。"mean", "gmean"(幾何平均), "max"のいずれか。
+        dense: 出力が画像などで、逆変換をしてから集計するならTrue。(4次元の出力のみ対象)
+               出力ごとに指定する場合はboolのリスト。
+        micro_batch_size: 1回に推論する件数。Noneならlen(X_batch)。
+
+    Returns:
+        集計後の推論結果。
+
+    """
+    assert reduce in ("mean", "gmean", "max"), f"Invalid reduce: {reduce}"
+    X_batch = np.asarray(X_batch)
+    transforms = make_tta_transforms() if transforms is None else transforms
+    assert len(transforms) > 0
+    micro_batch_size = micro_batch_size or len(X_batch)
+
+    outputs: typing.Optional[typing.List[np.ndarray]] = None
+    multiple_output = False
+    for start in range(0, len(X_batch), micro_batch_size):
+        X_micro = X_batch[start : start + micro_batch_size]
+        acc: typing.Optional[typing.List[np.ndarray]] = None
+        for t in transforms:
+            result = model.predict_on_batch(np.ascontiguousarray(t.apply(X_micro)))
+            multiple_output = isinstance(result, (list, tuple))
+            preds = [
+                np.asarray(r, dtype=np.float32)
+                for r in (result if multiple_output else [result])
+            ]
+            if isinstance(dense, bool):
+                dense_flags = [dense and p.ndim == 4 for p in preds]
+            else:
+                dense_flags = list(dense)
+                assert len(dense_flags) == len(preds), f"{dense=} {len(preds)=}"
+            preds = [
+                t.inverse(p, X_micro.shape) if d else p
+                for p, d in zip(preds, dense_flags)
+            ]
+            acc = _fold_tta(acc, preds, reduce)
+        assert acc is not None
+        if reduce == "mean":
+            acc = [a / len(transforms) for a in acc]
+        elif reduce == "gmean":
+            acc = [np.exp(a / len(transforms)) for a in acc]
+
+        if outputs is None:
+            outputs = [
+                np.empty((len(X_batch),) + a.shape[1:], dtype=np.float32) for a in acc
+            ]
+        for o, a in zip(outputs, acc):
+            o[start : start + len(X_micro)] = a
+    assert outputs is not None
+    return outputs if multiple_output else outputs[0]
+
+
+def _fold_tta(
+    acc: typing.Optional[typing.List[np.ndarray]],
+    preds: typing.List[np.ndarray],
+    reduce: str,
+) -> typing.List[np.ndarray]:
+    """TTAの結果を集計中の値に加える。(meanとgmeanは和を取っておいて最後に割る)"""
+    if reduce == "gmean":
+        preds = [np.log(np.maximum(p, 1e-7)) for p in preds]
+    if acc is None:
+        return [np.array(p) for p in preds]  # 反転などのviewの場合があるのでコピー
+    for a, p in zip(acc, preds):
+        if reduce == "max":
+            np.maximum(a, p, out=a)
+        else:
+            a += p
+    return acc
+
+
+def predict_tiled(
+    model: tf.keras.models.Model,
+    image: np.ndarray,
+    tile_size: typing.Tuple[int, int],
+    overlap: typing.Tuple[int, int] = (32, 32),
+    batch_size: int = 8,
+    blend: str = "gaussian",
+    flip: typing.Tuple[bool, bool] = (False, False),
+    output: np.ndarray = None,
+    output_path: tk.typing.PathLike = None,
+    max_queue_size: int = 2,
+    padding_mode: str = "edge",
+) -> np.ndarray:
+    """大きな画像をタイルに分けて推論し、結果を重み付きで繋ぎ合わせる。(セグメンテーションなど用)
+
+    タイルの切り出しは別スレッドで行い、最大max_queue_size個のミニバッチを先読みする。
+    TTA(反転)はタイルごとに行い、平均をその場で更新する。
+    使用メモリはタイルのバッチサイズ分と出力先のみで、画像サイズには(出力先以外)依存しない。
+
+    Args:
+        model: 画像を入力し、画像(縦横は入力と同じか整数分の1)を出力するモデル。
+        image: 入力画像 (H, W, C)。np.memmapなども可。
+        tile_size: タイルのサイズ (h, w)
+        overlap: タイル同士の重なりの最小値 (v, h)
+        batch_size: 1回に推論するタイルの数
+        blend: 重なり部分の重み付け。"gaussian", "linear", "none"
+        flip: 水平/垂直方向の反転によるTTAを行うか否か。(v, h)
+        output: 出力先の配列。Noneなら作成する。(0埋めしてから使う)
+        output_path: outputがNoneの場合、出力先をこのパスの.npyのメモリマップで作成する。
+        max_queue_size: 先読みするミニバッチの最大数
+        padding_mode: 画像の端のタイルのパディングの種類。(np.padのmode)
+
+    Returns:
+        推論結果 (H / r, W / r, 出力チャンネル数) dtype=np.float32
+
+    """
+    assert blend in ("gaussian", "linear", "none"), f"Invalid blend: {blend}"
+    h, w = image.shape[:2]
+    th, tw = tile_size
+    output_shape = tuple(
+        model.compute_output_shape((batch_size, th, tw) + image.shape[2:])
+    )
+    oh, ow = output_shape[1:3]
+    assert (
+        th % oh == 0 and tw % ow == 0
+    ), f"Invalid output size: {output_shape} (tile_size={tile_size})"
+    ry, rx = th // oh, tw // ow
+
+    # タイルの位置 (出力の画素の位置に揃える)
+    ys = _tile_positions(h, th, overlap[0], ry)
+    xs = _tile_positions(w, tw, overlap[1], rx)
+    positions = [(y, x) for y in ys for x in xs]
+
+    # 重みは縦横で分離できるので、重みの合計も縦横それぞれで計算しておく
+    out_h, out_w = -(-h // ry), -(-w // rx)
+    wy = _tile_weights(oh, overlap[0] // ry, blend)
+    wx = _tile_weights(ow, overlap[1] // rx, blend)
+    sum_y = np.zeros((ys[-1] // ry + oh,), dtype=np.float32)
+    sum_x = np.zeros((xs[-1] // rx + ow,), dtype=np.float32)
+    for y in ys:
+        sum_y[y // ry : y // ry + oh] += wy
+    for x in xs:
+        sum_x[x // rx : x // rx + ow] += wx
+
+    if output is None:
+        shape = (out_h, out_w, output_shape[-1])
+        if output_path is None:
+            output = np.zeros(shape, dtype=np.float32)
+        else:
+            output = np.lib.format.open_memmap(
+                str(output_path), mode="w+", dtype=np.float32, shape=shape
+            )
+    else:
+        assert output.shape[:2] == (out_h, out_w), f"{output.shape=}"
+        output[...] = 0
+
+    # タイルの切り出しは別スレッドで行う
+    tiles_queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+    stop_event = threading.Event()
+
+    def put(item) -> bool:
+        # 消費側が止まった場合(stop_event)は諦める
+        while not stop_event.is_set():
+            try:
+                tiles_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for i in range(0, len(positions), batch_size):
+                if stop_event.is_set():
+                    return
+                batch_positions = positions[i : i + batch_size]
+                X_batch = np.array(
+                    [
+                        _extract_tile(image, y, x, tile_size, padding_mode)
+                        for y, x in batch_positions
+                    ]
+                )
+                if not put((batch_positions, X_batch)):
+                    return
+        except BaseException as e:  # pylint: disable=broad-except
+            put(e)
+        else:
+            put(None)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = tiles_queue.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            batch_positions, X_batch = item
+            pred_batch = _predict_tiles_augmented(model, X_batch, flip)
+            for (y, x), pred in zip(batch_positions, pred_batch):
+                oy, ox = y // ry, x // rx
+                weights = (wy / sum_y[oy : oy + oh])[:, np.newaxis] * (
+                    wx / sum_x[ox : ox + ow]
+                )[np.newaxis, :]
+                vh, vw = min(oh, out_h - oy), min(ow, out_w - ox)
+                output[oy : oy + vh, ox : ox + vw] += (
+                    pred[:vh, :vw] * weights[:vh, :vw, np.newaxis]
+                )
+    finally:
+        stop_event.set()
+        thread.join()
+    return output
+
+
+def _tile_positions(size: int, tile: int, overlap: int, align: int) -> typing.List[int]:
+    """タイルの開始位置のリストを返す。(alignの倍数にする)"""
+    stride = max(align, (tile - overlap) // align * align)
+    last = max(-(-(size - tile) // align) * align, 0)
+    positions = list(range(0, last, stride))
+    positions.append(last)
+    return positions
+
+
+def _tile_weights(size: int, overlap: int, blend: str) -> np.ndarray:
+    """タイルの1方向の重みを返す。"""
+    if blend == "gaussian":
+        # 中心ほど重くする (σはタイルサイズの1/8)
+        x = np.arange(size) - (size - 1) / 2
+        w = np.exp(-(x ** 2) / (2 * (size / 8) ** 2))
+    elif blend == "linear":
+        # 端からoverlapの範囲で線形に重くする
+        i = np.arange(size)
+        w = np.minimum(np.minimum(i + 1, size - i) / (max(overlap, 1) + 1), 1)
+    else:
+        w = np.ones((size,))
+    # 画像の端はタイル1枚だけなので、重みが0にならないようにしておく
+    return np.maximum(w, 1e-3).astype(np.float32)
+
+
+def _extract_tile(
+    image: np.ndarray, y: int, x: int, tile_size: typing.Tuple[int, int], mode: str
+) -> np.ndarray:
+    """画像からタイルを切り出す。(はみ出す部分はパディング)"""
+    tile = np.asarray(image[y : y + tile_size[0], x : x + tile_size[1]])
+    pad_h, pad_w = tile_size[0] - tile.shape[0], tile_size[1] - tile.shape[1]
+    if pad_h > 0 or pad_w > 0:
+        pad_width = [(0, pad_h), (0, pad_w)] + [(0, 0)] * (tile.ndim - 2)
+        tile = np.pad(tile, pad_width, mode=mode)
+    return tile
+
+
+def _predict_tiles_augmented(
+    model: tf.keras.models.Model, X_batch: np.ndarray, flip: typing.Tuple[bool, bool]
+) -> np.ndarray:
+    """タイルのミニバッチの推論＆TTA。(反転を戻して平均をその場で更新する)"""
+    flips = [(False, False)]
+    if flip[0]:
+        flips.append((True, False))
+    if flip[1]:
+        flips.append((False, True))
+    if flip[0] and flip[1]:
+        flips.append((True, True))
+
+    def apply_flip(x, fv, fh):
+        if fv:
+            x = x[:, ::-1, :, :]
+        if fh:
+            x = x[:, :, ::-1, :]
+        return x
+
+    mean = None
+    for i, (fv, fh) in enumerate(flips):
+        pred = np.asarray(
+            model.predict_on_batch(apply_flip(X_batch, fv, fh)), dtype=np.float32
+        )
+        pred = apply_flip(pred, fv, fh)
+        if mean is None:
+            mean = np.array(pred)  # 反転のviewの場合があるのでコピー
+        else:
+            mean += (pred - mean) / (i + 1)
+    assert mean is not None
+    return mean
+
+
 def fingerprint(model: tf.keras.models.Model) -> str:
     """重みの同一性を確認するための文字列を作成して返す。"xx:xx:xx:xx"形式。"""
+    return _fingerprint(model.get_weights())
+
+
+def _fingerprint(weights: typing.List[np.ndarray]) -> str:
     m = hashlib.sha256()
-    for w in model.get_weights():
+    for w in weights:
         m.update(w.tobytes())
     h = m.hexdigest()
     return f"{h[:2]}:{h[2:4]}:{h[4:6]}:{h[6:8]}"
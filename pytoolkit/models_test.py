@@ -30,6 +30,26 @@ def test_save(tmpdir, mode):
         tk.models.load(path)
 
 
+def test_save_async(tmpdir):
+    path = str(tmpdir / "model.h5")
+
+    inputs = x = tf.keras.layers.Input((32, 32, 3))
+    x = tf.keras.layers.Conv2D(16, 3, padding="same")(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    model = tf.keras.models.Model(inputs, x)
+    tk.models.save(model, path, async_write=True)
+    expected = model.get_weights()
+    model.set_weights([-np.ones_like(w) for w in expected])  # 保存中に変更
+    tk.models.wait_for_save()
+
+    loaded_model = tk.models.load(path)
+    assert tk.models.fingerprint(loaded_model) != tk.models.fingerprint(model)
+    for w1, w2 in zip(loaded_model.get_weights(), expected):
+        assert (w1 == w2).all()
+    tk.models.load_weights(model, path)
+
+
 @pytest.mark.parametrize("output_count", [1, 2])
 def test_predict_flow(output_count):
     def on_batch(model, X_batch):
@@ -55,6 +75,39 @@ def test_predict_flow(output_count):
         assert (result[1] == dataset.data).all()
 
 
+@pytest.mark.parametrize("output_type", ["single", "list", "dict"])
+def test_predict_output_dir(tmpdir, output_type):
+    def on_batch(model, X_batch):
+        assert model is None
+        X_batch = X_batch.numpy()
+        if output_type == "single":
+            return X_batch
+        elif output_type == "list":
+            return [X_batch, X_batch * 2]
+        else:
+            return {"a": X_batch, "b": X_batch * 2}
+
+    dataset = tk.data.Dataset(data=np.arange(5, dtype=np.float32))
+    result = tk.models.predict(
+        model=None,
+        iterator=tk.data.DataLoader(batch_size=2).load(dataset),
+        on_batch_fn=on_batch,
+        output_dir=str(tmpdir),
+    )
+    if output_type == "single":
+        assert isinstance(result, np.memmap)
+        assert (result == dataset.data).all()
+        assert (np.load(str(tmpdir / "output.npy")) == dataset.data).all()
+    elif output_type == "list":
+        assert isinstance(result, list)
+        assert (result[1] == dataset.data * 2).all()
+        assert (np.load(str(tmpdir / "output_1.npy")) == dataset.data * 2).all()
+    else:
+        assert isinstance(result, dict)
+        assert (result["b"] == dataset.data * 2).all()
+        assert (np.load(str(tmpdir / "b.npy")) == dataset.data * 2).all()
+
+
 @pytest.mark.parametrize("output_count", [1, 2])
 def test_predict_on_batch_augmented(output_count):
     inputs = tf.keras.layers.Input((32, 32, 3))
@@ -76,3 +129,121 @@ def test_predict_on_batch_augmented(output_count):
         assert len(result) == output_count
         assert result[0].shape == (2 * 3 * 3, 4, 32, 32, 3)
         assert result[1].shape == (2 * 3 * 3, 4, 32, 32, 3)
+
+
+@pytest.mark.parametrize("reduce", ["mean", "gmean", "max"])
+def test_predict_on_batch_tta(reduce):
+    inputs = tf.keras.layers.Input((None, None, 3))
+    x = tf.keras.layers.Conv2D(4, 3, padding="same", activation="sigmoid")(inputs)
+    outputs = [x, tf.keras.layers.GlobalAveragePooling2D()(x)]
+    model = tf.keras.models.Model(inputs, outputs)
+    X_batch = np.random.uniform(size=(5, 32, 32, 3)).astype(np.float32)
+
+    # predict_on_batch_augmentedの集計と一致する
+    result = tk.models.predict_on_batch_tta(
+        model,
+        X_batch,
+        transforms=tk.models.make_tta_transforms(flip=(True, True)),
+        reduce=reduce,
+        micro_batch_size=2,
+    )
+    expected = tk.models.predict_on_batch_augmented(model, X_batch, flip=(True, True))
+    if reduce == "mean":
+        expected = [e.mean(axis=0) for e in expected]
+    elif reduce == "gmean":
+        expected = [np.exp(np.log(e).mean(axis=0)) for e in expected]
+    else:
+        expected = [e.max(axis=0) for e in expected]
+    assert isinstance(result, list)
+    assert result[0] == pytest.approx(expected[0], abs=1e-5)
+    assert result[1] == pytest.approx(expected[1], abs=1e-5)
+
+    # 恒等写像なら逆変換すると元に戻る (平行移動ははみ出した部分以外)
+    inputs = tf.keras.layers.Input((None, None, 3))
+    model = tf.keras.models.Model(inputs, inputs * 1)
+    result = tk.models.predict_on_batch_tta(
+        model,
+        X_batch,
+        transforms=tk.models.make_tta_transforms(
+            flip=(True, True), crop_size=(1, 1), padding_size=(0, 0)
+        ),
+        reduce=reduce,
+        dense=True,
+    )
+    assert result == pytest.approx(X_batch, abs=1e-5)
+    result = tk.models.predict_on_batch_tta(
+        model,
+        X_batch,
+        transforms=tk.models.make_tta_transforms(
+            flip=(True, True), crop_size=(3, 3), padding_size=(2, 2)
+        ),
+        reduce=reduce,
+        dense=True,
+    )
+    assert result[:, 2:-2, 2:-2] == pytest.approx(X_batch[:, 2:-2, 2:-2], abs=1e-5)
+    # 拡大・縮小は元のサイズに戻す
+    result = tk.models.predict_on_batch_tta(
+        model,
+        X_batch,
+        transforms=[tk.models.ScaleTTA(0.5), tk.models.ScaleTTA(1.5)],
+        reduce=reduce,
+        dense=True,
+    )
+    assert result.shape == X_batch.shape
+    # 画像以外の出力は逆変換しない
+    x = inputs * 1
+    model = tf.keras.models.Model(
+        inputs, [x, tf.keras.layers.GlobalAveragePooling2D()(x)]
+    )
+    result = tk.models.predict_on_batch_tta(
+        model,
+        X_batch,
+        transforms=tk.models.make_tta_transforms(flip=(True, True), crop_size=(1, 1)),
+        reduce=reduce,
+        dense=True,
+    )
+    assert result[1].shape == (5, 3)
+
+
+@pytest.mark.parametrize("blend", ["gaussian", "linear", "none"])
+def test_predict_tiled(tmpdir, blend):
+    inputs = tf.keras.layers.Input((None, None, 3))
+    x = tf.keras.layers.AveragePooling2D()(inputs)
+    model = tf.keras.models.Model(inputs, x)
+
+    image = np.random.uniform(size=(50, 70, 3)).astype(np.float32)
+    expected = model.predict(image[np.newaxis])[0]
+    result = tk.models.predict_tiled(
+        model,
+        image,
+        tile_size=(32, 32),
+        overlap=(8, 8),
+        batch_size=3,
+        blend=blend,
+        flip=(True, True),
+        output_path=str(tmpdir / "output.npy"),
+    )
+    assert result.shape == (25, 35, 3)
+    assert result == pytest.approx(expected, abs=1e-5)
+    assert np.load(str(tmpdir / "output.npy"), mmap_mode="r").shape == (25, 35, 3)
+
+
+def test_predict_tiled_error():
+    """推論でエラーが起きてもタイルの切り出し側が止まること"""
+
+    class BrokenModel:
+        def compute_output_shape(self, input_shape):
+            return input_shape
+
+        def predict_on_batch(self, X_batch):
+            raise ValueError("broken")
+
+    with pytest.raises(ValueError):
+        tk.models.predict_tiled(
+            BrokenModel(),
+            np.zeros((256, 256, 3), dtype=np.float32),
+            tile_size=(16, 16),
+            overlap=(0, 0),
+            batch_size=1,
+            max_queue_size=1,
+        )
@@ -3,6 +3,7 @@
 uint8のRGBで0～255として扱うのを前提とする。
 あとグレースケールの場合もrows×cols×1の配列で扱う。
 """
+import concurrent.futures
 import io
 import pathlib
 import random
@@ -12,6 +13,7 @@ import warnings
 import cv2
 import numba
 import numpy as np
+import pandas as pd
 import PIL.Image
 import PIL.ImageOps
 
@@ -19,8 +21,41 @@ import PIL.ImageOps
 def load(
     path_or_array: typing.Union[np.ndarray, io.IOBase, str, pathlib.Path],
     grayscale=False,
+    target_size: typing.Tuple[int, int] = None,
 ) -> np.ndarray:
-    """画像の読み込み。"""
+    """画像の読み込み。
+
+    Args:
+        path_or_array: 画像ファイルのパスなど。ndarrayならコピーして返す。
+        grayscale: グレースケールで読み込むならTrue
+        target_size: 縮小して使う場合の目安のサイズ (H, W)。
+                     JPEGの場合、このサイズを下回らない範囲で1/2～1/8に縮小しながらデコードする。(高速・省メモリ)
+                     縮小された倍率はload_scaledで取得できる。
+
+    """
+    return load_scaled(path_or_array, grayscale=grayscale, target_size=target_size)[0]
+
+
+def load_scaled(
+    path_or_array: typing.Union[np.ndarray, io.IOBase, str, pathlib.Path],
+    grayscale=False,
+    target_size: typing.Tuple[int, int] = None,
+) -> typing.Tuple[np.ndarray, typing.Tuple[float, float]]:
+    """画像の読み込み。(縮小された倍率も返す版)
+
+    ピクセル単位の座標(キーポイントなど)を扱う場合は、返された倍率を掛けて補正すること。
+    (bounding boxなど[0, 1]の相対座標の場合は補正不要)
+
+    Args:
+        path_or_array: 画像ファイルのパスなど。ndarrayならコピーして返す。
+        grayscale: グレースケールで読み込むならTrue
+        target_size: 縮小して使う場合の目安のサイズ (H, W)。(loadを参照)
+
+    Returns:
+        画像と、元の画像に対する縦横の倍率((scale_y, scale_x)。縮小しなければ(1, 1))のtuple
+
+    """
+    scale = (1.0, 1.0)
     if isinstance(path_or_array, np.ndarray):
         # ndarrayならそのまま画像扱い
         img = np.copy(path_or_array)  # 念のためコピー
@@ -36,8 +71,8 @@ def load(
             img = _load_npy(path_or_array)
         else:
             # PILで読み込む
-            pil_img = _load_pil(path_or_array)
             target_mode = "L" if grayscale else "RGB"
+            pil_img, scale = _load_pil_scaled(path_or_array, target_size, target_mode)
             if pil_img.mode != target_mode:
                 pil_img = pil_img.convert(target_mode)
             img = np.asarray(pil_img, dtype=np.uint8)
@@ -48,7 +83,7 @@ def load(
         img = np.expand_dims(img, axis=-1)
     if len(img.shape) != 3:
         raise ValueError(f"Image load failed: shape={path_or_array}")
-    return img
+    return img, scale
 
 
 def _load_npy(path_or_array):
@@ -66,8 +101,33 @@ def _load_npy(path_or_array):
 
 def _load_pil(path_or_array):
     """PILによる画像の読み込み。"""
+    return _load_pil_scaled(path_or_array)[0]
+
+
+def _load_pil_scaled(
+    path_or_array,
+    target_size: typing.Tuple[int, int] = None,
+    mode: str = None,
+) -> typing.Tuple[PIL.Image.Image, typing.Tuple[float, float]]:
+    """PILによる画像の読み込み。
+
+    target_sizeを指定した場合、JPEGならdraft modeでDCTの段階で縮小してデコードする。
+
+    """
     try:
         with PIL.Image.open(path_or_array) as pil_img:
+            scale = (1.0, 1.0)
+            if target_size is not None and pil_img.format == "JPEG":
+                # draftはEXIFの回転前のサイズで指定するので、90度回転なら縦横を入れ替える
+                swap = _get_exif_orientation(pil_img) in (5, 6, 7, 8)
+                target_h, target_w = target_size
+                if swap:
+                    target_h, target_w = target_w, target_h
+                original_w, original_h = pil_img.size
+                pil_img.draft(mode, (target_w, target_h))
+                scale = (pil_img.size[1] / original_h, pil_img.size[0] / original_w)
+                if swap:
+                    scale = (scale[1], scale[0])
             try:
                 pil_img = PIL.ImageOps.exif_transpose(pil_img)
             except Exception as e:
@@ -75,11 +135,19 @@ def _load_pil(path_or_array):
                 # https://github.com/python-pillow/Pillow/issues/3973
                 # これに限らず失敗時も害はそれほど無いと思われるので無視する。
                 warnings.warn(f"{type(e).__name__}: {e}")
-            return pil_img
+            return pil_img, scale
     except Exception as e:
         raise ValueError(f"Image load failed: {path_or_array}") from e
 
 
+def _get_exif_orientation(pil_img: PIL.Image.Image) -> int:
+    """EXIFのOrientationを返す。(無ければ1)"""
+    try:
+        return int(pil_img.getexif().get(0x0112, 1))
+    except Exception:
+        return 1
+
+
 def get_image_size(
     path_or_array: typing.Union[np.ndarray, io.IOBase, str, pathlib.Path]
 ) -> typing.Tuple[int, int]:
@@ -105,6 +173,121 @@ def get_image_size(
             return pil_img.height, pil_img.width
 
 
+def scan(
+    paths: typing.Sequence[typing.Union[str, pathlib.Path]],
+    workers: int = None,
+    cache_path: typing.Union[str, pathlib.Path] = None,
+) -> pd.DataFrame:
+    """画像ファイルのヘッダーのみを読み込み、サイズなどの一覧を作る。(デコードはしない)
+
+    バケット分けやファイルのチェックなどに使う。
+    (例: dataset.metadata["image_sizes"] = index[["height", "width"]].to_numpy())
+
+    Args:
+        paths: 画像ファイルのパスのリスト
+        workers: 並列数 (スレッド数)。Noneならconcurrent.futures.ThreadPoolExecutorの既定値。
+        cache_path: 結果を保存するパス(pickle)。
+                    既に存在すれば読み込み、ファイルサイズと更新日時が変わっていないものは再利用する。
+
+    Returns:
+        pathsと同じ順番のDataFrame。列は以下の通り。
+
+        - path: パス
+        - height, width: EXIFのOrientationを適用した後の画像サイズ (tk.ndimage.loadの結果と同じ)
+        - channels: チャンネル数
+        - format: 画像形式 ("JPEG", "PNG", "NPY"など)
+        - orientation: EXIFのOrientation (無ければ1)
+        - bytes: ファイルサイズ
+        - mtime: 更新日時
+        - error: 読み込めなかったならTrue (その場合サイズなどは0)
+
+    """
+    paths = [str(p) for p in paths]
+    cache_path = None if cache_path is None else pathlib.Path(cache_path)
+    cached: typing.Dict[str, typing.Tuple[typing.Any, ...]] = {}
+    if cache_path is not None and cache_path.exists():
+        cached_df = pd.read_pickle(str(cache_path))
+        cached = {row[0]: row for row in cached_df.itertuples(index=False, name=None)}
+
+    def scan_file(path: str) -> typing.Tuple[typing.Any, ...]:
+        try:
+            stat = pathlib.Path(path).stat()
+        except OSError:
+            return (path, 0, 0, 0, "", 1, 0, 0.0, True)
+        row = cached.get(path)
+        if row is not None and row[6] == stat.st_size and row[7] == stat.st_mtime:
+            return row
+        try:
+            h, w, c, fmt, orientation = _read_image_header(path)
+            return (path, h, w, c, fmt, orientation, stat.st_size, stat.st_mtime, False)
+        except Exception:
+            return (path, 0, 0, 0, "", 1, stat.st_size, stat.st_mtime, True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(scan_file, paths))
+
+    columns = [
+        "path",
+        "height",
+        "width",
+        "channels",
+        "format",
+        "orientation",
+        "bytes",
+        "mtime",
+        "error",
+    ]
+    df = pd.DataFrame(rows, columns=columns)
+    df = df.astype(
+        {
+            "height": np.int32,
+            "width": np.int32,
+            "channels": np.int8,
+            "format": "category",
+            "orientation": np.int8,
+            "bytes": np.int64,
+            "mtime": np.float64,
+            "error": bool,
+        }
+    )
+    if cache_path is not None:
+        # 以前の結果のうち今回対象外のものも残しておく
+        paths_set = set(paths)
+        others = [row for path, row in cached.items() if path not in paths_set]
+        to_save = pd.concat([df, pd.DataFrame(others, columns=columns)]).astype(
+            df.dtypes.to_dict()
+        )
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        to_save.to_pickle(str(tmp_path))
+        tmp_path.replace(cache_path)
+    return df
+
+
+def _read_image_header(path: str) -> typing.Tuple[int, int, int, str, int]:
+    """画像ファイルのヘッダーから(H, W, C, 形式, EXIFのOrientation)を返す。"""
+    suffix = pathlib.Path(path).suffix.lower()
+    if suffix == ".npy":
+        # mmapならヘッダーのみ読み込まれる
+        img = np.load(path, mmap_mode="r")
+        shape = img.shape
+        fmt = "NPY"
+    elif suffix == ".npz":
+        shape = _load_npy(path).shape
+        fmt = "NPZ"
+    else:
+        # PIL.Image.openは遅延読み込みなので、ヘッダーのみ読み込まれる
+        with PIL.Image.open(path) as pil_img:
+            orientation = _get_exif_orientation(pil_img)
+            w, h = pil_img.size
+            if orientation in (5, 6, 7, 8):
+                h, w = w, h
+            return h, w, len(pil_img.getbands()), str(pil_img.format), orientation
+    if len(shape) not in (2, 3):
+        raise ValueError(f"Invalid shape: {shape}")
+    return shape[0], shape[1], 1 if len(shape) == 2 else shape[2], fmt, 1
+
+
 def save(
     path: typing.Union[str, pathlib.Path], img: np.ndarray, jpeg_quality: int = None
 ):
@@ -170,13 +353,13 @@ def rotate(
         rgb = cv2.warpAffine(rgb, m, (w, h), flags=cv2_interp, borderMode=cv2_border)
         rgb = ensure_channel_dim(rgb)
     else:
-        rotated_list = [
-            cv2.warpAffine(
-                rgb[:, :, ch], m, (w, h), flags=cv2_interp, borderMode=cv2_border
-            )
-            for ch in range(rgb.shape[-1])
-        ]
-        rgb = np.transpose(rotated_list, (1, 2, 0))
+        rgb = apply_channel_groups(
+            rgb,
+            lambda x: cv2.warpAffine(
+                x, m, (w, h), flags=cv2_interp, borderMode=cv2_border
+            ),
+            (h, w),
+        )
     return rgb
 
 
@@ -311,14 +494,54 @@ def resize(
         rgb = cv2.resize(rgb, (width, height), interpolation=cv2_interp)
         rgb = ensure_channel_dim(rgb)
     else:
-        resized_list = [
-            cv2.resize(rgb[:, :, ch], (width, height), interpolation=cv2_interp)
-            for ch in range(rgb.shape[-1])
-        ]
-        rgb = np.transpose(resized_list, (1, 2, 0))
+        rgb = apply_channel_groups(
+            rgb,
+            lambda x: cv2.resize(x, (width, height), interpolation=cv2_interp),
+            (height, width),
+        )
     return rgb
 
 
+def apply_channel_groups(
+    rgb: np.ndarray,
+    fn: typing.Callable[[np.ndarray], np.ndarray],
+    output_size: typing.Tuple[int, int],
+) -> np.ndarray:
+    """OpenCVの関数を4チャンネルを超える画像に適用する。
+
+    OpenCVが一度に扱える4チャンネルずつに分けてfnを呼び出し、
+    結果を事前に確保した出力配列に書き込む。
+
+    Args:
+        rgb: 入力画像 (H, W, C)
+        fn: 4チャンネル以下の画像を受け取って処理する関数 (リサイズ・変形など)
+        output_size: 出力サイズ (H, W)
+
+    Returns:
+        出力画像 (output_size[0], output_size[1], C)
+
+    """
+    output_size = (int(output_size[0]), int(output_size[1]))
+    num_channels = rgb.shape[-1]
+    output = np.empty(output_size + (num_channels,), dtype=rgb.dtype)
+    for c in range(0, num_channels, 4):
+        n = min(4, num_channels - c)
+        group = np.ascontiguousarray(rgb[:, :, c : c + n])
+        output[:, :, c : c + n] = fn(group).reshape(output_size + (n,))
+    return output
+
+
+def to_border_value4(border_value) -> typing.Optional[typing.Tuple[float, ...]]:
+    """cv2のborderValueをチャンネルごとにまとめて処理する場合用に4チャンネル分にする。
+
+    スカラーやリストの先頭の値を全チャンネルに使う。(Noneならそのまま)
+
+    """
+    if border_value is None:
+        return None
+    return (float(np.ravel(border_value)[0]),) * 4
+
+
 def gaussian_noise(
     rgb: np.ndarray, random_state: np.random.RandomState, scale: float
 ) -> np.ndarray:
@@ -434,6 +657,97 @@ def equalize(rgb: np.ndarray) -> np.ndarray:
     return to_uint8(rgb)
 
 
+def apply_color_stages(
+    rgb: np.ndarray,
+    stages: typing.Sequence[typing.Tuple[str, typing.Any]],
+) -> np.ndarray:
+    """画素ごとの色変換を複数まとめて1パスで適用する。
+
+    各段階は以下のいずれか。段階ごとに0～255への丸め(to_uint8相当)を行うので、
+    1つずつ適用した場合と(浮動小数点数の誤差を除き)同じ結果になる。
+
+    - ("lut", lut): 全チャンネル共通の256要素のルックアップテーブル (連続するものは合成する)
+    - ("matrix", (matrix, offset)): チャンネル数×チャンネル数の行列とオフセットによる線形変換
+
+    Args:
+        rgb: 画像
+        stages: 変換の段階のリスト
+
+    Returns:
+        変換後の画像
+
+    """
+    rgb = ensure_channel_dim(rgb)
+    num_channels = rgb.shape[-1]
+    kinds: typing.List[int] = []
+    luts: typing.List[np.ndarray] = []
+    matrices: typing.List[np.ndarray] = []
+    offsets: typing.List[np.ndarray] = []
+    for kind, value in stages:
+        if kind == "lut":
+            lut = np.asarray(value, dtype=np.uint8).reshape((256,))
+            if len(kinds) > 0 and kinds[-1] == 0:
+                # 連続するLUTは合成できる
+                luts[-1] = lut[luts[-1]]
+                continue
+            kinds.append(0)
+            luts.append(lut)
+            matrices.append(np.eye(num_channels, dtype=np.float32))
+            offsets.append(np.zeros((num_channels,), dtype=np.float32))
+        else:
+            assert kind == "matrix", f"Invalid stage: {kind}"
+            matrix, offset = value
+            kinds.append(1)
+            luts.append(np.arange(256, dtype=np.uint8))
+            matrices.append(np.asarray(matrix, dtype=np.float32))
+            offsets.append(np.asarray(offset, dtype=np.float32))
+    if len(kinds) <= 0:
+        return rgb
+    if kinds == [0]:
+        return cv2.LUT(rgb, luts[0]).reshape(rgb.shape)
+    return _apply_color_stages(
+        np.ascontiguousarray(rgb),
+        np.array(kinds, dtype=np.int32),
+        np.stack(luts),
+        np.stack(matrices),
+        np.stack(offsets),
+    )
+
+
+@numba.njit(fastmath=True, nogil=True)
+def _apply_color_stages(
+    rgb: np.ndarray,
+    kinds: np.ndarray,
+    luts: np.ndarray,
+    matrices: np.ndarray,
+    offsets: np.ndarray,
+) -> np.ndarray:
+    height, width, num_channels = rgb.shape
+    out = np.empty_like(rgb)
+    v = np.empty((num_channels,), dtype=np.float32)
+    t = np.empty((num_channels,), dtype=np.float32)
+    for y in range(height):
+        for x in range(width):
+            for c in range(num_channels):
+                v[c] = rgb[y, x, c]
+            for s in range(len(kinds)):
+                if kinds[s] == 0:
+                    for c in range(num_channels):
+                        v[c] = luts[s, int(v[c])]
+                else:
+                    for c in range(num_channels):
+                        a = offsets[s, c]
+                        for k in range(num_channels):
+                            a += matrices[s, c, k] * v[k]
+                        t[c] = a
+                    for c in range(num_channels):
+                        # to_uint8と同じく切り捨て
+                        v[c] = np.floor(min(max(t[c], np.float32(0)), np.float32(255)))
+            for c in range(num_channels):
+                out[y, x, c] = np.uint8(v[c])
+    return out
+
+
 # @numba.njit(fastmath=True, nogil=True)  # TypingError: numba doesn't support kwarg for mean
 def auto_contrast(rgb: np.ndarray, scale=255) -> np.ndarray:
     """オートコントラスト。"""
@@ -642,18 +956,19 @@ def perspective_transform(
         )
         rgb = ensure_channel_dim(rgb)
     else:
-        resized_list = [
-            cv2.warpPerspective(
-                rgb[:, :, ch],
+        borderValue4 = to_border_value4(borderValue)
+        rgb = apply_channel_groups(
+            rgb,
+            lambda x: cv2.warpPerspective(
+                x,
                 m,
                 (width, height),
                 flags=cv2_interp,
                 borderMode=cv2_border,
-                borderValue=borderValue,
-            )
-            for ch in range(rgb.shape[-1])
-        ]
-        rgb = np.transpose(resized_list, (1, 2, 0))
+                borderValue=borderValue4,
+            ),
+            (height, width),
+        )
     assert rgb.ndim == 3
     return rgb
 
@@ -875,15 +1190,19 @@ def deprocess_torch(rgb, clip=True):
     return rgb.astype(np.uint8)
 
 
-# @numba.njit(fastmath=True, nogil=True)
 def mask_to_onehot(
-    rgb: np.ndarray, class_colors: np.ndarray, append_bg: bool = False
+    rgb: np.ndarray,
+    class_colors: np.ndarray,
+    append_bg: bool = False,
+    void_colors: np.ndarray = None,
 ) -> np.ndarray:
     """RGBのマスク画像をone-hot形式に変換する。
 
     Args:
         class_colors: 色の配列。shape=(num_classes, 3)
         append_bg: class_colorsに該当しない色のクラスを追加するならTrue。
+        void_colors: 評価対象外の色の配列。shape=(M, 3)。(Dataset.metadata["void_colors"]など)
+                     該当するピクセルは全クラス0にする。(append_bgの場合も)
 
     Returns:
         ndarray shape=(H, W, num_classes) dtype=np.float32
@@ -892,50 +1211,144 @@ def mask_to_onehot(
 
     """
     num_classes = len(class_colors) + (1 if append_bg else 0)
-    result = np.zeros((rgb.shape[0], rgb.shape[1], num_classes), np.float32)
-    for i, cc in enumerate(class_colors):
-        result[np.all(rgb == cc, axis=-1), i] = 1
-    if append_bg:
-        result[:, :, -1] = 1 - result[:, :, :-1].sum(axis=-1)
+    # 背景はlen(class_colors)、voidはそれより大きい値にして、範囲外は0にする
+    classes = mask_to_class(
+        rgb,
+        class_colors,
+        void_class=len(class_colors) + 1,
+        void_colors=void_colors,
+        bg_class=len(class_colors),
+    )
+    result = np.empty((rgb.shape[0], rgb.shape[1], num_classes), np.float32)
+    _class_to_onehot(classes, result)
     return result
 
 
-# @numba.njit(fastmath=True, nogil=True)
 def mask_to_class(
-    rgb: np.ndarray, class_colors: np.ndarray, void_class: int = None
+    rgb: np.ndarray,
+    class_colors: np.ndarray,
+    void_class: int = None,
+    void_colors: np.ndarray = None,
+    bg_class: int = None,
 ) -> np.ndarray:
     """RGBのマスク画像をクラスIDの配列に変換する。
 
+    色を24bitの整数にまとめ、ソート済みのパレットを引く処理を1パスで行う。
+
     Args:
         class_colors: 色の配列。shape=(num_classes, 3)
-        void_class: class_colorsに該当しない色のピクセルの値。Noneならlen(class_colors)
+        void_class: void_colorsの色のピクセルの値。Noneならlen(class_colors)
+        void_colors: 評価対象外の色の配列。shape=(M, 3)。(Dataset.metadata["void_colors"]など)
+                     class_colorsと重複する色はclass_colorsの方を優先する。
+        bg_class: class_colorsにもvoid_colorsにも該当しない色のピクセルの値。Noneならvoid_class
 
     Returns:
-        ndarray shape=(H, W) dtype=np.int32
+        ndarray shape=(H, W)。値が全て256未満ならdtype=np.uint8、そうでなければnp.int32
 
     """
     if void_class is None:
         void_class = len(class_colors)
-    result = np.empty(rgb.shape[:2], dtype=np.int32)
-    result[:] = void_class
-    for i, cc in enumerate(class_colors):
-        result[np.all(rgb == cc, axis=-1)] = i
+    if bg_class is None:
+        bg_class = void_class
+    assert rgb.ndim == 3 and rgb.shape[-1] >= 3, f"Invalid mask: {rgb.shape}"
+    max_value = max(len(class_colors) - 1, void_class, bg_class)
+    dtype = np.uint8 if 0 <= min(void_class, bg_class) and max_value < 256 else np.int32
+    keys, values = _make_palette(class_colors, void_colors, void_class, dtype)
+    result = np.empty(rgb.shape[:2], dtype=dtype)
+    _lookup_palette(rgb, keys, values, dtype(bg_class), result)
     return result
 
 
+def _make_palette(
+    class_colors: np.ndarray,
+    void_colors: typing.Optional[np.ndarray],
+    void_class: int,
+    dtype,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """mask_to_class用に、24bitの色とクラスIDの対応をソート済みの配列にする。"""
+    palette: typing.Dict[int, int] = {}
+    if void_colors is not None:
+        for color in np.asarray(void_colors).reshape((-1, 3)):
+            palette[_pack_color(color)] = void_class
+    # class_colorsを優先 (重複時は従来と同じく後のクラスを優先)
+    for i, color in enumerate(np.asarray(class_colors).reshape((-1, 3))):
+        palette[_pack_color(color)] = i
+    keys = np.array(sorted(palette), dtype=np.int32)
+    values = np.array([palette[k] for k in keys], dtype=dtype)
+    return keys, values
+
+
+def _pack_color(color: np.ndarray) -> int:
+    r, g, b = (int(c) for c in color)
+    return (r << 16) | (g << 8) | b
+
+
 @numba.njit(fastmath=True, nogil=True)
-def class_to_mask(classes: np.ndarray, class_colors: np.ndarray) -> np.ndarray:
+def _lookup_palette(rgb, keys, values, default, result):
+    """24bitの色をキーにパレットを引く。(直前のピクセルと同じ色なら探索を省略)"""
+    last_key = -1
+    last_value = default
+    for y in range(rgb.shape[0]):
+        for x in range(rgb.shape[1]):
+            key = (
+                (np.int32(rgb[y, x, 0]) << 16)
+                | (np.int32(rgb[y, x, 1]) << 8)
+                | np.int32(rgb[y, x, 2])
+            )
+            if key != last_key:
+                i = np.searchsorted(keys, key)
+                if i < len(keys) and keys[i] == key:
+                    last_value = values[i]
+                else:
+                    last_value = default
+                last_key = key
+            result[y, x] = last_value
+
+
+@numba.njit(fastmath=True, nogil=True)
+def _class_to_onehot(classes, result):
+    """クラスIDの配列をone-hotにする。(範囲外の値は全クラス0)"""
+    num_classes = result.shape[-1]
+    for y in range(classes.shape[0]):
+        for x in range(classes.shape[1]):
+            c = classes[y, x]
+            for k in range(num_classes):
+                result[y, x, k] = 1 if k == c else 0
+
+
+def class_to_mask(
+    classes: np.ndarray, class_colors: np.ndarray, void_color=(0, 0, 0)
+) -> np.ndarray:
     """クラスIDの配列をRGBのマスク画像に変換する。
 
     Args:
         classes: クラスIDの配列。 shape=(H, W)
         class_colors: 色の配列。shape=(num_classes, 3)
+        void_color: 範囲外のクラスIDのピクセルの色。
 
     Returns:
-        ndarray shape=(H, W, 3)
+        ndarray shape=(H, W, 3) dtype=np.uint8
 
     """
-    return np.asarray(class_colors)[classes]
+    colors = np.concatenate(
+        [np.asarray(class_colors).reshape((-1, 3)), np.reshape(void_color, (1, 3))]
+    ).astype(np.uint8)
+    result = np.empty(classes.shape[:2] + (3,), dtype=np.uint8)
+    _class_to_mask(classes, colors, result)
+    return result
+
+
+@numba.njit(fastmath=True, nogil=True)
+def _class_to_mask(classes, colors, result):
+    void_index = len(colors) - 1
+    for y in range(classes.shape[0]):
+        for x in range(classes.shape[1]):
+            c = classes[y, x]
+            if c < 0 or c >= void_index:
+                c = void_index
+            result[y, x, 0] = colors[c, 0]
+            result[y, x, 1] = colors[c, 1]
+            result[y, x, 2] = colors[c, 2]
 
 
 @numba.njit(fastmath=True, nogil=True)
@@ -1,3 +1,5 @@
+import pathlib
+
 import numpy as np
 import pytest
 import tensorflow as tf
@@ -25,6 +27,69 @@ def test_saveload_gif(data_dir, tmpdir):
     assert (tk.ndimage.load(str(tmpdir.join("output.bmp"))) == img).all()
 
 
+def test_load_draft(data_dir, tmpdir):
+    full = tk.ndimage.load(data_dir / "Lenna.png")
+    path = str(tmpdir.join("Lenna.jpg"))
+    tk.ndimage.save(path, full)
+    h, w = full.shape[:2]
+
+    img, scale = tk.ndimage.load_scaled(path, target_size=(h // 4, w // 4))
+    assert img.shape == (h // 4, w // 4, 3)
+    assert scale == pytest.approx((0.25, 0.25))
+    assert (
+        tk.ndimage.load(path, grayscale=True, target_size=(h // 2, w // 2)).shape
+        == (h // 2, w // 2, 1)
+    )
+    # 目安のサイズを下回らない
+    assert tk.ndimage.load(path, target_size=(h // 4 + 1, w // 4)).shape[0] == h // 2
+
+    # EXIFで90度回転されるケース
+    import PIL.Image
+
+    rect = np.zeros((h, w // 2, 3), dtype=np.uint8)
+    pil_img = PIL.Image.fromarray(rect)
+    exif = pil_img.getexif()
+    exif[0x0112] = 6
+    rotated_path = str(tmpdir.join("rotated.jpg"))
+    pil_img.save(rotated_path, exif=exif)
+    img, scale = tk.ndimage.load_scaled(rotated_path, target_size=(w // 8, h // 4))
+    assert img.shape == (w // 8, h // 4, 3)
+    assert scale == pytest.approx((0.25, 0.25))
+
+
+def test_scan(data_dir, tmpdir):
+    tmpdir = pathlib.Path(str(tmpdir))
+    (tmpdir / "broken.png").write_bytes(b"broken")
+    np.save(str(tmpdir / "array.npy"), np.zeros((3, 4, 5), dtype=np.uint8))
+    paths = [
+        data_dir / "Lenna.png",
+        tmpdir / "broken.png",
+        tmpdir / "array.npy",
+        tmpdir / "missing.png",
+    ]
+    cache_path = tmpdir / "index.pkl"
+    index = tk.ndimage.scan(paths, workers=2, cache_path=cache_path)
+    assert index["path"].tolist() == [str(p) for p in paths]
+    assert index["error"].tolist() == [False, True, False, True]
+    assert index[["height", "width", "channels"]].to_numpy().tolist() == [
+        [256, 256, 3],
+        [0, 0, 0],
+        [3, 4, 5],
+        [0, 0, 0],
+    ]
+    assert index["format"].tolist()[0] == "PNG"
+    assert cache_path.exists()
+
+    # 2回目はキャッシュから (変更されたファイルのみ再読み込み)
+    np.save(str(tmpdir / "array.npy"), np.zeros((6, 7, 1), dtype=np.uint8))
+    index = tk.ndimage.scan(paths[:3], cache_path=cache_path)
+    assert index[["height", "width"]].to_numpy().tolist() == [
+        [256, 256],
+        [0, 0],
+        [6, 7],
+    ]
+
+
 def test_load_text_failed(data_dir):
     with pytest.raises(Exception):
         tk.ndimage.load(data_dir / "text.txt")
@@ -309,6 +374,66 @@ def test_filters(data_dir, check_dir):
         tk.ndimage.save(save_dir / f"{i:02d}_{name}.png", x)
 
 
+@pytest.mark.parametrize("num_channels", [2, 4, 7, 12])
+def test_multichannel(num_channels):
+    """4チャンネルずつの処理がチャンネルごとの処理と一致することの確認"""
+    import cv2
+
+    random = np.random.RandomState(1234)
+    rgb = random.randint(0, 255, size=(40, 30, num_channels)).astype(np.uint8)
+    m = np.array([[0.8, 0.1, 3], [-0.1, 1.2, -2], [0.001, 0, 1]], dtype=np.float32)
+    for actual, fn in [
+        (
+            tk.ndimage.resize(rgb, 20, 50),
+            lambda x: cv2.resize(x, (20, 50), interpolation=cv2.INTER_AREA),
+        ),
+        (
+            tk.ndimage.perspective_transform(
+                rgb, 20, 50, m, interp="bilinear", border_mode="half"
+            ),
+            lambda x: cv2.warpPerspective(
+                x,
+                m,
+                (20, 50),
+                flags=cv2.INTER_LINEAR,
+                borderMode=cv2.BORDER_CONSTANT,
+                borderValue=127,
+            ),
+        ),
+    ]:
+        expected = np.stack([fn(rgb[:, :, c]) for c in range(num_channels)], axis=-1)
+        assert actual.shape == (50, 20, num_channels)
+        assert np.abs(actual.astype(int) - expected.astype(int)).max() <= 1
+
+
+def test_mask_palette():
+    class_colors = np.array([(128, 64, 128), (0, 0, 142), (255, 0, 0)])
+    void_colors = np.array([(0, 0, 0), (0, 0, 142)])  # (0, 0, 142)はクラスを優先
+    rgb = np.array(
+        [[(128, 64, 128), (0, 0, 142)], [(0, 0, 0), (1, 2, 3)]], dtype=np.uint8
+    )
+
+    classes = tk.ndimage.mask_to_class(rgb, class_colors, void_colors=void_colors)
+    assert classes.dtype == np.uint8
+    assert classes.tolist() == [[0, 1], [3, 3]]
+    classes = tk.ndimage.mask_to_class(
+        rgb, class_colors, void_class=255, void_colors=void_colors, bg_class=3
+    )
+    assert classes.tolist() == [[0, 1], [255, 3]]
+
+    onehot = tk.ndimage.mask_to_onehot(
+        rgb, class_colors, append_bg=True, void_colors=void_colors
+    )
+    assert onehot.dtype == np.float32
+    assert onehot.tolist() == [
+        [[1, 0, 0, 0], [0, 1, 0, 0]],
+        [[0, 0, 0, 0], [0, 0, 0, 1]],
+    ]
+
+    mask = tk.ndimage.class_to_mask(np.array([[0, 2], [1, 9]]), class_colors)
+    assert mask.tolist() == [[[128, 64, 128], [255, 0, 0]], [[0, 0, 142], [0, 0, 0]]]
+
+
 def test_cut_mix(data_dir, check_dir):
     random = np.random.RandomState(1234)
     rgb1 = tk.ndimage.load(data_dir / "Lenna.png")  # 256x256の某有名画像
@@ -58,7 +58,7 @@ class Model:
             self
 
         """
-        dataset = dataset.copy()
+        dataset = dataset.copy(deep=False)
         if self.preprocessors is not None:
             dataset.data = self.preprocessors.fit_transform(
                 dataset.data, dataset.labels
@@ -131,7 +131,7 @@ class Model:
 
         """
         pred_list = [
-            self.predict(dataset.slice(val_indices), fold)
+            self.predict(dataset.view(val_indices), fold)
             for fold, (_, val_indices) in enumerate(folds)
         ]
         assert len(pred_list) == len(folds)
@@ -167,7 +167,7 @@ class Model:
             推論結果
 
         """
-        dataset = dataset.copy()
+        dataset = dataset.copy(deep=False)
         if self.preprocessors is not None:
             dataset.data = self.preprocessors.transform(dataset.data)
 
@@ -238,7 +238,7 @@ class KerasModel(Model):
                         X_batch[f"model{i}_target{j}"] = ytj
                 yield X_batch, None
 
-        train_sets, val_sets = zip(*list(dataset.iter(folds)))
+        train_sets, val_sets = zip(*list(dataset.iter(folds, view=True)))
 
         model.fit(
             generator(train_sets, self.train_data_loader),
@@ -261,7 +261,7 @@ class KerasModel(Model):
     def _serial_cv(self, dataset: tk.data.Dataset, folds: tk.validation.FoldsType):
         evals_list = []
         evals_weights = []
-        for fold, (train_set, val_set) in enumerate(dataset.iter(folds)):
+        for fold, (train_set, val_set) in enumerate(dataset.iter(folds, view=True)):
             tk.log.get(__name__).info(
                 f"fold{fold}: train={len(train_set)} val={len(val_set)}"
             )
@@ -329,6 +329,7 @@ class KerasModel(Model):
             ds, _ = data_loader.get_ds(dataset, shuffle=shuffle)
             time.sleep(3)  # prefetch待ち (一応レベル)
             steps = 100
+            data_loader.stats.reset()
             start_time = time.perf_counter()
             for i, _ in enumerate(ds.repeat()):
                 if i >= steps - 1:
@@ -337,6 +338,7 @@ class KerasModel(Model):
             tk.log.get(__name__).info(
                 f"{name}_data_loader:{' ' * (6 - len(name))} {elapsed * 1000 / steps:.0f}ms/step"
             )
+            tk.log.get(__name__).info(data_loader.stats.format())
         return self
 
     @typing.overload
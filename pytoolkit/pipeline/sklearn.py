@@ -59,7 +59,7 @@ class SKLearnModel(Model):
         score_weights = []
         self.estimators_ = []
         for fold, (train_set, val_set) in tk.utils.tqdm(
-            enumerate(dataset.iter(folds)), total=len(folds), desc="cv"
+            enumerate(dataset.iter(folds, view=True)), total=len(folds), desc="cv"
         ):
             kwargs = {}
             if train_set.weights is not None:
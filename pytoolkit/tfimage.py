@@ -0,0 +1,641 @@
+"""tf.dataのグラフ内で動く画像処理関連。
+
+tk.imageの主な変換のTensorFlow版。tf.numpy_functionを使わないので、
+tf.dataのスレッドプールで(GILの影響を受けずに)並列に処理できる。
+
+- 画像は(H, W, C)のテンソルで受け取り、0～255のfloat32で返す。
+- 乱数はstatelessなもののみを使い、要素ごとのseed(shape=(2,)の整数)から決める。
+- tk.data.DataLoaderのsample_graph_fn/batch_graph_fnと組み合わせて使う。
+  sample_graph_fnはサンプル単位で読み込む場合(get_dataをオーバーライドした場合など)はバッチにする前に適用されるので、
+  下の例のようにRandomTransformでサイズの異なる画像を揃えられる。
+  バッチ単位で読み込む場合(batch_mode, parallel="process")は読み込んだ時点で同じshapeである必要がある。
+
+Examples:
+    ::
+
+        aug = tk.tfimage.Compose(
+            [
+                tk.tfimage.RandomTransform(size=(256, 256)),
+                tk.tfimage.RandomColorAugmentors(),
+                tk.tfimage.RandomErasing(),
+            ]
+        )
+        data_loader = tk.data.DataLoader(
+            sample_graph_fn=lambda X, y, seed: (aug(X, seed), y),
+            batch_graph_fn=lambda X, y, seed: tk.tfimage.mixup(X, y, seed),
+        )
+
+"""
+from __future__ import annotations
+
+import typing
+
+import numpy as np
+import tensorflow as tf
+
+
+class Transform:
+    """グラフ内で動く変換の基底クラス。
+
+    Args:
+        p: 適用確率
+
+    """
+
+    def __init__(self, p: float = 1.0):
+        self.p = p
+
+    def __call__(self, image: tf.Tensor, seed: tf.Tensor) -> tf.Tensor:
+        """変換の適用。"""
+        image = tf.cast(image, tf.float32)
+        seed_p, seed_apply = tf.unstack(split_seed(seed, 2))
+        if self.p >= 1:
+            return self.apply(image, seed_apply)
+        return tf.cond(
+            tf.random.stateless_uniform((), seed=seed_p) < self.p,
+            lambda: self.apply(image, seed_apply),
+            lambda: image,
+        )
+
+    def apply(self, image: tf.Tensor, seed: tf.Tensor) -> tf.Tensor:
+        """変換の本体。(入力は0～255のfloat32)"""
+        raise NotImplementedError()
+
+
+class Compose(Transform):
+    """変換を順番に適用する。(tk.image.RandomComposeと違い、順番は固定)
+
+    Args:
+        transforms: 変換のリスト
+
+    """
+
+    def __init__(self, transforms: typing.Sequence[Transform], p: float = 1.0):
+        super().__init__(p=p)
+        self.transforms = list(transforms)
+
+    def apply(self, image, seed):
+        seeds = split_seed(seed, len(self.transforms))
+        for i, t in enumerate(self.transforms):
+            image = t(image, seeds[i])
+        return image
+
+
+class RandomTransform(Transform):
+    """Flip, Scale, Resize, Rotateをまとめて処理。(tk.image.RandomTransformのTF版)
+
+    変換は1回の射影変換(ImageProjectiveTransform)で行う。
+    補間はbilinearのみ。(縮小時のINTER_AREA相当のアンチエイリアスはしない)
+
+    Args:
+        size: 出力サイズ(h, w)
+        flip: 反転の有無(vertical, horizontal)
+        translate: 平行移動の量(vertical, horizontal)
+        border_mode: edge, reflect, wrap, zero, half, one
+        preserve_aspect: アスペクト比を維持するように縮小するならTrue
+        p: 適用確率。適用しない場合もリサイズは行う。(出力サイズを揃えるため)
+
+    """
+
+    def __init__(
+        self,
+        size: typing.Tuple[int, int],
+        flip: typing.Tuple[bool, bool] = (False, True),
+        translate: typing.Tuple[float, float] = (0.125, 0.125),
+        scale_prob: float = 0.5,
+        scale_range: typing.Tuple[float, float] = (2 / 3, 3 / 2),
+        base_scale: float = 1.0,
+        aspect_prob: float = 0.5,
+        aspect_range: typing.Tuple[float, float] = (3 / 4, 4 / 3),
+        rotate_prob: float = 0.25,
+        rotate_range: typing.Tuple[int, int] = (-15, +15),
+        border_mode: str = "edge",
+        preserve_aspect: bool = False,
+        p: float = 1.0,
+    ):
+        super().__init__(p=p)
+        assert border_mode in ("edge", "reflect", "wrap", "zero", "half", "one")
+        self.size = size
+        self.flip = flip
+        self.translate = translate
+        self.scale_prob = scale_prob
+        self.base_scale = base_scale
+        self.scale_range = scale_range
+        self.aspect_prob = aspect_prob
+        self.aspect_range = aspect_range
+        self.rotate_prob = rotate_prob
+        self.rotate_range = rotate_range
+        self.border_mode = border_mode
+        self.preserve_aspect = preserve_aspect
+
+    def __call__(self, image, seed):
+        image = tf.cast(image, tf.float32)
+        seed_p, seed_apply = tf.unstack(split_seed(seed, 2))
+        enabled = tf.random.stateless_uniform((), seed=seed_p) < self.p
+        return self.apply(image, seed_apply, enabled)
+
+    def apply(self, image, seed, enabled=True):
+        # pylint: disable=arguments-differ
+        seeds = split_seed(seed, 13)
+
+        def uniform(i, minval=0.0, maxval=1.0):
+            return tf.random.stateless_uniform(
+                (), seed=seeds[i], minval=minval, maxval=maxval
+            )
+
+        def prob(i, p):
+            return tf.logical_and(enabled, uniform(i) <= p)
+
+        scale = self.base_scale * tf.where(
+            prob(0, self.scale_prob),
+            tf.exp(uniform(1, *np.log(self.scale_range))),
+            1.0,
+        )
+        ar = tf.where(
+            prob(2, self.aspect_prob),
+            tf.exp(uniform(3, *np.log(self.aspect_range))),
+            1.0,
+        )
+        flip_v = tf.logical_and(prob(4, 0.5), self.flip[0])
+        flip_h = tf.logical_and(prob(5, 0.5), self.flip[1])
+        degrees = tf.where(
+            prob(6, self.rotate_prob), uniform(7, *self.rotate_range), 0.0
+        )
+        pos_v = tf.where(enabled, uniform(8), 0.5)
+        pos_h = tf.where(enabled, uniform(9), 0.5)
+        translate_v = tf.where(
+            enabled, uniform(10, -self.translate[0], self.translate[0]), 0.0
+        )
+        translate_h = tf.where(
+            enabled, uniform(11, -self.translate[1], self.translate[1]), 0.0
+        )
+
+        input_shape = tf.cast(tf.shape(image)[:2], tf.float32)
+        transform = self._make_transform(
+            input_shape,
+            scale=scale,
+            ar=ar,
+            flip_v=flip_v,
+            flip_h=flip_h,
+            degrees=degrees,
+            pos_v=pos_v,
+            pos_h=pos_h,
+            translate_v=translate_v,
+            translate_h=translate_h,
+        )
+        return self._warp(image, transform)
+
+    def _make_transform(
+        self,
+        input_shape,
+        scale,
+        ar,
+        flip_v,
+        flip_h,
+        degrees,
+        pos_v,
+        pos_h,
+        translate_v,
+        translate_h,
+    ) -> tf.Tensor:
+        """出力座標から入力座標への変換(ImageProjectiveTransformの形式)を作る。
+
+        tk.image.RandomTransform._make_matrixと同じ変換の逆変換。
+        (単位正方形の各頂点の移動先で定義されるが、アフィン変換なので直接計算する)
+
+        """
+        in_h, in_w = input_shape[0], input_shape[1]
+        out_h, out_w = float(self.size[0]), float(self.size[1])
+        scale_v = scale / tf.sqrt(ar)
+        scale_h = scale * tf.sqrt(ar)
+
+        # 出力側: 単位正方形 → 出力画像上の矩形 (x = x0 + sx * u)
+        if self.preserve_aspect:
+            hr = tf.minimum(in_h / in_w, 1.0)
+            wr = tf.minimum(in_w / in_h, 1.0)
+        else:
+            hr = wr = tf.constant(1.0)
+        x0, sx = (1 - wr) / 2 * out_w, wr * out_w
+        y0, sy = (1 - hr) / 2 * out_h, hr * out_h
+        x0, sx = tf.where(flip_h, x0 + sx, x0), tf.where(flip_h, -sx, sx)
+        y0, sy = tf.where(flip_v, y0 + sy, y0), tf.where(flip_v, -sy, sy)
+
+        # 入力側: 単位正方形 → 平行移動 → 回転 → スケール変換 → 入力画像上の座標
+        theta = degrees * np.pi * 2 / 360
+        c, s = tf.cos(theta), tf.sin(theta)
+        kx, ky = in_w / scale_h, in_h / scale_v
+        bx = -in_w * (1 / scale_h - 1) * pos_h
+        by = -in_h * (1 / scale_v - 1) * pos_v
+
+        # 出力座標(x, y) → 単位正方形(u, v) = ((x - x0) / sx, (y - y0) / sy)
+        # → (u - translate_h - 0.5, v - translate_v - 0.5)を回転して0.5を足し、スケール変換
+        ex = -x0 / sx - translate_h - 0.5
+        ey = -y0 / sy - translate_v - 0.5
+        a0 = kx * c / sx
+        a1 = -kx * s / sy
+        a2 = kx * (c * ex - s * ey + 0.5) + bx
+        b0 = ky * s / sx
+        b1 = ky * c / sy
+        b2 = ky * (s * ex + c * ey + 0.5) + by
+        return tf.stack([a0, a1, a2, b0, b1, b2, 0.0, 0.0])
+
+    def _warp(self, image: tf.Tensor, transform: tf.Tensor) -> tf.Tensor:
+        if self.border_mode == "edge":
+            # ImageProjectiveTransformV2のNEARESTはTensorFlow 2.4以降なので、座標のclipで処理する
+            return self._warp_edge(image, transform)
+        fill_mode, fill_value = {
+            "reflect": ("REFLECT", 0.0),
+            "wrap": ("WRAP", 0.0),
+            "zero": ("CONSTANT", 0.0),
+            "half": ("CONSTANT", 127.0),
+            "one": ("CONSTANT", 255.0),
+        }[self.border_mode]
+        # 定数での埋めは0埋めにずらして処理する (ImageProjectiveTransformV2は0埋めのみ)
+        image = image - fill_value
+        image = tf.raw_ops.ImageProjectiveTransformV2(
+            images=tf.expand_dims(image, axis=0),
+            transforms=tf.expand_dims(transform, axis=0),
+            output_shape=tf.constant(self.size, dtype=tf.int32),
+            interpolation="BILINEAR",
+            fill_mode=fill_mode,
+        )[0]
+        return image + fill_value
+
+    def _warp_edge(self, image: tf.Tensor, transform: tf.Tensor) -> tf.Tensor:
+        """画像の外側を端の画素で埋める射影変換。(bilinear)"""
+        in_shape = tf.shape(image)
+        max_y = tf.cast(in_shape[0] - 1, tf.float32)
+        max_x = tf.cast(in_shape[1] - 1, tf.float32)
+        y, x = tf.meshgrid(
+            tf.range(self.size[0], dtype=tf.float32),
+            tf.range(self.size[1], dtype=tf.float32),
+            indexing="ij",
+        )
+        a0, a1, a2, b0, b1, b2 = tf.unstack(transform[:6])
+        src_x = tf.clip_by_value(a0 * x + a1 * y + a2, 0.0, max_x)
+        src_y = tf.clip_by_value(b0 * x + b1 * y + b2, 0.0, max_y)
+        x0, y0 = tf.floor(src_x), tf.floor(src_y)
+        x1, y1 = tf.minimum(x0 + 1, max_x), tf.minimum(y0 + 1, max_y)
+        wx, wy = (src_x - x0)[..., tf.newaxis], (src_y - y0)[..., tf.newaxis]
+
+        def gather(yy, xx):
+            indices = tf.stack([tf.cast(yy, tf.int32), tf.cast(xx, tf.int32)], axis=-1)
+            return tf.gather_nd(image, indices)
+
+        top = gather(y0, x0) * (1 - wx) + gather(y0, x1) * wx
+        bottom = gather(y1, x0) * (1 - wx) + gather(y1, x1) * wx
+        return top * (1 - wy) + bottom * wy
+
+
+class RandomFlip(Transform):
+    """反転。(RandomTransformを使わない場合用)
+
+    Args:
+        vertical: 上下反転するか否か
+        horizontal: 左右反転するか否か
+
+    """
+
+    def __init__(self, vertical: bool = False, horizontal: bool = True, p=1.0):
+        super().__init__(p=p)
+        self.vertical = vertical
+        self.horizontal = horizontal
+
+    def apply(self, image, seed):
+        u = tf.random.stateless_uniform((2,), seed=seed)
+        if self.vertical:
+            image = tf.where(u[0] < 0.5, image[::-1, :, :], image)
+        if self.horizontal:
+            image = tf.where(u[1] < 0.5, image[:, ::-1, :], image)
+        return image
+
+
+class RandomBrightness(Transform):
+    """明度の変更。"""
+
+    def __init__(self, shift=(-50, 50), p=0.5):
+        super().__init__(p=p)
+        self.shift = shift
+
+    def apply(self, image, seed):
+        shift = tf.random.stateless_uniform(
+            (), seed=seed, minval=self.shift[0], maxval=self.shift[1]
+        )
+        return _clip(image + shift)
+
+
+class RandomContrast(Transform):
+    """コントラストの変更。"""
+
+    def __init__(self, alpha=(1 / 2, 2), p=0.5):
+        super().__init__(p=p)
+        self.alpha = alpha
+
+    def apply(self, image, seed):
+        alpha = _random_loguniform((), seed, *self.alpha)
+        return _clip(image * alpha + 127.5 * (1 - alpha))
+
+
+class RandomSaturation(Transform):
+    """彩度の変更。(RGB以外はそのまま)"""
+
+    def __init__(self, alpha=(1 / 2, 2), p=0.5):
+        super().__init__(p=p)
+        self.alpha = alpha
+
+    def apply(self, image, seed):
+        def fn():
+            alpha = _random_loguniform((), seed, *self.alpha)
+            gray = tf.reduce_sum(
+                image * [0.299, 0.587, 0.114], axis=-1, keepdims=True
+            )
+            return _clip(alpha * image + (1 - alpha) * gray)
+
+        return _if_rgb(image, fn)
+
+
+class RandomHue(Transform):
+    """色相の変更。(tk.ndimage.hue_liteと同じ計算。RGB以外はそのまま)"""
+
+    def __init__(self, alpha=(1 / 1.5, 1.5), beta=(-30, 30), p=0.5):
+        super().__init__(p=p)
+        self.alpha = alpha
+        self.beta = beta
+
+    def apply(self, image, seed):
+        def fn():
+            seed_alpha, seed_beta = tf.unstack(split_seed(seed, 2))
+            alpha = _random_loguniform((3,), seed_alpha, *self.alpha)
+            beta = tf.random.stateless_uniform(
+                (3,), seed=seed_beta, minval=self.beta[0], maxval=self.beta[1]
+            )
+            ma = 3 / tf.reduce_sum(1 / (alpha + 1e-7))
+            mb = tf.reduce_mean(beta)
+            return _clip(image * (alpha / ma) + (beta - mb))
+
+        return _if_rgb(image, fn)
+
+
+class RandomColorAugmentors(Compose):
+    """色関連のDataAugmentationをいくつかまとめたもの。(tk.image.RandomColorAugmentorsのTF版)
+
+    順番のシャッフルとnoisyなものは未対応。
+
+    """
+
+    def __init__(self, p: float = 1.0):
+        super().__init__(
+            [
+                RandomBrightness(p=0.25),
+                RandomContrast(p=0.25),
+                RandomHue(p=0.25),
+                RandomSaturation(p=0.25),
+            ],
+            p=p,
+        )
+
+
+class RandomErasing(Transform):
+    """Random Erasing <https://arxiv.org/abs/1708.04896>
+
+    max_tries個の候補の矩形を一度に作り、最初の有効なものをランダムな色で塗りつぶす。
+    (object_awareは未対応)
+
+    """
+
+    def __init__(
+        self,
+        scale_low=0.02,
+        scale_high=0.4,
+        rate_1=1 / 3,
+        rate_2=3,
+        max_tries=30,
+        p=0.5,
+    ):
+        super().__init__(p=p)
+        assert scale_low <= scale_high
+        assert rate_1 <= rate_2
+        self.scale_low = scale_low
+        self.scale_high = scale_high
+        self.rate_1 = rate_1
+        self.rate_2 = rate_2
+        self.max_tries = max_tries
+
+    def apply(self, image, seed):
+        seeds = split_seed(seed, 5)
+        shape = tf.shape(image)
+        h, w = shape[0], shape[1]
+        hf, wf = tf.cast(h, tf.float32), tf.cast(w, tf.float32)
+        s = (
+            hf
+            * wf
+            * tf.random.stateless_uniform(
+                (self.max_tries,),
+                seed=seeds[0],
+                minval=self.scale_low,
+                maxval=self.scale_high,
+            )
+        )
+        r = _random_loguniform((self.max_tries,), seeds[1], self.rate_1, self.rate_2)
+        ew = tf.cast(tf.sqrt(s / r), tf.int32)
+        eh = tf.cast(tf.sqrt(s * r), tf.int32)
+        valid = (ew > 0) & (eh > 0) & (ew < w) & (eh < h)
+        found = tf.reduce_any(valid)
+        first = tf.argmax(tf.cast(valid, tf.int32), output_type=tf.int32)
+        ew, eh = ew[first], eh[first]
+        u = tf.random.stateless_uniform((2,), seed=seeds[2])
+        ex = tf.cast(u[0] * tf.cast(w - ew, tf.float32), tf.int32)
+        ey = tf.cast(u[1] * tf.cast(h - eh, tf.float32), tf.int32)
+
+        ys = tf.range(h)[:, tf.newaxis]
+        xs = tf.range(w)[tf.newaxis, :]
+        region = found & (ys >= ey) & (ys < ey + eh) & (xs >= ex) & (xs < ex + ew)
+        color = tf.random.stateless_uniform(
+            shape[2:], seed=seeds[3], minval=0, maxval=256, dtype=tf.int32
+        )
+        return tf.where(
+            region[:, :, tf.newaxis],
+            tf.cast(color, tf.float32)[tf.newaxis, tf.newaxis, :],
+            image,
+        )
+
+
+class GridMask(Transform):
+    """GridMask <https://arxiv.org/abs/2001.04086> (tk.image.GridMaskのTF版)
+
+    マスク画像を作って回転させる代わりに、出力画素ごとに回転前の座標を計算してマスクを決める。
+
+    """
+
+    def __init__(
+        self,
+        r: typing.Union[float, typing.Tuple[float, float]] = 0.6,
+        d: typing.Tuple[float, float] = (0.4, 1.0),
+        random_color: bool = False,
+        fill_value: int = 0,
+        p: float = 0.7,
+    ):
+        super().__init__(p=p)
+        self.r: typing.Tuple[float, float] = r if isinstance(r, tuple) else (r, r)
+        self.d: typing.Tuple[float, float] = d
+        self.random_color = random_color
+        self.fill_value = fill_value
+
+    def apply(self, image, seed):
+        seeds = split_seed(seed, 4)
+        shape = tf.shape(image)
+        h, w = shape[0], shape[1]
+        hh, ww = h * 3 // 2, w * 3 // 2
+        u = tf.random.stateless_uniform((5,), seed=seeds[0])
+        d = tf.cast(
+            tf.cast(tf.minimum(h, w), tf.float32)
+            * (self.d[0] + u[0] * (self.d[1] - self.d[0])),
+            tf.int32,
+        )
+        d = tf.maximum(d, 1)
+        l_ = tf.cast(
+            tf.cast(d, tf.float32) * (self.r[0] + u[1] * (self.r[1] - self.r[0])),
+            tf.int32,
+        )
+        theta = u[2] * np.pi * 2
+        cy = tf.cast(u[3] * tf.cast(hh - h, tf.float32), tf.int32)
+        cx = tf.cast(u[4] * tf.cast(ww - w, tf.float32), tf.int32)
+
+        # 出力画素 → 回転前のマスク上の座標
+        dy = tf.cast(tf.range(h)[:, tf.newaxis] + cy - hh // 2, tf.float32)
+        dx = tf.cast(tf.range(w)[tf.newaxis, :] + cx - ww // 2, tf.float32)
+        c, s = tf.cos(theta), tf.sin(theta)
+        mu = tf.math.floormod(tf.cast(tf.round(c * dx - s * dy), tf.int32) + ww // 2, ww)
+        mv = tf.math.floormod(tf.cast(tf.round(s * dx + c * dy), tf.int32) + hh // 2, hh)
+        mask = (tf.math.floormod(mu, d) < l_) | (tf.math.floormod(mv, d) < l_)
+
+        if self.random_color:
+            color = tf.random.stateless_uniform(
+                shape[2:], seed=seeds[1], minval=0, maxval=256, dtype=tf.int32
+            )
+            color = tf.cast(color, tf.float32)
+        else:
+            color = tf.fill(shape[2:], float(self.fill_value))
+        return tf.where(mask[:, :, tf.newaxis], image, color[tf.newaxis, tf.newaxis, :])
+
+
+def mixup(
+    X: tf.Tensor, y: tf.Tensor, seed: tf.Tensor, alpha: float = 0.2
+) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+    """バッチ内でのmixup。 <https://arxiv.org/abs/1710.09412>
+
+    バッチを逆順にしたものと混ぜる。(yはone-hot化したラベルなど)
+
+    Args:
+        X: 入力のバッチ
+        y: 出力のバッチ
+        seed: 乱数のseed
+        alpha: beta分布のalpha(=beta)
+
+    Returns:
+        X, y
+
+    """
+    batch_size = tf.shape(X)[0]
+    r = _random_beta((batch_size,), seed, alpha)
+    rx = tf.reshape(r, [-1] + [1] * (X.shape.rank - 1))
+    ry = tf.reshape(r, [-1] + [1] * (y.shape.rank - 1))
+    X = tf.cast(X, tf.float32)
+    y = tf.cast(y, tf.float32)
+    X = X * rx + X[::-1] * (1 - rx)
+    y = y * ry + y[::-1] * (1 - ry)
+    return X, y
+
+
+def cut_mix(
+    X: tf.Tensor, y: tf.Tensor, seed: tf.Tensor, beta: float = 1.0
+) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+    """バッチ内でのCutMix。 <https://arxiv.org/abs/1905.04899>
+
+    バッチを逆順にしたものから矩形を切り貼りする。(yはone-hot化したラベルなど)
+    ラベルの比率はtk.ndimage.cut_mixと同じくbeta分布の乱数をそのまま使う。
+
+    Args:
+        X: 画像のバッチ。shape=(N, H, W, C)
+        y: 出力のバッチ
+        seed: 乱数のseed
+        beta: beta分布のbeta
+
+    Returns:
+        X, y
+
+    """
+    seed_lam, seed_pos = tf.unstack(split_seed(seed, 2))
+    shape = tf.shape(X)
+    batch_size, h, w = shape[0], shape[1], shape[2]
+    hf, wf = tf.cast(h, tf.float32), tf.cast(w, tf.float32)
+    lam = _random_beta((batch_size,), seed_lam, beta)
+    cut_rat = tf.sqrt(1.0 - lam)
+    cut_w = tf.cast(wf * cut_rat, tf.int32)
+    cut_h = tf.cast(hf * cut_rat, tf.int32)
+    u = tf.random.stateless_uniform((2, batch_size), seed=seed_pos)
+    cx = tf.cast(u[0] * wf, tf.int32)
+    cy = tf.cast(u[1] * hf, tf.int32)
+    bbx1 = tf.clip_by_value(cx - cut_w // 2, 0, w)[:, tf.newaxis, tf.newaxis]
+    bby1 = tf.clip_by_value(cy - cut_h // 2, 0, h)[:, tf.newaxis, tf.newaxis]
+    bbx2 = tf.clip_by_value(cx + cut_w // 2, 0, w)[:, tf.newaxis, tf.newaxis]
+    bby2 = tf.clip_by_value(cy + cut_h // 2, 0, h)[:, tf.newaxis, tf.newaxis]
+    ys = tf.range(h)[tf.newaxis, :, tf.newaxis]
+    xs = tf.range(w)[tf.newaxis, tf.newaxis, :]
+    region = (ys >= bby1) & (ys < bby2) & (xs >= bbx1) & (xs < bbx2)
+    X = tf.cast(X, tf.float32)
+    X = tf.where(region[..., tf.newaxis], X[::-1], X)
+    ry = tf.reshape(lam, [-1] + [1] * (y.shape.rank - 1))
+    y = tf.cast(y, tf.float32)
+    y = y * ry + y[::-1] * (1 - ry)
+    return X, y
+
+
+def split_seed(seed: tf.Tensor, num: int) -> tf.Tensor:
+    """statelessな乱数のseedから、num個の独立なseedを作る。
+
+    Args:
+        seed: shape=(2,)の整数のテンソル
+        num: 作る数
+
+    Returns:
+        shape=(num, 2)のint32のテンソル
+
+    """
+    return tf.random.stateless_uniform(
+        (num, 2), seed=seed, minval=tf.int32.min, maxval=tf.int32.max, dtype=tf.int32
+    )
+
+
+def _if_rgb(image: tf.Tensor, fn: typing.Callable[[], tf.Tensor]) -> tf.Tensor:
+    """RGB(3チャンネル)の場合だけfn()を、それ以外はimageをそのまま返す。
+
+    チャンネル数が静的に不明な場合(tk.data.DataLoaderのシグネチャ推定時など)はtf.condで分岐する。
+
+    """
+    channels = image.shape[-1]
+    if channels is not None:
+        return fn() if channels == 3 else image
+    return tf.cond(tf.shape(image)[-1] == 3, fn, lambda: image)
+
+
+def _clip(image: tf.Tensor) -> tf.Tensor:
+    return tf.clip_by_value(image, 0.0, 255.0)
+
+
+def _random_loguniform(shape, seed, lower: float, upper: float) -> tf.Tensor:
+    """3/4 ～ 4/3みたいな乱数を作って返す。"""
+    assert 0 < lower < 1 < upper
+    return tf.exp(
+        tf.random.stateless_uniform(
+            shape, seed=seed, minval=np.log(lower), maxval=np.log(upper)
+        )
+    )
+
+
+def _random_beta(shape, seed, alpha: float) -> tf.Tensor:
+    """β分布(alpha=beta)の乱数を生成する。"""
+    seed1, seed2 = tf.unstack(split_seed(seed, 2))
+    r1 = tf.random.stateless_gamma(shape, seed=seed1, alpha=alpha)
+    r2 = tf.random.stateless_gamma(shape, seed=seed2, alpha=alpha)
+    return r1 / (r1 + r2)
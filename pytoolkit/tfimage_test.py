@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import pytoolkit as tk
+
+
+def test_transforms(data_dir, check_dir):
+    img = tk.ndimage.load(data_dir / "Lenna.png")
+    aug = tk.tfimage.Compose(
+        [
+            tk.tfimage.RandomTransform(size=(128, 96), rotate_prob=1.0),
+            tk.tfimage.RandomFlip(vertical=True),
+            tk.tfimage.RandomColorAugmentors(),
+            tk.tfimage.RandomErasing(p=1),
+            tk.tfimage.GridMask(random_color=True, p=1),
+        ]
+    )
+    save_dir = check_dir / "tfimage"
+    save_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(4):
+        result = aug(tf.constant(img), tf.constant([0, i], dtype=tf.int64)).numpy()
+        assert result.shape == (128, 96, 3)
+        assert result.dtype == np.float32
+        assert 0 <= result.min() <= result.max() <= 255
+        tk.ndimage.save(save_dir / f"Lenna.tfimage.{i}.png", np.uint8(result))
+
+    # 同じseedなら同じ結果
+    seed = tf.constant([1, 2], dtype=tf.int64)
+    assert aug(img, seed).numpy() == pytest.approx(aug(img, seed).numpy())
+
+
+def test_random_transform_resize(data_dir):
+    """変換無しならリサイズのみ"""
+    img = tk.ndimage.load(data_dir / "Lenna.png")
+    aug = tk.tfimage.RandomTransform(
+        size=(img.shape[0], img.shape[1]),
+        flip=(False, False),
+        translate=(0, 0),
+        scale_prob=0,
+        aspect_prob=0,
+        rotate_prob=0,
+    )
+    result = aug(img, tf.constant([0, 0], dtype=tf.int64)).numpy()
+    assert result == pytest.approx(img.astype(np.float32), abs=1e-3)
+
+
+def test_random_transform_edge(data_dir):
+    """border_mode="edge"は座標のclipで処理する (TF 2.4以降のNEARESTと同じ結果)"""
+    if tf.version.VERSION.startswith(("2.2.", "2.3.")):
+        pytest.skip("fill_mode='NEAREST' requires TensorFlow 2.4")
+    img = tk.ndimage.load(data_dir / "Lenna.png").astype(np.float32)
+    aug = tk.tfimage.RandomTransform(size=(128, 96), border_mode="edge")
+    transform = tf.constant([1.3, 0.2, -20.0, -0.1, 1.1, 30.0, 0.0, 0.0])
+    result = aug._warp(img, transform)  # pylint: disable=protected-access
+    expected = tf.raw_ops.ImageProjectiveTransformV2(
+        images=img[np.newaxis],
+        transforms=transform[tf.newaxis],
+        output_shape=tf.constant((128, 96), dtype=tf.int32),
+        interpolation="BILINEAR",
+        fill_mode="NEAREST",
+    )[0]
+    assert result.numpy() == pytest.approx(expected.numpy(), abs=1e-2)
+
+
+def test_mixup_cut_mix():
+    X = tf.random.uniform((4, 8, 8, 3), maxval=255)
+    y = tf.one_hot([0, 1, 2, 3], 4)
+    seed = tf.constant([0, 0], dtype=tf.int64)
+    for fn in [tk.tfimage.mixup, tk.tfimage.cut_mix]:
+        X2, y2 = fn(X, y, seed)
+        assert X2.shape == X.shape
+        assert y2.shape == y.shape
+        assert y2.numpy().sum(axis=-1) == pytest.approx(np.ones((4,)))
+
+
+def test_data_loader_graph_fn():
+    aug = tk.tfimage.RandomTransform(size=(8, 8))
+    dataset = tk.data.Dataset(
+        data=np.zeros((5, 16, 16, 3), dtype=np.uint8), labels=np.eye(5)
+    )
+    data_loader = tk.data.DataLoader(
+        batch_size=2,
+        sample_graph_fn=lambda X, y, seed: (aug(X, seed), y),
+        batch_graph_fn=lambda X, y, seed: tk.tfimage.mixup(X, y, seed),
+    )
+    ds, steps = data_loader.get_ds(dataset, shuffle=True)
+    assert steps == 3
+    for X_batch, y_batch in ds.take(steps):
+        assert X_batch.shape == (2, 8, 8, 3)
+        assert y_batch.shape == (2, 5)
+
+    # np.random.seedで再現できる
+    results = []
+    for _ in range(2):
+        np.random.seed(1)
+        ds, _ = data_loader.get_ds(dataset, shuffle=True)
+        results.append(next(iter(ds))[1].numpy())
+    assert results[0] == pytest.approx(results[1])
+
+    # predict時は使わない
+    ds, steps = data_loader.get_ds(dataset, without_label=True)
+    assert [X_batch.shape[1] for X_batch in ds] == [16, 16, 16]